@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the session serializer formats.
+
+Reports the bytes stored per session and the
+microseconds per open_session/save_session call.
+
+Usage:
+    python bin/bench_serializers.py [iterations]
+"""
+
+from __future__ import absolute_import, print_function
+
+import sys
+import timeit
+
+from flask import Flask
+
+# pylint: disable=unused-import
+import script_env
+# pylint: enable=unused-import
+from flask_easyauth.constants import REQ_TOKEN_HEADER
+from flask_easyauth.serializers import FORMATS, msgpack
+from flask_easyauth.token_redis_session import TokenRedisSessionInterface
+from bin.memory_redis import MemoryRedis
+
+SID = 'a' * 32
+SESSION_DATA = {
+    'is_authenticated': True,
+    'auth_token': SID,
+    'user_id': 'b' * 32,
+    '_fresh': False
+}
+
+
+def bench_format(fmt, iterations, compress_threshold=None):
+    """
+    Benchmark a single format
+    """
+    app = Flask(__name__)
+    app.config['SESSION_SERIALIZER'] = fmt
+    app.config['SESSION_COMPRESS_THRESHOLD'] = compress_threshold
+    ## A lazy session is not fetched by open_session
+    app.config['SESSION_LAZY'] = False
+    redis = MemoryRedis()
+    iface = TokenRedisSessionInterface(app, redis=redis)
+    ## Seed the stored session
+    sess = iface.session_class(sid=SID, new=True)
+    sess.update(SESSION_DATA)
+    iface.save_session(app, sess, None)
+    size = len(redis.get(iface.prefix + SID))
+    with app.test_request_context(headers={REQ_TOKEN_HEADER: SID}):
+        from flask import request
+
+        def do_open():
+            """
+            open_session
+            """
+            return iface.open_session(app, request)
+
+        def do_save():
+            """
+            save_session, forcing a write
+            """
+            sess.modified = True
+            return iface.save_session(app, sess, None)
+
+        open_us = \
+            timeit.timeit(do_open, number=iterations) / iterations * 1e6
+        save_us = \
+            timeit.timeit(do_save, number=iterations) / iterations * 1e6
+    return (size, open_us, save_us)
+
+
+def main():
+    """
+    Main
+    """
+    iterations = 10000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    print("%-10s %8s %12s %12s" % ('format', 'bytes', 'open (us)', 'save (us)'))
+    for fmt in sorted(FORMATS.keys()):
+        if (fmt == 'msgpack') and (msgpack is None):
+            continue
+        size, open_us, save_us = bench_format(fmt, iterations)
+        print("%-10s %8d %12.2f %12.2f" % (fmt, size, open_us, save_us))
+    return True
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
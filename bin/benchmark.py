@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmarks for the per-request auth path.
+
+Runs offline, against an in-memory Redis stand-in and SQLite.
+Results are written as JSON, and can be compared against the
+results of an earlier run to catch regressions.
+
+Usage:
+    python bin/benchmark.py [--output results.json]
+                            [--compare baseline.json] [--threshold 0.2]
+                            [--redis-latency 0.5]
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+
+from flask import Flask, request, session
+# pylint: disable=no-name-in-module
+from flask.ext.sqlalchemy import SQLAlchemy
+# pylint: enable=no-name-in-module
+
+# pylint: disable=unused-import
+import script_env
+# pylint: enable=unused-import
+from flask_easyauth import Auth, AuthTokenMixin, AuthUserMixin, current_user
+from flask_easyauth import decorators, request_helpers
+from flask_easyauth.constants import REQ_TOKEN_HEADER
+from flask_easyauth.metrics import Metrics
+from flask_easyauth.token_redis_session import TokenRedisSessionInterface
+from bin.memory_redis import MemoryRedis
+
+PASSWORD = "benchmark-password"
+
+
+class BenchSessionInterface(TokenRedisSessionInterface):
+    """
+    Session interface backed by the in-memory Redis stand-in
+    """
+
+    def __init__(self, app):
+        """
+        Constructor
+        """
+        TokenRedisSessionInterface.__init__(self, app, redis=MemoryRedis())
+        return None
+
+
+class LatentRedis(object):
+    """
+    Adds a fixed round trip delay to a Redis stand-in
+    """
+
+    def __init__(self, redis, latency):
+        """
+        Constructor.
+        `latency` is in seconds.
+        """
+        self.redis = redis
+        self.latency = latency
+        return None
+
+    def pipeline(self, transaction=True):
+        """
+        Get a pipeline, delayed once per execute
+        """
+        pipe = self.redis.pipeline(transaction)
+        execute = pipe.execute
+
+        def delayed():
+            """
+            Delayed execute
+            """
+            time.sleep(self.latency)
+            return execute()
+
+        pipe.execute = delayed
+        return pipe
+
+    def __getattr__(self, name):
+        """
+        Get a delayed command
+        """
+        func = getattr(self.redis, name)
+
+        def command(*args, **kwargs):
+            """
+            Delayed command
+            """
+            time.sleep(self.latency)
+            return func(*args, **kwargs)
+
+        return command
+
+
+class BenchAuth(Auth):
+    """
+    Auth using the in-memory Redis stand-in
+    """
+
+    session_interface_cls = BenchSessionInterface
+
+
+def create_app(config=None):
+    """
+    Create the benchmark app and its models
+    """
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SECRET_KEY'] = 'benchmark'
+    app.config.update(config or {})
+    db = SQLAlchemy(app)
+
+    # pylint: disable=too-few-public-methods,invalid-name
+    class User(db.Model, AuthUserMixin):
+        """
+        User
+        """
+        __tablename__ = 'user'
+        id = db.Column(db.Integer, primary_key=True)
+        email = db.Column(db.String(255), index=True, unique=True)
+        password = db.Column(db.String(255))
+        active = db.Column(db.Boolean(), nullable=False, default=True)
+        real = db.Column(db.Boolean(), nullable=False, default=True)
+        type = db.Column(db.String(10), index=True)
+        __mapper_args__ = {
+            'polymorphic_identity': 'user',
+            'polymorphic_on': type
+        }
+
+        @classmethod
+        def get(cls, user_id):
+            """
+            Get by id
+            """
+            return cls.query.get(user_id)
+
+    class AdminUser(User):
+        """
+        Admin user
+        """
+        __tablename__ = 'adminuser'
+        __mapper_args__ = {
+            'polymorphic_identity': 'admin'
+        }
+        id = \
+            db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+
+    class AuthToken(db.Model, AuthTokenMixin):
+        """
+        Token
+        """
+        __tablename__ = 'auth_token'
+        id = db.Column(db.Integer, primary_key=True)
+        user_id = \
+            db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+        user = \
+            db.relationship(
+                'User',
+                backref=db.backref('auth_tokens', lazy='dynamic'))
+        token = db.Column(db.String(255), nullable=False, unique=True)
+    # pylint: enable=too-few-public-methods,invalid-name
+
+    auth = BenchAuth(app, db, User, AuthToken)
+
+    @app.route('/real')
+    @decorators.real_required
+    def real_view():
+        """
+        Real user view
+        """
+        return "ok"
+
+    with app.app_context():
+        db.create_all()
+        user = AdminUser()
+        user.set_security_attrs("bench@example.com", password=PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        with app.test_request_context():
+            auth.login(user)
+            token = session['auth_token']
+            ## Saved as at the end of the login request
+            app.session_interface.save_session(app, session, None)
+    return (app, auth, User, token)
+
+
+def time_it(func, number, repeat):
+    """
+    Time a function, in microseconds per call
+    """
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    per_call = sorted((timing / number) * 1e6 for timing in timings)
+    return {
+        'us_min': per_call[0],
+        'us_median': per_call[len(per_call) // 2],
+        'number': number,
+        'repeat': repeat
+    }
+
+
+def noop_view():
+    """
+    A view which does nothing
+    """
+    return None
+
+
+def run_request_benchmarks(app, auth, token, number, repeat):
+    """
+    Benchmarks which run inside an authenticated request
+    """
+    # pylint: disable=protected-access
+    results = {}
+    iface = app.session_interface
+    headers = {REQ_TOKEN_HEADER: token}
+    real_view = decorators.real_required(noop_view)
+    admin_view = decorators.admin_required(noop_view)
+    types_view = decorators.user_types_required('admin')(noop_view)
+    with app.test_request_context(headers=headers):
+        sess = iface.load_session(token)
+        results['get_request_token'] = time_it(
+            lambda: request_helpers.get_request_token(
+                auth.req_tok_type, request),
+            number, repeat)
+        results['open_session'] = time_it(
+            lambda: iface.open_session(app, request), number, repeat)
+        results['open_session.load'] = time_it(
+            lambda: iface.open_session(app, request).load(), number, repeat)
+        results['save_session.unmodified'] = time_it(
+            lambda: iface.save_session(app, sess, None), number, repeat)
+
+        def save_modified():
+            """
+            Force a write
+            """
+            sess.modified = True
+            return iface.save_session(app, sess, None)
+
+        results['save_session.modified'] = time_it(
+            save_modified, number, repeat)
+        results['load_user_from_request'] = time_it(
+            lambda: auth.login_manager._load_user_from_request(request),
+            number, repeat)
+        ## Load current_user once, as the first decorator would
+        current_user._get_current_object()
+        results['decorator.real_required'] = time_it(
+            real_view, number, repeat)
+        results['decorator.admin_required'] = time_it(
+            admin_view, number, repeat)
+        results['decorator.user_types_required'] = time_it(
+            types_view, number, repeat)
+    return results
+
+
+def run_end_to_end(app, token, number, repeat):
+    """
+    Full requests through the test client
+    """
+    client = app.test_client()
+    headers = {REQ_TOKEN_HEADER: token}
+    return {
+        'request.authenticated': time_it(
+            lambda: client.get('/real', headers=headers), number, repeat),
+        'request.anonymous': time_it(
+            lambda: client.get('/real'), number, repeat)
+    }
+
+
+def run_login_benchmarks(app, auth, user_cls, number, repeat, hash_number):
+    """
+    Login, logout and password verification
+    """
+    results = {}
+    with app.test_request_context():
+        user = user_cls.get_by_email("bench@example.com")
+
+        def login_logout():
+            """
+            Login then logout
+            """
+            auth.login(user)
+            auth.logout()
+
+        results['login_logout'] = time_it(login_logout, number, repeat)
+        results['verify_password'] = time_it(
+            lambda: user.verify_password(PASSWORD), hash_number, repeat)
+    return results
+
+
+class BytesSink(object):
+    """
+    Metrics sink which totals the bytes of session writes
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.total = 0
+        self.count = 0
+        return None
+
+    def incr(self, name, value, labels):
+        """
+        Counters are ignored
+        """
+        # pylint: disable=unused-argument
+        return None
+
+    def observe(self, name, value, labels):
+        """
+        Total session write sizes
+        """
+        # pylint: disable=unused-argument
+        if name == 'session_bytes':
+            self.total += value
+            self.count += 1
+        return None
+
+
+def bench_storage(storage, number, repeat, fields, field_size, latency):
+    """
+    Load a large session, change one small key and save it,
+    with one session storage, over a Redis with a simulated
+    round trip. Also reports the bytes written per save.
+    """
+    app = Flask(__name__)
+    app.config['SESSION_STORAGE'] = storage
+    iface = \
+        TokenRedisSessionInterface(
+            app, redis=LatentRedis(MemoryRedis(), latency))
+    sess = iface.session_class(sid='bench', new=True)
+    for i in range(fields):
+        sess['field%d' % i] = 'x' * field_size
+    iface.save_session(app, sess, None)
+    sink = BytesSink()
+    iface.metrics = Metrics([sink])
+
+    def change_one():
+        """
+        Load, change one key, save
+        """
+        loaded = iface.load_session('bench')
+        loaded['counter'] = loaded.get('counter', 0) + 1
+        iface.save_session(app, loaded, None)
+
+    result = time_it(change_one, number, repeat)
+    result['bytes_per_save'] = sink.total // max(sink.count, 1)
+    result['latency_ms'] = latency * 1000
+    return result
+
+
+def run_storage_benchmarks(number, repeat, latency, fields=50,
+                           field_size=1024):
+    """
+    Blob against hash session storage: load a large
+    session, change one small key and save it
+    """
+    results = {}
+    for storage in ('blob', 'hash'):
+        results['session_storage.%s' % storage] = \
+            bench_storage(
+                storage, number, repeat, fields, field_size, latency)
+    return results
+
+
+def run_write_behind_benchmarks(number, latency):
+    """
+    Time spent saving a modified session before the response,
+    writing it to Redis against queueing it for the background
+    writer, over a Redis with a simulated round trip
+    """
+    results = {}
+    for name, enabled in (('write_through', False), ('write_behind', True)):
+        app = Flask(__name__)
+        app.config['SESSION_WRITE_BEHIND'] = enabled
+        iface = \
+            TokenRedisSessionInterface(
+                app, redis=LatentRedis(MemoryRedis(), latency))
+        sess = iface.session_class(sid='bench', new=True)
+        sess['counter'] = 0
+        iface.save_session(app, sess, None)
+        timings = []
+        for _ in range(number):
+            loaded = iface.load_session('bench')
+            loaded['counter'] += 1
+            start = timeit.default_timer()
+            iface.save_session(app, loaded, None)
+            timings.append((timeit.default_timer() - start) * 1e6)
+        if iface.session_writer is not None:
+            iface.session_writer.flush()
+        timings.sort()
+        results['session_write.%s' % name] = {
+            'us_median': timings[len(timings) // 2],
+            'us_p99': timings[int(len(timings) * 0.99)],
+            'number': number,
+            'latency_ms': latency * 1000
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline.
+    Returns the names of benchmarks which regressed.
+    """
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['us_median']
+        after = result['us_median']
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print("%-34s %10.2f -> %10.2f us (%+.1f%%)%s" % (
+            name, before, after, change * 100, flag))
+    return regressions
+
+
+def main():
+    """
+    Main
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--number', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--hash-number', type=int, default=3)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--compare', default=None)
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--redis-latency', type=float, default=0.5,
+                        help="simulated round trip, in ms, for the "
+                        "storage and write-behind benchmarks")
+    args = parser.parse_args()
+    app, auth, user_cls, token = create_app()
+    results = {}
+    results.update(
+        run_request_benchmarks(app, auth, token, args.number, args.repeat))
+    results.update(run_end_to_end(app, token, args.number, args.repeat))
+    results.update(
+        run_login_benchmarks(
+            app, auth, user_cls, args.number // 10, args.repeat,
+            args.hash_number))
+    results.update(
+        run_storage_benchmarks(
+            args.number // 10, args.repeat, args.redis_latency / 1000.0))
+    results.update(
+        run_write_behind_benchmarks(
+            args.number // 10, args.redis_latency / 1000.0))
+    output = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'results': results
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as fhl:
+            json.dump(output, fhl, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+    if args.compare is not None:
+        with open(args.compare) as fhl:
+            baseline = json.load(fhl)
+        if compare(output, baseline, args.threshold):
+            sys.exit(1)
+    return True
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
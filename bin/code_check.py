@@ -28,6 +28,11 @@ CHECK_FILES = [
     'bin/'
 ]
 
+## Modules which only parse on Python 3
+PY3_FILES = [
+    'aio.py'
+]
+
 PYLINT_DISABLES = [
     'import-error',
     'locally-disabled',
@@ -97,6 +102,11 @@ def build_pylint_options():
     pylint_opts.append(__file__)
     pylint_opts.append(build_pylint_opt('rcfile', PYLINT_RCFILE))
     pylint_opts += map(build_pylint_disable, PYLINT_DISABLES)
+    if sys.version_info[0] < 3:
+        ## Replaces the ignore list of the rcfile
+        pylint_opts.append(
+            build_pylint_opt(
+                'ignore', ','.join(['CVS', '.git', 'migrations'] + PY3_FILES)))
     pylint_opts += CHECK_FILES
     return pylint_opts
 
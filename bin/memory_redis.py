@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+A minimal in-memory stand-in for the Redis client,
+used by the benchmarks so they can run offline.
+
+Only the commands used by flask_easyauth are implemented,
+with the signatures of the redis-py client, e.g. expiry is
+set with `set(name, value, ex=seconds)`.
+"""
+
+from __future__ import absolute_import
+
+import time
+
+
+class MemoryPipeline(object):
+    """
+    A non-transactional pipeline
+    """
+
+    def __init__(self, redis):
+        """
+        Constructor
+        """
+        self.redis = redis
+        self.calls = []
+        return None
+
+    def __getattr__(self, name):
+        """
+        Queue a command
+        """
+        func = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            """
+            Queue wrapper
+            """
+            self.calls.append((func, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        """
+        Run all queued commands
+        """
+        calls = self.calls
+        self.calls = []
+        return [func(*args, **kwargs) for func, args, kwargs in calls]
+
+
+class MemoryRedis(object):
+    """
+    In-memory Redis stand-in
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.data = {}
+        self.expires = {}
+        self.commands = 0
+        return None
+
+    def _expire_key(self, name):
+        """
+        Drop a key if it has expired
+        """
+        self.commands += 1
+        exp = self.expires.get(name)
+        if (exp is not None) and (exp <= time.time()):
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+        return None
+
+    def pipeline(self, transaction=True):
+        """
+        Get a pipeline
+        """
+        # pylint: disable=unused-argument
+        return MemoryPipeline(self)
+
+    def get(self, name):
+        """
+        GET
+        """
+        self._expire_key(name)
+        return self.data.get(name)
+
+    def set(self, name, value, ex=None, nx=False):
+        """
+        SET
+        """
+        self._expire_key(name)
+        if nx and (name in self.data):
+            return None
+        self.data[name] = value
+        self.expires.pop(name, None)
+        if ex is not None:
+            self.expires[name] = time.time() + ex
+        return True
+
+    def expire(self, name, time_secs):
+        """
+        EXPIRE
+        """
+        self._expire_key(name)
+        if name not in self.data:
+            return False
+        self.expires[name] = time.time() + time_secs
+        return True
+
+    def ttl(self, name):
+        """
+        TTL
+        """
+        self._expire_key(name)
+        if name not in self.data:
+            return -2
+        if name not in self.expires:
+            return -1
+        return int(self.expires[name] - time.time())
+
+    def exists(self, name):
+        """
+        EXISTS
+        """
+        self._expire_key(name)
+        return name in self.data
+
+    def sadd(self, name, *values):
+        """
+        SADD
+        """
+        self._expire_key(name)
+        members = self.data.setdefault(name, set())
+        before = len(members)
+        members.update(values)
+        return len(members) - before
+
+    def srem(self, name, *values):
+        """
+        SREM
+        """
+        self._expire_key(name)
+        members = self.data.get(name, set())
+        before = len(members)
+        members.difference_update(values)
+        return before - len(members)
+
+    def smembers(self, name):
+        """
+        SMEMBERS
+        """
+        self._expire_key(name)
+        return set(self.data.get(name, set()))
+
+    def hgetall(self, name):
+        """
+        HGETALL
+        """
+        self._expire_key(name)
+        return dict(self.data.get(name, {}))
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        """
+        HSET
+        """
+        self._expire_key(name)
+        fields = self.data.setdefault(name, {})
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        added = len([field for field in items if field not in fields])
+        fields.update(items)
+        return added
+
+    def hmset(self, name, mapping):
+        """
+        HMSET
+        """
+        self.hset(name, mapping=mapping)
+        return True
+
+    def hdel(self, name, *keys):
+        """
+        HDEL
+        """
+        self._expire_key(name)
+        fields = self.data.get(name, {})
+        count = 0
+        for key in keys:
+            if fields.pop(key, None) is not None:
+                count += 1
+        if (not fields) and (name in self.data):
+            self.delete(name)
+        return count
+
+    def publish(self, channel, message):
+        """
+        PUBLISH, there are never any subscribers
+        """
+        # pylint: disable=unused-argument
+        self.commands += 1
+        return 0
+
+    def delete(self, *names):
+        """
+        DEL
+        """
+        count = 0
+        for name in names:
+            self._expire_key(name)
+            if self.data.pop(name, None) is not None:
+                count += 1
+            self.expires.pop(name, None)
+        return count
+
+    unlink = delete
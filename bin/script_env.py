@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+
+"""
+Puts the repository root on the import path, so that the
+scripts in bin/ can import the package from a checkout.
+Scripts import this before the package.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+
+ROOT = \
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__),
+            '../'))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+Local multi-instance harness for sharded session storage.
+
+Starts several local redis-server instances (or, with --memory,
+in-memory stand-ins), writes and reads back sessions through the
+session interface, and reports how sessions spread across nodes
+and how many would move if a node were added.
+
+Usage:
+    python bin/shard_harness.py [--nodes 3] [--sessions 10000]
+                                [--base-port 7100] [--memory]
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import subprocess
+import sys
+import time
+import uuid
+
+from flask import Flask
+
+# pylint: disable=unused-import
+import script_env
+# pylint: enable=unused-import
+from flask_easyauth.sharding import HashRing, ShardedRedis
+from flask_easyauth.token_redis_session import TokenRedisSessionInterface
+from bin.memory_redis import MemoryRedis
+
+
+def start_servers(ports):
+    """
+    Start a redis-server per port, and wait for them
+    """
+    procs = []
+    for port in ports:
+        procs.append(
+            subprocess.Popen(
+                [
+                    'redis-server',
+                    '--port', str(port),
+                    '--save', '',
+                    '--appendonly', 'no'
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT))
+    ## Give the servers a moment to accept connections
+    time.sleep(0.5)
+    return procs
+
+
+def stop_servers(procs):
+    """
+    Stop started servers
+    """
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        proc.wait()
+    return None
+
+
+def create_interface(urls, memory):
+    """
+    Create a session interface sharded across `urls`
+    """
+    app = Flask(__name__)
+    app.config['SESSION_REDIS_NODES'] = urls
+    iface = TokenRedisSessionInterface(app)
+    if memory:
+        iface.session_redis = \
+            ShardedRedis(dict((url, MemoryRedis()) for url in urls))
+    return (app, iface)
+
+
+def check_sessions(app, iface, count):
+    """
+    Write sessions, and read them back.
+    Returns the sids, and the number which did not match.
+    """
+    sids = [uuid.uuid4().hex for _ in range(count)]
+    for sid in sids:
+        sess = iface.session_class(sid=sid, new=True)
+        sess['sid'] = sid
+        iface.save_session(app, sess, None)
+    mismatches = 0
+    for sid in sids:
+        if iface.load_session(sid).get('sid') != sid:
+            mismatches += 1
+    return (sids, mismatches)
+
+
+def report_distribution(iface, urls, sids):
+    """
+    Print how sessions spread across nodes, and how many
+    would move if a node were added
+    """
+    ring = iface.session_redis.ring
+    counts = dict((url, 0) for url in urls)
+    for sid in sids:
+        counts[ring.get_node(iface.session_key(sid))] += 1
+    for url in urls:
+        print("%-32s %8d sessions (%.1f%%)" % (
+            url, counts[url], 100.0 * counts[url] / len(sids)))
+    grown = HashRing(urls + ['redis://new-node'], ring.vnodes)
+    moved = sum(
+        1 for sid in sids
+        if ring.get_node(iface.session_key(sid)) !=
+        grown.get_node(iface.session_key(sid))
+    )
+    print("Adding a node moves %.1f%% of sessions (ideal %.1f%%)" % (
+        100.0 * moved / len(sids), 100.0 / (len(urls) + 1)))
+    return True
+
+
+def main():
+    """
+    Main
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--base-port', type=int, default=7100)
+    parser.add_argument('--memory', action='store_true')
+    args = parser.parse_args()
+    ports = [args.base_port + i for i in range(args.nodes)]
+    urls = ['redis://127.0.0.1:%d/0' % port for port in ports]
+    procs = [] if args.memory else start_servers(ports)
+    try:
+        app, iface = create_interface(urls, args.memory)
+        sids, mismatches = check_sessions(app, iface, args.sessions)
+        report_distribution(iface, urls, sids)
+    finally:
+        stop_servers(procs)
+    if mismatches:
+        print("%d sessions did not read back" % mismatches)
+        sys.exit(1)
+    print("All %d sessions read back" % len(sids))
+    return True
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+
+"""
+Asyncio support, for Quart and other ASGI deployments.
+
+Uses the same config keys and Redis wire format as the
+synchronous classes. Redis is accessed via `redis.asyncio`,
+and SQL work is run in an executor so that it never
+blocks the event loop.
+
+Requires Python 3 and redis-py 4.2 or newer.
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+
+from flask import session, request, g
+
+# pylint: disable=no-name-in-module
+from flask.ext.login import current_user
+# pylint: enable=no-name-in-module
+
+import redis.asyncio as aioredis
+from redis.asyncio.connection import UnixDomainSocketConnection
+from redis.exceptions import NoScriptError
+
+from .core import Auth
+from .identity import snapshot_user, restore_user
+from .lua import BACKFILL_TOKEN_SCRIPT
+from .login_manager import AuthLoginManager
+from .redis_client import LazyRedis, create_redis
+from .token_redis_session import TokenRedisSessionInterface
+from .token_store import RedisTokenStore, RedisSQLTokenStore, get_prefetched
+from . import request_helpers
+
+
+def create_async_redis(config, prefix='SESSION_REDIS_'):
+    """
+    Create an asyncio Redis client from app config
+    """
+    return \
+        create_redis(
+            config,
+            prefix,
+            pool_cls=aioredis.BlockingConnectionPool,
+            client_cls=aioredis.Redis,
+            unix_cls=UnixDomainSocketConnection)
+
+
+async def run_script(script, redis, keys=None, args=None):
+    """
+    Run a LuaScript on an asyncio client
+    """
+    keys = list(keys or [])
+    args = list(args or [])
+    try:
+        return await redis.evalsha(script.sha, len(keys), *(keys + args))
+    except NoScriptError:
+        return await redis.eval(script.source, len(keys), *(keys + args))
+
+
+class AsyncTokenRedisSessionInterface(TokenRedisSessionInterface):
+    """
+    An asyncio Redis Session Interface
+    """
+
+    aioredis = None
+
+    def __init__(self, app, redis=None, aioredis_client=None,
+                 prefix='session:'):
+        """
+        Constructor
+        """
+        TokenRedisSessionInterface.__init__(self, app, redis, prefix)
+        if self.session_redis is not self.redis:
+            raise Exception("Session sharding is not supported with asyncio")
+        if self.replica_router is not None:
+            raise Exception("Read replicas are not supported with asyncio")
+        ## Session writes are awaited, never queued
+        self.session_writer = None
+        if aioredis_client is None:
+            config = dict(app.config)
+            aioredis_client = LazyRedis(lambda: create_async_redis(config))
+        self.aioredis = aioredis_client
+        return None
+
+    async def open_session(self, app, request):
+        """
+        Open Session
+        """
+        # pylint: disable=redefined-outer-name
+        sid = (
+            request_helpers
+            .get_request_token(
+                self.req_tok_type,
+                request
+            )
+        )
+        if sid is None:
+            return self.session_class(new=True)
+        with self.metrics.timer('session_load_seconds'):
+            val, ttl, prefetched = await self.fetch_session_async(sid, app)
+            return self.make_session(sid, val, ttl, prefetched)
+
+    async def fetch_session_async(self, sid, app=None):
+        """
+        Fetch a session, see `fetch_session`
+        """
+        keys = self.get_fetch_keys(sid)
+        if self.use_auth_script:
+            val, ttl, tok = \
+                await run_script(
+                    self.auth_script,
+                    self.aioredis,
+                    keys,
+                    self.get_auth_script_args(app))
+        else:
+            pipe = self.aioredis.pipeline(transaction=False)
+            self.queue_fetch(pipe, keys)
+            results = await pipe.execute()
+            val, ttl = results[:2]
+            tok = results[2] if (len(keys) > 1) else None
+        prefetched = {}
+        if len(keys) > 1:
+            prefetched[keys[1]] = tok
+        return (val, ttl, prefetched)
+
+    async def save_session(self, app, sess, response):
+        """
+        Save Session
+        """
+        if self.is_empty(sess):
+            if not sess.new:
+                with self.metrics.timer('session_delete_seconds'):
+                    await self.aioredis.delete(self.session_key(sess.sid))
+            return None
+        redis_exp = self.get_redis_expiration_time(app, sess)
+        if not sess.modified:
+            if self.needs_refresh(sess, redis_exp):
+                await self.aioredis.expire(
+                    self.session_key(sess.sid),
+                    int(redis_exp.total_seconds())
+                )
+                self.metrics.incr('session_refresh_total')
+            return None
+        if sess.sid is None:
+            sess.sid = self.generate_sid()
+        with self.metrics.timer('session_save_seconds'):
+            if self.storage == 'hash':
+                pipe = self.aioredis.pipeline(transaction=False)
+                size = self.queue_hash_save(pipe, sess, redis_exp)
+                await pipe.execute()
+            else:
+                val = self.serializer.dumps(dict(sess))
+                size = len(val)
+                await self.aioredis.set(
+                    self.session_key(sess.sid),
+                    val,
+                    ex=int(redis_exp.total_seconds())
+                )
+        self.metrics.observe('session_bytes', size)
+        return None
+
+
+class AsyncTokenStore(object):
+    """
+    Runs a synchronous token store in an executor
+    """
+
+    store = None
+    executor = None
+
+    def __init__(self, store, executor=None):
+        """
+        Constructor
+        """
+        self.store = store
+        self.executor = executor
+        return None
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking function in the executor,
+        inside an app context
+        """
+        app = self.store.app
+
+        def call():
+            """
+            Executor wrapper
+            """
+            with app.app_context():
+                return func(*args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, call)
+
+    async def add(self, token, user, **kwargs):
+        """
+        Store a token for a user
+        """
+        return await self.run(self.store.add, token, user, **kwargs)
+
+    async def remove(self, token):
+        """
+        Remove a token
+        """
+        return await self.run(self.store.remove, token)
+
+    async def get_user(self, token):
+        """
+        Get the user for a token.
+        The user is loaded in the executor, and rebuilt
+        in the current db session from a snapshot.
+        """
+
+        def load():
+            """
+            Load a user snapshot
+            """
+            user = self.store.get_user(token)
+            if user is None:
+                return None
+            return snapshot_user(user)
+
+        snapshot = await self.run(load)
+        if snapshot is None:
+            return None
+        return restore_user(self.store.db, self.store.user_cls, snapshot)
+
+
+class AsyncRedisTokenStore(AsyncTokenStore):
+    """
+    Async access to a `RedisTokenStore` or `RedisSQLTokenStore`
+    """
+
+    aioredis = None
+
+    def __init__(self, store, aioredis_client, executor=None):
+        """
+        Constructor
+        """
+        AsyncTokenStore.__init__(self, store, executor)
+        self.aioredis = aioredis_client
+        return None
+
+    async def add(self, token, user, **kwargs):
+        """
+        Store a token for a user
+        """
+        ttl = self.store.token_ttl(kwargs.get('expires', None))
+        if ttl > 0:
+            await self.aioredis.set(
+                self.store.key(token),
+                self.store.dump_token(user, **kwargs),
+                ex=ttl
+            )
+        if isinstance(self.store, RedisSQLTokenStore):
+            self.store.persist(
+                self.store.sql_store.insert, token, user.id, kwargs)
+        return True
+
+    async def remove(self, token):
+        """
+        Remove a token
+        """
+        if not isinstance(self.store, RedisSQLTokenStore):
+            await self.aioredis.delete(self.store.key(token))
+            return True
+        pipe = self.aioredis.pipeline(transaction=False)
+        self.store.queue_revoke(pipe, token)
+        await pipe.execute()
+        self.store.persist(self.store.sql_store.remove, token)
+        return True
+
+    async def get_user(self, token):
+        """
+        Get the user for a token
+        """
+        key = self.store.key(token)
+        prefetched = get_prefetched(key)
+        if prefetched is not None:
+            val = prefetched[0]
+        else:
+            val = await self.aioredis.get(key)
+        if val is not None:
+            return self.store.load_user(val)
+        if not isinstance(self.store, RedisSQLTokenStore):
+            return None
+        if await self.aioredis.exists(self.store.revoked_key(token)):
+            return None
+        ## Fall back to the token table, and backfill
+        sql_store = self.store.sql_store
+
+        def load():
+            """
+            Load a user snapshot, and the token expiry
+            """
+            auth_token = sql_store.get_auth_token(token)
+            if auth_token is None:
+                return None
+            return (
+                snapshot_user(auth_token.user),
+                getattr(auth_token, 'expires', None)
+            )
+
+        loaded = await self.run(load)
+        if loaded is None:
+            return None
+        snapshot, expires = loaded
+        user = restore_user(self.store.db, self.store.user_cls, snapshot)
+        backfill_args = self.store.backfill_args(token, user, expires)
+        if backfill_args is not None:
+            keys, args = backfill_args
+            await \
+                run_script(BACKFILL_TOKEN_SCRIPT, self.aioredis, keys, args)
+        return user
+
+
+class AsyncAuthLoginManager(AuthLoginManager):
+    """
+    Auth login manager which resolves tokens asynchronously,
+    before the request is handled
+    """
+
+    async_token_store = None
+
+    def __init__(self, app, db, user_cls, token_cls, token_store,
+                 async_token_store):
+        """
+        Constructor
+        """
+        AuthLoginManager.__init__(
+            self, app, db, user_cls, token_cls, token_store)
+        self.async_token_store = async_token_store
+        self.app.before_request(self.resolve_request_user)
+        return None
+
+    async def resolve_request_user(self):
+        """
+        Resolve the request token before the view runs, so
+        the login manager callbacks never block
+        """
+        token = (
+            request_helpers
+            .get_request_token(
+                self.req_tok_type,
+                request
+            )
+        )
+        if token is None:
+            return None
+        user = await self.async_user_from_token(token)
+        g.easyauth_resolved = (token, user)
+        return None
+
+    async def async_user_from_token(self, token):
+        """
+        Gets a user from a token
+        """
+        with self.metrics.timer('token_lookup_seconds'):
+            user, result = await self._resolve_token_async(token)
+        self.metrics.incr('token_lookup_total', result=result)
+        return user
+
+    async def _resolve_token_async(self, token):
+        """
+        Resolves a token to its user, see `_resolve_token`
+        """
+        if self.token_cache is not None:
+            self.token_cache_invalidator.ensure_listening()
+            snapshot = self.token_cache.get(token)
+            if snapshot is not None:
+                user = restore_user(self.db, self.user_cls, snapshot)
+                return (user, 'cache_hit')
+        user = await self.async_token_store.get_user(token)
+        if user is None:
+            return (None, 'miss')
+        if self.token_cache is not None:
+            self.token_cache.set(token, snapshot_user(user))
+        return (user, 'hit')
+
+    async def async_invalidate_token(self, token):
+        """
+        Evict a token from the token cache of every worker
+        """
+        if self.token_cache_invalidator is None:
+            return False
+        invalidator = self.token_cache_invalidator
+        invalidator.cache.delete(token)
+        aioredis_client = self.app.session_interface.aioredis
+        await aioredis_client.publish(invalidator.channel, token)
+        return True
+
+    def _user_from_token(self, token):
+        """
+        Gets a user from a token, using the
+        user resolved before the request
+        """
+        resolved = getattr(g, 'easyauth_resolved', None)
+        if (resolved is not None) and (resolved[0] == token):
+            return resolved[1]
+        return AuthLoginManager._user_from_token(self, token)
+
+
+class AsyncAuth(Auth):
+    """
+    The Auth app, for asyncio
+    """
+
+    session_interface_cls = AsyncTokenRedisSessionInterface
+    async_token_store = None
+
+    def create_login_manager(self):
+        """
+        Create the login manager
+        """
+        if isinstance(self.token_store, RedisTokenStore):
+            self.async_token_store = \
+                AsyncRedisTokenStore(
+                    self.token_store,
+                    self.app.session_interface.aioredis)
+        else:
+            self.async_token_store = AsyncTokenStore(self.token_store)
+        return \
+            AsyncAuthLoginManager(
+                app=self.app,
+                db=self.db,
+                user_cls=self.user_cls,
+                token_cls=self.token_cls,
+                token_store=self.token_store,
+                async_token_store=self.async_token_store
+            )
+
+    async def authenticate(self, email, password, remote_addr=None):
+        """
+        Get the user with an email and password, or None.
+        Outdated hashes are replaced, in the executor.
+        See `Auth.authenticate`.
+        """
+        if remote_addr is None:
+            remote_addr = request.remote_addr
+        await \
+            self.async_token_store.run(
+                self.check_login_rate, email, remote_addr)
+        user = \
+            await self.async_token_store.run(self.user_cls.get_by_email, email)
+        if user is None:
+            return None
+        valid, new_hash = \
+            await self.hasher.verify_and_update_async(password, user.password)
+        if not valid:
+            return None
+        if new_hash is not None:
+            await \
+                self.async_token_store.run(
+                    self.rehash_password, user, new_hash)
+        return user
+
+    def rehash_password(self, user, new_hash):
+        """
+        Store an upgraded password hash, see `Auth.authenticate`.
+        The user is reloaded after the commit, as the db session
+        of the executor is closed before the user is used again.
+        """
+        user.rehash_password(new_hash)
+        if not self.app.config.get('AUTH_HASH_REHASH_COMMIT', True):
+            return False
+        self.db.session.add(user)
+        self.db.session.commit()
+        self.db.session.refresh(user)
+        return True
+
+    async def login(self, user, **kwargs):
+        """
+        Logs a user in
+        """
+        token = self.create_token(user)
+        await self.async_token_store.add(token, user, **kwargs)
+        ## Filter and index bookkeeping is synchronous
+        await self.async_token_store.run(
+            self.login_manager.remember_token, token)
+        if self.session_index is not None:
+            await self.async_token_store.run(
+                self.session_index.add, user.id, token)
+        self.start_session(user, token)
+        self.metrics.incr('login_total')
+        return True
+
+    async def logout(self):
+        """
+        Logs out current user
+        """
+        if ('auth_token' in session) and (session['auth_token'] is not None):
+            token = session['auth_token']
+            ## Looked up before the token is removed, see `Auth.logout`
+            user_id = None
+            if (
+                    (self.session_index is not None) and
+                    (current_user.is_authenticated())
+            ):
+                user_id = current_user.id
+            await self.async_token_store.remove(token)
+            await self.login_manager.async_invalidate_token(token)
+            if user_id is not None:
+                await self.async_token_store.run(
+                    self.session_index.remove, user_id, token)
+        self.end_session()
+        self.metrics.incr('logout_total')
+        return True
+
+    async def logout_all(self, user):
+        """
+        Logs a user out of every session and device
+        """
+        return await self.revoke_tokens_async([user.id])
+
+    async def revoke_tokens_async(self, user_ids):
+        """
+        Revokes every token and session of the given users
+        """
+        tokens = \
+            await self.async_token_store.run(self.purge_tokens, user_ids)
+        if session.get('auth_token', None) in tokens:
+            self.end_session()
+        return True
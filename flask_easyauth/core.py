@@ -7,12 +7,14 @@ Provides Base Model
 from __future__ import absolute_import
 
 import uuid
+from datetime import timedelta
 
-from flask import session, current_app
+from flask import session, current_app, request
 from werkzeug.local import LocalProxy
 
 # pylint: disable=no-name-in-module
 from flask.ext.login import (
+    current_user,
     login_user,
     logout_user
 )
@@ -20,6 +22,11 @@ from flask.ext.login import (
 
 from .token_redis_session import TokenRedisSessionInterface
 from .login_manager import AuthLoginManager
+from .token_store import create_token_store
+from .hashing import create_hasher, HashingUnavailable
+from .session_index import SessionIndex, unlink_keys
+from .metrics import create_metrics
+from .rate_limit import create_rate_limiter, RateLimited
 from .constants import REQ_TOK_TYPES
 
 # pylint: disable=invalid-name
@@ -37,7 +44,13 @@ class Auth(object):
     login_manager = None
     user_cls = None
     token_cls = None
+    token_store = None
+    hasher = None
+    session_index = None
+    metrics = None
+    rate_limiter = None
     req_tok_type = None
+    session_interface_cls = TokenRedisSessionInterface
 
     def __init__(
             self,
@@ -69,7 +82,13 @@ class Auth(object):
         """
         ## Initialize app
         self.app = app
-        self.app.session_interface = TokenRedisSessionInterface(self.app)
+        self.metrics = create_metrics(self.app)
+        self.app.session_interface = self.session_interface_cls(self.app)
+        self.app.session_interface.metrics = self.metrics
+        if self.app.session_interface.replica_router is not None:
+            self.app.session_interface.replica_router.metrics = self.metrics
+        if self.app.session_interface.session_writer is not None:
+            self.app.session_interface.session_writer.metrics = self.metrics
         ## Initialize db
         self.db = db
         ## Setup models
@@ -81,37 +100,112 @@ class Auth(object):
                 REQ_TOK_TYPES['header']
             )
         )
+        ## Setup token store
+        self.token_store = \
+            create_token_store(
+                self.app,
+                self.db,
+                self.user_cls,
+                self.token_cls
+            )
+        ## Setup per-user token index
+        if app.config.get('AUTH_SESSION_INDEX', True):
+            self.session_index = \
+                SessionIndex(
+                    self.app.session_interface.redis,
+                    app.config.get(
+                        'AUTH_SESSION_INDEX_PREFIX',
+                        'user-tokens:'),
+                    app.config.get(
+                        'AUTH_SESSION_INDEX_TTL',
+                        timedelta(days=30)))
         ## Setup login manager
-        self.login_manager = \
+        self.login_manager = self.create_login_manager()
+        self.login_manager.metrics = self.metrics
+        ## Setup password hashing
+        self.hasher = create_hasher(self.app)
+        self.hasher.metrics = self.metrics
+        self.app.register_error_handler(
+            HashingUnavailable,
+            lambda exc: self.login_manager.unavailable()
+        )
+        ## Setup login rate limiting
+        self.rate_limiter = \
+            create_rate_limiter(
+                self.app,
+                self.app.session_interface.redis)
+        self.app.register_error_handler(
+            RateLimited,
+            lambda exc: self.login_manager.too_many_requests(exc.retry_after)
+        )
+        ## Add to extensions
+        self.app.extensions['easyauth'] = self
+        return True
+
+    def create_login_manager(self):
+        """
+        Create the login manager
+        """
+        return \
             AuthLoginManager(
                 app=self.app,
                 db=self.db,
                 user_cls=self.user_cls,
-                token_cls=self.token_cls
+                token_cls=self.token_cls,
+                token_store=self.token_store
             )
-        ## Add to extensions
-        self.app.extensions['easyauth'] = self
+
+    def check_login_rate(self, email, remote_addr=None):
+        """
+        Charge a login attempt against the rate limits.
+        Raises `RateLimited`, answered with a JSON 429,
+        when any limit is exceeded.
+        """
+        if self.rate_limiter is None:
+            return True
+        try:
+            self.rate_limiter.check(email, remote_addr)
+        except RateLimited as exc:
+            self.metrics.incr('rate_limited_total', scope=exc.scope)
+            raise
         return True
 
+    def authenticate(self, email, password, remote_addr=None):
+        """
+        Get the user with an email and password, or None.
+        Rate limits are checked before the user is looked
+        up or the password is hashed.
+        """
+        if remote_addr is None:
+            remote_addr = request.remote_addr
+        self.check_login_rate(email, remote_addr)
+        user = self.user_cls.get_by_email(email)
+        if user is None:
+            return None
+        old_hash = user.password
+        if not user.verify_password(password):
+            return None
+        if (
+                (user.password != old_hash) and
+                self.app.config.get('AUTH_HASH_REHASH_COMMIT', True)
+        ):
+            self.db.session.commit()
+        return user
+
     def login(self, user, **kwargs):
         """
         Logs a user in
         """
         ## Create token
-        token = self.create_token()
-        ## Add to DB
-        auth_token = self.token_cls()
-        auth_token.user_id = user.id
-        auth_token.token = token
-        for key, val in kwargs.iteritems():
-            setattr(auth_token, key, val)
-        self.db.session.add(auth_token)
-        self.db.session.commit()
-        ## Set session vars
-        session['is_authenticated'] = True
-        session['auth_token'] = token
+        token = self.create_token(user)
+        ## Add to token store
+        self.token_store.add(token, user, **kwargs)
+        self.login_manager.remember_token(token)
+        if self.session_index is not None:
+            self.session_index.add(user.id, token)
         ## Log user in
-        login_user(user, remember=False)
+        self.start_session(user, token)
+        self.metrics.incr('login_total')
         ## Return token
         return True
 
@@ -122,20 +216,91 @@ class Auth(object):
         if ('auth_token' in session) and (session['auth_token'] is not None):
             ## Get token
             token = session['auth_token']
-            ## Remove token from DB
-            auth_token = self.token_cls.query.filter_by(token=token).first()
-            self.db.session.delete(auth_token)
-            self.db.session.commit()
-        ## Clear session stuff
-        session.clear()
-        session['is_authenticated'] = False
-        session['auth_token'] = None
+            ## The user is loaded from the token, so must be
+            ## looked up before the token is removed
+            user_id = None
+            if (
+                    (self.session_index is not None) and
+                    (current_user.is_authenticated())
+            ):
+                user_id = current_user.id
+            ## Remove token from token store
+            self.token_store.remove(token)
+            self.login_manager.invalidate_token(token)
+            if user_id is not None:
+                self.session_index.remove(user_id, token)
         ## Logout the user
+        self.end_session()
+        self.metrics.incr('logout_total')
+        return True
+
+    def logout_all(self, user):
+        """
+        Logs a user out of every session and device
+        """
+        return self.revoke_tokens([user.id])
+
+    def revoke_tokens(self, user_ids):
+        """
+        Revokes every token and session of the given users
+        """
+        tokens = self.purge_tokens(user_ids)
+        ## Current session belongs to a revoked user
+        if session.get('auth_token', None) in tokens:
+            self.end_session()
+        return True
+
+    def purge_tokens(self, user_ids):
+        """
+        Deletes every token and session of the given users,
+        and returns the deleted tokens. Sessions are deleted
+        with pipelined UNLINKs, and tokens with bulk deletes.
+        """
+        if self.session_index is None:
+            raise Exception("Revoking tokens requires AUTH_SESSION_INDEX")
+        user_ids = list(user_ids)
+        tokens = self.session_index.pop_tokens(user_ids)
+        iface = self.app.session_interface
+        unlink_keys(
+            iface.session_redis,
+            [iface.session_key(token) for token in tokens],
+            iface.unlink_batch_size
+        )
+        self.token_store.remove_many(tokens, user_ids)
+        self.login_manager.invalidate_tokens(tokens)
+        return tokens
+
+    def start_session(self, user, token):
+        """
+        Set session vars and log user in
+        """
+        session['is_authenticated'] = True
+        session['auth_token'] = token
+        ## Sessions are stored under the token of the requests
+        ## carrying them, so a session opened under another
+        ## token, or none, moves to this one in full
+        if session.sid != token:
+            session.sid = token
+            session.full_write = True
+        ## Clients use the token right away, so the
+        ## session must be written before responding
+        session.write_through = True
+        login_user(user, remember=False)
+        return True
+
+    def end_session(self):
+        """
+        Clear session vars and log user out.
+        The emptied session is deleted, not written back.
+        """
+        session.clear()
         logout_user()
         return True
 
-    def create_token(self):
+    def create_token(self, user=None):
         """
         Created a token
         """
-        return uuid.uuid4().get_hex()
+        if self.token_store is not None:
+            return self.token_store.create_token(user)
+        return uuid.uuid4().hex
@@ -14,62 +14,21 @@ from werkzeug.local import LocalProxy
 from flask.ext.login import current_user, login_required
 # pylint: enable=no-name-in-module,unused-import
 
-from . import constants
+from .permissions import (
+    Requirement,
+    current_permissions,
+    type_permission
+)
 
 # pylint: disable=invalid-name
 _auth = LocalProxy(lambda: current_app.extensions['easyauth'])
 # pylint: enable=invalid-name
 
 
-def real_required(func):
-    """
-    Ensures that user is a real.
-    A real user is the opposite of an
-    anon user.
-    """
-
-    @wraps(func)
-    def decorated_view(*args, **kwargs):
-        """
-        Decorated class view
-        """
-        ## No Good
-        if (
-                (not current_user.is_authenticated()) or
-                (not current_user.is_real())
-        ):
-            return _auth.login_manager.unauthorized()
-        ## Return success
-        return func(*args, **kwargs)
-
-    return decorated_view
-
-
-def admin_required(func):
-    """
-    Ensures that user is an admin
-    """
-
-    @wraps(func)
-    def decorated_view(*args, **kwargs):
-        """
-        Decorated class view
-        """
-        ## No Good
-        if (
-                (not current_user.is_authenticated()) or
-                (not current_user.is_admin())
-        ):
-            return _auth.login_manager.unauthorized()
-        ## Return success
-        return func(*args, **kwargs)
-
-    return decorated_view
-
-
-def user_types_required(*types):
+def require(requirement):
     """
-    Ensures that user is of a certain type
+    Ensures that the current user meets a
+    compiled permission requirement
     """
 
     def wrapper(func):
@@ -83,17 +42,48 @@ def user_types_required(*types):
             Decorated class view
             """
             ## No Good
-            if (
-                    (current_user.type != constants.ADMIN_USER_TYPE) and
-                    (
-                        (not current_user.is_authenticated()) or
-                        (current_user.type not in types)
-                    )
-            ):
-                return _auth.login_manager.unauthorized()
+            reason = requirement.failure(current_permissions())
+            if reason is not None:
+                return _auth.login_manager.unauthorized(reason)
             ## Return success
             return func(*args, **kwargs)
 
         return decorated_view
 
     return wrapper
+
+
+def real_required(func):
+    """
+    Ensures that user is a real.
+    A real user is the opposite of an
+    anon user.
+    """
+    return require(Requirement('not_real', all_of=['real']))(func)
+
+
+def admin_required(func):
+    """
+    Ensures that user is an admin
+    """
+    return require(Requirement('not_admin', all_of=['admin']))(func)
+
+
+def user_types_required(*types):
+    """
+    Ensures that user is of a certain type.
+    Admins are always allowed.
+    """
+    return \
+        require(
+            Requirement(
+                'wrong_type',
+                any_of=['admin'] + [type_permission(typ) for typ in types]))
+
+
+def permissions_required(*names):
+    """
+    Ensures that user holds every one of the
+    given permissions, see `AuthUserMixin.get_permissions`
+    """
+    return require(Requirement('missing_permission', all_of=names))
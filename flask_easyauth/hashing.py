@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+"""
+Password hashing service.
+
+Hashing is deliberately slow, so it can be offloaded to a bounded
+thread or process pool. When the pool and its queue are full, new
+requests fail fast with `HashingUnavailable` instead of piling up.
+
+The CryptContext is configurable, and its rounds can be calibrated
+against the host to hit a target verify time.
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor
+)
+
+from passlib.apps import custom_app_context
+from passlib.context import CryptContext
+
+from .metrics import NULL_METRICS
+
+CALIBRATION_SECRET = "calibration-secret"
+
+## Contexts rebuilt inside worker processes, keyed by config string
+_CONTEXTS = {}
+
+
+class HashingUnavailable(Exception):
+    """
+    Raised when the hashing queue is full
+    """
+    pass
+
+
+def _run_hash(context_str, method, args):
+    """
+    Run a CryptContext method in a worker.
+    Returns the result and the time spent hashing.
+    """
+    if context_str not in _CONTEXTS:
+        _CONTEXTS[context_str] = CryptContext.from_string(context_str)
+    context = _CONTEXTS[context_str]
+    start = time.time()
+    result = getattr(context, method)(*args)
+    return (result, time.time() - start)
+
+
+class PasswordHasher(object):
+    """
+    Hashes and verifies passwords, optionally in a bounded pool
+    """
+
+    context = None
+    executor_type = None
+    workers = None
+    max_pending = None
+    metrics = NULL_METRICS
+
+    def __init__(self, context=None, executor=None, workers=4,
+                 queue_size=64):
+        """
+        Constructor.
+        `executor` may be None (hash inline), 'thread' or 'process'.
+        """
+        if context is None:
+            context = custom_app_context
+        self.context = context
+        self._context_str = context.to_string()
+        self.workers = workers
+        self.max_pending = workers + queue_size
+        if executor not in (None, 'thread', 'process'):
+            raise Exception("Invalid hash executor")
+        self.executor_type = executor
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {
+            'completed': 0,
+            'rejected': 0,
+            'hash_time': 0.0,
+            'max_hash_time': 0.0,
+            'total_time': 0.0,
+            'max_total_time': 0.0
+        }
+        return None
+
+    def _record(self, method, hash_time, total_time):
+        """
+        Record the latency of a finished hash
+        """
+        self.metrics.observe('hash_seconds', hash_time, method=method)
+        with self._lock:
+            stats = self._stats
+            stats['completed'] += 1
+            stats['hash_time'] += hash_time
+            stats['max_hash_time'] = max(stats['max_hash_time'], hash_time)
+            stats['total_time'] += total_time
+            stats['max_total_time'] = \
+                max(stats['max_total_time'], total_time)
+        return None
+
+    def get_executor(self):
+        """
+        Get the pool for the current process.
+        Pools are created lazily, so forked workers
+        never inherit their parent's pool.
+        """
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                if self.executor_type == 'process':
+                    self._executor = \
+                        ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = \
+                        ThreadPoolExecutor(max_workers=self.workers)
+                self._pending = 0
+                self._pid = pid
+        return self._executor
+
+    def submit(self, method, *args):
+        """
+        Submit a CryptContext method call to the pool.
+        Returns a future resolving to its result.
+        """
+        executor = self.get_executor()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._stats['rejected'] += 1
+                raise HashingUnavailable("Password hashing queue is full")
+            self._pending += 1
+        start = time.time()
+        if self.executor_type == 'process':
+            inner = \
+                executor.submit(
+                    _run_hash, self._context_str, method, args)
+        else:
+            inner = executor.submit(self._run_local, method, args)
+        outer = Future()
+
+        def done(fut):
+            """
+            Completion callback
+            """
+            with self._lock:
+                self._pending -= 1
+            try:
+                result, hash_time = fut.result()
+            # pylint: disable=broad-except
+            except Exception as exc:
+                outer.set_exception(exc)
+                return None
+            # pylint: enable=broad-except
+            self._record(method, hash_time, time.time() - start)
+            outer.set_result(result)
+            return None
+
+        inner.add_done_callback(done)
+        return outer
+
+    def _run_local(self, method, args):
+        """
+        Run a CryptContext method in this process
+        """
+        start = time.time()
+        result = getattr(self.context, method)(*args)
+        return (result, time.time() - start)
+
+    def _call(self, method, *args):
+        """
+        Run a CryptContext method and wait for it
+        """
+        if self.executor_type is None:
+            start = time.time()
+            result, hash_time = self._run_local(method, args)
+            self._record(method, hash_time, time.time() - start)
+            return result
+        return self.submit(method, *args).result()
+
+    def _call_async(self, method, *args):
+        """
+        Run a CryptContext method, returning an awaitable.
+        Must be called from a running event loop. Without a
+        pool, the hash runs in the loop's default executor,
+        so it never blocks the loop.
+        """
+        import asyncio
+        if self.executor_type is None:
+            loop = asyncio.get_running_loop()
+            return loop.run_in_executor(None, self._call, method, *args)
+        return asyncio.wrap_future(self.submit(method, *args))
+
+    def verify(self, password, hashed):
+        """
+        Verify a password against a hash
+        """
+        return self._call('verify', password, hashed)
+
+    def verify_and_update(self, password, hashed):
+        """
+        Verify a password against a hash.
+        Returns a tuple of whether it matched, and a new hash
+        when the old one uses an outdated scheme or cost.
+        """
+        return self._call('verify_and_update', password, hashed)
+
+    def encrypt(self, password):
+        """
+        Hash a password
+        """
+        return self._call('encrypt', password)
+
+    def verify_async(self, password, hashed):
+        """
+        Verify a password against a hash, awaitable
+        """
+        return self._call_async('verify', password, hashed)
+
+    def verify_and_update_async(self, password, hashed):
+        """
+        Verify a password against a hash, and get a new hash
+        when outdated, awaitable. See `verify_and_update`.
+        """
+        return self._call_async('verify_and_update', password, hashed)
+
+    def encrypt_async(self, password):
+        """
+        Hash a password, awaitable
+        """
+        return self._call_async('encrypt', password)
+
+    def stats(self):
+        """
+        Get queue depth and latency counters
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = self._pending
+            stats['queued'] = max(0, self._pending - self.workers)
+            stats['max_pending'] = self.max_pending
+        return stats
+
+
+def _time_hash(context, scheme, rounds, samples):
+    """
+    Best time, in seconds, to hash at the given rounds
+    """
+    best = None
+    for _ in range(samples):
+        start = time.time()
+        context.encrypt(CALIBRATION_SECRET, scheme=scheme, rounds=rounds)
+        elapsed = time.time() - start
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+
+def round_rounds(rounds):
+    """
+    Round linear rounds down to two significant digits, so
+    that hosts and restarts measuring slightly different
+    timings settle on the same value
+    """
+    step = 10 ** max(0, len(str(rounds)) - 2)
+    return (rounds // step) * step
+
+
+def calibrate_context(context, target_time, scheme=None, samples=3):
+    """
+    Benchmark this host and return a copy of `context` whose
+    default scheme uses the rounds that take about `target_time`
+    seconds to verify, for new hashes. Minimum rounds are left
+    as configured, so a calibration never flags existing hashes
+    for an upgrade.
+    """
+    handler = context.handler(scheme)
+    if 'rounds' not in handler.setting_kwds:
+        return context
+    min_rounds = handler.min_rounds or 1
+    max_rounds = handler.max_rounds
+    if handler.rounds_cost == 'log2':
+        sample_rounds = max(min_rounds, handler.default_rounds - 4)
+        elapsed = _time_hash(context, handler.name, sample_rounds, samples)
+        rounds = sample_rounds
+        while (elapsed * 2) <= target_time:
+            rounds += 1
+            elapsed *= 2
+    else:
+        sample_rounds = max(min_rounds, handler.default_rounds // 8)
+        elapsed = _time_hash(context, handler.name, sample_rounds, samples)
+        rounds = \
+            round_rounds(
+                int(sample_rounds * (target_time / max(elapsed, 1e-6))))
+    if max_rounds is not None:
+        rounds = min(max_rounds, rounds)
+    ## New hashes must not fall below the configured minimum,
+    ## which categories, e.g. admin, may raise
+    settings = {}
+    config = context.to_dict()
+    for key, val in config.items():
+        if key.endswith('%s__min_rounds' % handler.name):
+            settings[key[:-len('min_rounds')] + 'default_rounds'] = \
+                max(min_rounds, rounds, val)
+    settings['%s__default_rounds' % handler.name] = \
+        max(
+            min_rounds,
+            rounds,
+            config.get('%s__min_rounds' % handler.name, min_rounds))
+    return context.copy(**settings)
+
+
+def create_crypt_context(app):
+    """
+    Create the CryptContext from app config.
+    AUTH_CRYPT_CONTEXT may be a CryptContext, a passlib
+    config string, or a dict of CryptContext kwargs.
+    """
+    context = app.config.get('AUTH_CRYPT_CONTEXT', None)
+    if context is None:
+        context = custom_app_context
+    elif isinstance(context, dict):
+        context = CryptContext(**context)
+    elif not isinstance(context, CryptContext):
+        context = CryptContext.from_string(context)
+    target_time = app.config.get('AUTH_HASH_TARGET_TIME', None)
+    if target_time is not None:
+        context = calibrate_context(context, target_time)
+    return context
+
+
+def create_hasher(app):
+    """
+    Create the password hasher from app config
+    """
+    return \
+        PasswordHasher(
+            context=create_crypt_context(app),
+            executor=app.config.get('AUTH_HASH_EXECUTOR', None),
+            workers=app.config.get('AUTH_HASH_WORKERS', 4),
+            queue_size=app.config.get('AUTH_HASH_QUEUE_SIZE', 64))
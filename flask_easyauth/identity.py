@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+Snapshots of user identities.
+
+A snapshot holds the column values of a user, so that the user can
+later be rebuilt and attached to a db session without a query.
+Columns left out of a snapshot are loaded lazily on first access.
+"""
+
+from __future__ import absolute_import
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+
+def snapshot_user(user, keys=None):
+    """
+    Capture the loaded column values of a user.
+    When `keys` is given, only those columns and the
+    primary key are captured.
+    """
+    state = inspect(user)
+    mapper = state.mapper
+    if keys is not None:
+        keys = \
+            set(keys) | \
+            set(mapper.get_property_by_column(col).key
+                for col in mapper.primary_key)
+    values = {}
+    for attr in mapper.column_attrs:
+        if (keys is not None) and (attr.key not in keys):
+            continue
+        if attr.key in state.dict:
+            values[attr.key] = state.dict[attr.key]
+    return {
+        'identity': mapper.polymorphic_identity,
+        'values': values
+    }
+
+
+def restore_user(db, user_cls, snapshot):
+    """
+    Rebuild a user from a snapshot and attach it
+    to the current db session
+    """
+    mapper = inspect(user_cls)
+    identity = snapshot['identity']
+    if (identity is not None) and (identity in mapper.polymorphic_map):
+        mapper = mapper.polymorphic_map[identity]
+    user = mapper.class_manager.new_instance()
+    for key, val in snapshot['values'].items():
+        setattr(user, key, val)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def identity_keys(user_cls):
+    """
+    Get the attribute names of the primary key and
+    the polymorphic identity of a user model
+    """
+    mapper = inspect(user_cls)
+    id_key = mapper.get_property_by_column(mapper.primary_key[0]).key
+    type_key = 'type'
+    if mapper.polymorphic_on is not None:
+        type_key = mapper.get_property_by_column(mapper.polymorphic_on).key
+    return (id_key, type_key)
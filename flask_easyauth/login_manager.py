@@ -6,6 +6,8 @@ Provides Base Login Manager
 
 from __future__ import absolute_import
 
+import math
+
 from flask import session, json, Response
 
 # pylint: disable=no-name-in-module
@@ -13,6 +15,16 @@ from flask.ext.login import LoginManager
 # pylint: enable=no-name-in-module
 
 from .constants import REQ_TOK_TYPES
+from .identity import snapshot_user, restore_user, identity_keys
+from .metrics import NULL_METRICS
+from .token_store import SQLTokenStore
+from .token_filter import TokenFilter
+from .token_cache import (
+    TokenCache,
+    TokenCacheInvalidator,
+    TOKEN_CACHE_CHANNEL
+)
+from .shared_cache import SharedTokenCache
 from . import request_helpers
 
 
@@ -27,8 +39,13 @@ class AuthLoginManager(object):
     token_cls = None
     db = None
     req_tok_type = None
+    token_store = None
+    token_cache = None
+    token_cache_invalidator = None
+    token_filter = None
+    metrics = NULL_METRICS
 
-    def __init__(self, app, db, user_cls, token_cls):
+    def __init__(self, app, db, user_cls, token_cls, token_store=None):
         """
         Constructor
         """
@@ -36,18 +53,36 @@ class AuthLoginManager(object):
         self.user_cls = user_cls
         self.token_cls = token_cls
         self.app = app
+        if token_store is None:
+            token_store = SQLTokenStore(app, db, user_cls, token_cls)
+        self.token_store = token_store
         self.req_tok_type = (
             app.config.get(
                 'AUTH_TOKEN_TYPE',
                 REQ_TOK_TYPES['header']
             )
         )
+        self._init_token_cache()
+        if app.config.get('AUTH_TOKEN_FILTER', False):
+            self.token_filter = \
+                TokenFilter(
+                    self.app,
+                    self.token_store,
+                    self.app.session_interface.redis)
         self.manager = LoginManager()
         self.manager.request_loader(self._load_user_from_request)
         self.manager.user_loader(self._load_user)
         self.manager.token_loader(self._user_from_token)
         self.manager.unauthorized_handler(self.unauthorized)
         self.manager.init_app(self.app)
+        ## Tokens are never remembered with a cookie, and the
+        ## remember cookie hook would load the session of
+        ## every request
+        after_request = self.app.after_request_funcs.get(None, [])
+        update_cookie = \
+            getattr(self.manager, '_update_remember_cookie', None)
+        if update_cookie in after_request:
+            after_request.remove(update_cookie)
         return None
 
     def get_manager(self):
@@ -56,6 +91,70 @@ class AuthLoginManager(object):
         """
         return self.manager
 
+    def _init_token_cache(self):
+        """
+        Setup the optional token cache.
+        Enabled by setting AUTH_TOKEN_CACHE_SIZE. With
+        AUTH_TOKEN_CACHE_BACKEND set to `shared`, the cache
+        is shared by every worker on the host.
+        """
+        cache_size = self.app.config.get('AUTH_TOKEN_CACHE_SIZE', None)
+        if not cache_size:
+            return False
+        ttl = self.app.config.get('AUTH_TOKEN_CACHE_TTL', 60)
+        backend = self.app.config.get('AUTH_TOKEN_CACHE_BACKEND', 'local')
+        if backend == 'shared':
+            path = self.app.config.get('AUTH_TOKEN_CACHE_PATH', None)
+            if path is None:
+                raise Exception("AUTH_TOKEN_CACHE_PATH is not set")
+            id_key, type_key = identity_keys(self.user_cls)
+            self.token_cache = \
+                SharedTokenCache(
+                    path,
+                    slots=cache_size,
+                    ttl=ttl,
+                    id_key=id_key,
+                    type_key=type_key)
+        elif backend == 'local':
+            self.token_cache = TokenCache(max_size=cache_size, ttl=ttl)
+        else:
+            raise Exception("Invalid token cache backend")
+        self.token_cache_invalidator = \
+            TokenCacheInvalidator(
+                self.token_cache,
+                self.app.session_interface.redis,
+                self.app.config.get(
+                    'AUTH_TOKEN_CACHE_CHANNEL',
+                    TOKEN_CACHE_CHANNEL))
+        return True
+
+    def remember_token(self, token):
+        """
+        Add a newly issued token to the token filter
+        """
+        if self.token_filter is None:
+            return False
+        self.token_filter.add(token)
+        return True
+
+    def invalidate_token(self, token):
+        """
+        Evict a token from the token cache of every worker
+        """
+        if self.token_cache_invalidator is None:
+            return False
+        self.token_cache_invalidator.publish(token)
+        return True
+
+    def invalidate_tokens(self, tokens):
+        """
+        Evict many tokens from the token cache of every worker
+        """
+        if self.token_cache_invalidator is None:
+            return False
+        self.token_cache_invalidator.publish_many(tokens)
+        return True
+
     def _load_user_from_request(self, request):
         """
         Callback to load a user from a Flask request object
@@ -73,12 +172,14 @@ class AuthLoginManager(object):
         )
         if req_token is None:
             return None
-        auth_token = self.token_cls.query.filter_by(token=req_token).first()
-        if auth_token is None:
+        user = self._user_from_token(req_token)
+        if user is None:
             return None
-        session['is_authenticated'] = True
-        session['auth_token'] = auth_token.token
-        return auth_token.user
+        ## Only changes the session when the values differ,
+        ## and does not load a lazy session
+        update = getattr(session, 'update_on_load', session.update)
+        update(is_authenticated=True, auth_token=req_token)
+        return user
 
     def _load_user(self, user_id):
         """
@@ -90,15 +191,40 @@ class AuthLoginManager(object):
         """
         Gets a user from a token
         """
-        auth_token = self.token_cls.query.filter_by(token=token).first()
-        if auth_token is None:
-            return None
-        return auth_token.user
+        with self.metrics.timer('token_lookup_seconds'):
+            user, result = self._resolve_token(token)
+        self.metrics.incr('token_lookup_total', result=result)
+        return user
 
-    def unauthorized(self):
+    def _resolve_token(self, token):
+        """
+        Resolves a token to its user.
+        Returns the user, or None, and how it was resolved:
+        `cache_hit`, `filtered`, `hit` or `miss`.
+        """
+        if self.token_cache is not None:
+            self.token_cache_invalidator.ensure_listening()
+            snapshot = self.token_cache.get(token)
+            if snapshot is not None:
+                user = restore_user(self.db, self.user_cls, snapshot)
+                return (user, 'cache_hit')
+        if self.token_filter is not None:
+            if not self.token_filter.might_contain(token):
+                return (None, 'filtered')
+        user = self.token_store.get_user(token)
+        if user is None:
+            if self.token_filter is not None:
+                self.token_filter.record_false_positive()
+            return (None, 'miss')
+        if self.token_cache is not None:
+            self.token_cache.set(token, snapshot_user(user))
+        return (user, 'hit')
+
+    def unauthorized(self, reason='login_required'):
         """
         Unauthorized handler
         """
+        self.metrics.incr('unauthorized_total', reason=reason)
         headers = {}
         headers['Content-Type'] = "application/json"
         payload = {
@@ -106,3 +232,29 @@ class AuthLoginManager(object):
             'code': 'not_authorized'
         }
         return Response(json.dumps(payload), 401, headers)
+
+    def unavailable(self):
+        """
+        Service unavailable handler
+        """
+        headers = {}
+        headers['Content-Type'] = "application/json"
+        headers['Retry-After'] = "1"
+        payload = {
+            'msg': "Service unavailable",
+            'code': 'unavailable'
+        }
+        return Response(json.dumps(payload), 503, headers)
+
+    def too_many_requests(self, retry_after=1):
+        """
+        Rate limited handler
+        """
+        headers = {}
+        headers['Content-Type'] = "application/json"
+        headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        payload = {
+            'msg': "Too many requests",
+            'code': 'too_many_requests'
+        }
+        return Response(json.dumps(payload), 429, headers)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Server-side Lua scripts.
+
+Scripts are run with EVALSHA, using a SHA computed locally,
+and fall back to EVAL (which also caches the script) when
+the server replies with NOSCRIPT.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+
+from redis.exceptions import NoScriptError
+
+
+class LuaScript(object):
+    """
+    A Lua script, cached by SHA
+    """
+
+    source = None
+    sha = None
+
+    def __init__(self, source):
+        """
+        Constructor
+        """
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        return None
+
+    def __call__(self, redis, keys=None, args=None):
+        """
+        Run the script
+        """
+        keys = list(keys or [])
+        args = list(args or [])
+        try:
+            return redis.evalsha(self.sha, len(keys), *(keys + args))
+        except NoScriptError:
+            return redis.eval(self.source, len(keys), *(keys + args))
+
+
+## Load a session and its token in one round trip,
+## and slide the session TTL when it is running low.
+##
+## KEYS[1]: session key
+## KEYS[2]: token key (optional)
+## ARGV[1]: refresh threshold, in seconds
+## ARGV[2]: session lifetime, in seconds
+##
+## Returns: {session value, session ttl, token value}
+AUTH_SCRIPT = LuaScript("""
+local sess = redis.call('GET', KEYS[1])
+local ttl = redis.call('TTL', KEYS[1])
+local tok = false
+if KEYS[2] then
+    tok = redis.call('GET', KEYS[2])
+end
+if sess and ttl >= 0 and ttl < tonumber(ARGV[1]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    ttl = tonumber(ARGV[2])
+end
+return {sess, ttl, tok}
+""")
+
+
+## Token bucket rate limit over several buckets at once.
+## A request is only charged when every bucket has a token,
+## so a rejected request never drains the other buckets.
+## Buckets are refilled by the Redis server clock, so clients
+## with skewed clocks can not drain or refill them. Redis
+## before 5 only allows writes after reading the clock when
+## the script replicates its effects.
+##
+## KEYS: bucket keys
+## ARGV[2i - 1], ARGV[2i]: capacity and refill period,
+##   in milliseconds, of KEYS[i]
+##
+## Returns: {0, 0} when allowed, or else {index of the first
+## empty bucket, milliseconds until it has a token}
+RATE_LIMIT_SCRIPT = LuaScript("""
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local period = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+    tokens = math.min(capacity, tokens + (elapsed * capacity / period))
+    if tokens < 1 then
+        return {i, math.ceil((1 - tokens) * period / capacity)}
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HMSET', key, 'tokens', levels[i] - 1, 'ts', now)
+    redis.call('PEXPIRE', key, ARGV[2 * i])
+end
+return {0, 0}
+""")
+
+
+## Backfill a token read from the token table, unless it
+## was revoked in the meantime.
+##
+## KEYS[1]: token key
+## KEYS[2]: revoked token key
+## ARGV[1]: token value
+## ARGV[2]: token lifetime, in seconds
+##
+## Returns: 1 when backfilled, or else 0
+BACKFILL_TOKEN_SCRIPT = LuaScript("""
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+""")
+
+
+## AUTH_SCRIPT, for sessions stored as hashes.
+## The session is returned as a flat list of fields and values.
+HASH_AUTH_SCRIPT = LuaScript("""
+local sess = redis.call('HGETALL', KEYS[1])
+local ttl = redis.call('TTL', KEYS[1])
+local tok = false
+if KEYS[2] then
+    tok = redis.call('GET', KEYS[2])
+end
+if #sess > 0 and ttl >= 0 and ttl < tonumber(ARGV[1]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    ttl = tonumber(ARGV[2])
+end
+return {sess, ttl, tok}
+""")
+
+
+## Elect a single heartbeat writer, and write the heartbeat when
+## elected. The writer holds a lock key, renewed with each
+## heartbeat, and another process takes over once it expires.
+##
+## KEYS[1]: heartbeat key
+## KEYS[2]: writer lock key
+## ARGV[1]: id of the calling process
+## ARGV[2]: lock lifetime, in milliseconds
+## ARGV[3]: heartbeat, the current time in seconds
+##
+## Returns: the current heartbeat, or nil when none was written yet
+HEARTBEAT_SCRIPT = LuaScript("""
+local writer = redis.call('GET', KEYS[2])
+if (not writer) or (writer == ARGV[1]) then
+    redis.call('SET', KEYS[2], ARGV[1], 'PX', ARGV[2])
+    redis.call('SET', KEYS[1], ARGV[3])
+    return ARGV[3]
+end
+return redis.call('GET', KEYS[1])
+""")
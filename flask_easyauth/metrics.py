@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""
+Metrics and timing instrumentation.
+
+Components record counters and observations (latencies in seconds,
+sizes in bytes) through a `Metrics` object, which forwards them to
+its sinks. With no sinks configured, recording is a no-op.
+
+Recorded metrics:
+
+    session_load_seconds        Session load, incl. deserialization
+    session_save_seconds        Session write
+    session_delete_seconds      Session delete
+    session_refresh_total       Session TTL refreshes
+    session_bytes               Bytes serialized per session write
+    session_rejected_total      Legacy pickle sessions dropped
+    session_write_dropped_total Write-behind session writes dropped
+                                after their retries failed
+    token_lookup_seconds        Token to user resolution
+    token_lookup_total          Token lookups, by `result`
+    unauthorized_total          401 responses, by `reason`
+    login_total                 Logins
+    logout_total                Logouts
+    hash_seconds                Password hashing, by `method`
+    rate_limited_total          Rate limited logins, by `scope`
+    session_replica_reads_total Session reads served by a replica
+    session_replica_fallback_total
+                                Session reads sent to the primary
+                                instead, by `reason`
+    session_replica_lag_seconds Replica lag, by `replica`
+"""
+
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, has_app_context
+from flask.signals import Namespace
+
+# pylint: disable=invalid-name
+_signals = Namespace()
+metric_recorded = _signals.signal('easyauth-metric-recorded')
+# pylint: enable=invalid-name
+
+TIME_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+BYTE_BUCKETS = (64, 128, 256, 512, 1024, 4096, 16384, 65536, 262144)
+
+
+class NullTimer(object):
+    """
+    A timer which records nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+    """
+    Times a block, and records it as an observation
+    """
+
+    def __init__(self, metrics, name, labels):
+        """
+        Constructor
+        """
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+        return None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(
+            self.name, time.time() - self.start, **self.labels)
+        return False
+
+
+class Metrics(object):
+    """
+    Forwards metrics to sinks
+    """
+
+    sinks = None
+    enabled = False
+
+    def __init__(self, sinks=None):
+        """
+        Constructor
+        """
+        self.sinks = list(sinks or [])
+        self.enabled = bool(self.sinks)
+        return None
+
+    def incr(self, name, value=1, **labels):
+        """
+        Increment a counter
+        """
+        if not self.enabled:
+            return None
+        for sink in self.sinks:
+            sink.incr(name, value, labels)
+        return None
+
+    def observe(self, name, value, **labels):
+        """
+        Record an observation
+        """
+        if not self.enabled:
+            return None
+        for sink in self.sinks:
+            sink.observe(name, value, labels)
+        return None
+
+    def timer(self, name, **labels):
+        """
+        Get a context manager which times a block
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def get_sink(self, sink_cls):
+        """
+        Get the first sink of a class
+        """
+        for sink in self.sinks:
+            if isinstance(sink, sink_cls):
+                return sink
+        return None
+
+
+NULL_METRICS = Metrics()
+
+
+def _labels_key(labels):
+    """
+    Hashable, ordered form of labels
+    """
+    return tuple(sorted(labels.items()))
+
+
+class PrometheusSink(object):
+    """
+    An in-process, Prometheus style registry of
+    counters and histograms
+    """
+
+    namespace = None
+
+    def __init__(self, namespace='easyauth'):
+        """
+        Constructor
+        """
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        return None
+
+    def incr(self, name, value, labels):
+        """
+        Increment a counter
+        """
+        with self._lock:
+            self._counters[(name, _labels_key(labels))] += value
+        return None
+
+    def observe(self, name, value, labels):
+        """
+        Record an observation in a histogram
+        """
+        key = (name, _labels_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                buckets = \
+                    BYTE_BUCKETS if name.endswith('_bytes') else TIME_BUCKETS
+                hist = {
+                    'buckets': buckets,
+                    'counts': [0] * len(buckets),
+                    'sum': 0.0,
+                    'count': 0
+                }
+                self._histograms[key] = hist
+            for i, bound in enumerate(hist['buckets']):
+                if value <= bound:
+                    hist['counts'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+        return None
+
+    def _format(self, name, labels, extra=None):
+        """
+        Format a sample name with labels
+        """
+        pairs = list(labels)
+        if extra is not None:
+            pairs.append(extra)
+        full_name = '%s_%s' % (self.namespace, name)
+        if not pairs:
+            return full_name
+        return '%s{%s}' % (
+            full_name,
+            ','.join('%s="%s"' % (key, val) for key, val in pairs)
+        )
+
+    def render(self):
+        """
+        Render in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append('%s %s' % (self._format(name, labels), value))
+            for (name, labels), hist in sorted(self._histograms.items()):
+                for bound, count in zip(hist['buckets'], hist['counts']):
+                    lines.append('%s %d' % (
+                        self._format(
+                            name + '_bucket', labels, ('le', bound)),
+                        count))
+                lines.append('%s %d' % (
+                    self._format(name + '_bucket', labels, ('le', '+Inf')),
+                    hist['count']))
+                lines.append('%s %s' % (
+                    self._format(name + '_sum', labels), hist['sum']))
+                lines.append('%s %d' % (
+                    self._format(name + '_count', labels), hist['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class SignalSink(object):
+    """
+    Sends every metric as a `metric_recorded` Flask signal
+    """
+
+    def _send(self, kind, name, value, labels):
+        """
+        Send the signal
+        """
+        sender = None
+        if has_app_context():
+            # pylint: disable=protected-access
+            sender = current_app._get_current_object()
+        metric_recorded.send(
+            sender, kind=kind, name=name, value=value, labels=labels)
+        return None
+
+    def incr(self, name, value, labels):
+        """
+        Increment a counter
+        """
+        return self._send('counter', name, value, labels)
+
+    def observe(self, name, value, labels):
+        """
+        Record an observation
+        """
+        return self._send('observation', name, value, labels)
+
+
+SINKS = {
+    'prometheus': PrometheusSink,
+    'signals': SignalSink
+}
+
+
+def create_metrics(app):
+    """
+    Create metrics from AUTH_METRICS, a list of
+    sink names or sink instances
+    """
+    sinks = []
+    for sink in app.config.get('AUTH_METRICS', None) or []:
+        if sink in SINKS:
+            sink = SINKS[sink]()
+        sinks.append(sink)
+    return Metrics(sinks)
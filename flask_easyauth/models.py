@@ -6,11 +6,10 @@ Provides Base Model
 
 from __future__ import absolute_import
 
-from flask import session, current_app
+from flask import session, current_app, has_app_context
 from werkzeug.local import LocalProxy
 
-from passlib.apps import custom_app_context as pwd_context
-
+from .hashing import PasswordHasher
 from .constants import (
     REQ_TOKEN_COOKIE,
     REQ_TOKEN_HEADER
@@ -21,6 +20,18 @@ from .constants import (
 _auth = LocalProxy(lambda: current_app.extensions['easyauth'])
 # pylint: enable=invalid-name
 
+## Used outside of an app context
+_DEFAULT_HASHER = PasswordHasher()
+
+
+def get_hasher():
+    """
+    Get the password hasher of the current app
+    """
+    if has_app_context() and ('easyauth' in current_app.extensions):
+        return _auth.hasher
+    return _DEFAULT_HASHER
+
 
 class AuthTokenMixin(object):
     """
@@ -34,6 +45,11 @@ class AuthTokenMixin(object):
                 'User',
                 backref=db.backref('auth_tokens', lazy='dynamic'))
         token = db.Column(db.CHAR(32), nullable=False, index=True, unique=True)
+
+    Optionally, tokens can expire. Expired tokens are rejected,
+    and can be deleted with `flask_easyauth.sweeper`:
+
+        expires = db.Column(db.DateTime, nullable=True, index=True)
     """
     pass
 
@@ -122,6 +138,14 @@ class AuthUserMixin(object):
         """
         return (not self.is_authenticated())
 
+    def get_permissions(self):
+        """
+        Names of the permissions granted to this user,
+        checked by `decorators.permissions_required`.
+        Override to grant permissions, e.g. from roles.
+        """
+        return ()
+
     def get_id(self):
         """
         Get ID
@@ -130,13 +154,35 @@ class AuthUserMixin(object):
 
     def verify_password(self, password):
         """
-        Verify a password
+        Verify a password.
+        When the stored hash uses an outdated scheme or cost,
+        it is transparently replaced with a fresh hash.
 
         See:
             http://pythonhosted.org/passlib/lib
-            /passlib.apps.html#predefined-context-example
+            /passlib.context.html#context-migration-example
+        """
+        valid, new_hash = \
+            get_hasher().verify_and_update(password, self.password)
+        if valid and (new_hash is not None):
+            self.rehash_password(new_hash)
+        return valid
+
+    def rehash_password(self, new_hash):
+        """
+        Store an upgraded password hash.
+        Nothing is committed here, so other pending changes of
+        the caller are left alone. `Auth.authenticate` commits
+        it, see AUTH_HASH_REHASH_COMMIT.
+        """
+        self.password = new_hash
+        return True
+
+    def verify_password_async(self, password):
+        """
+        Verify a password, returning an awaitable
         """
-        return pwd_context.verify(password, self.password)
+        return get_hasher().verify_async(password, self.password)
 
     def get_auth_token(self):
         """
@@ -196,4 +242,4 @@ class AuthUserMixin(object):
             http://pythonhosted.org/passlib/lib
             /passlib.apps.html#predefined-context-example
         """
-        return pwd_context.encrypt(password)
+        return get_hasher().encrypt(password)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+Permission bitmasks.
+
+Permission names, user types included, are assigned bits in a
+registry. Decorators compile their requirements into masks when
+they are applied, and the permissions of the current user are
+computed once per request, so each check is a single AND.
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+from flask import g
+# pylint: disable=no-name-in-module
+from flask.ext.login import current_user
+# pylint: enable=no-name-in-module
+
+AUTHENTICATED = 1 << 0
+REAL = 1 << 1
+ADMIN = 1 << 2
+
+
+def type_permission(user_type):
+    """
+    Permission name granted to users of a type
+    """
+    return 'type:%s' % user_type
+
+
+class PermissionRegistry(object):
+    """
+    Assigns a bit to each permission name
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._bits = {
+            'authenticated': AUTHENTICATED,
+            'real': REAL,
+            'admin': ADMIN
+        }
+        self._lock = threading.Lock()
+        return None
+
+    def bit(self, name):
+        """
+        Get the bit of a permission, assigning one if needed
+        """
+        bit = self._bits.get(name)
+        if bit is not None:
+            return bit
+        with self._lock:
+            if name not in self._bits:
+                self._bits[name] = 1 << len(self._bits)
+            return self._bits[name]
+
+    def mask(self, names):
+        """
+        Get the mask of many permissions
+        """
+        mask = 0
+        for name in names:
+            mask |= self.bit(name)
+        return mask
+
+
+PERMISSIONS = PermissionRegistry()
+
+
+class Requirement(object):
+    """
+    A compiled permission check.
+    Users must be authenticated, hold every permission
+    in `all_of`, and at least one in `any_of`, if given.
+    """
+
+    all_mask = None
+    any_mask = None
+    reason = None
+
+    def __init__(self, reason, all_of=(), any_of=(), registry=PERMISSIONS):
+        """
+        Constructor
+        """
+        self.all_mask = AUTHENTICATED | registry.mask(all_of)
+        self.any_mask = registry.mask(any_of)
+        self.reason = reason
+        return None
+
+    def failure(self, mask):
+        """
+        Check a permission mask.
+        Returns None when it is satisfied, or else
+        the reason it is not.
+        """
+        if (
+                ((mask & self.all_mask) == self.all_mask) and
+                ((not self.any_mask) or (mask & self.any_mask))
+        ):
+            return None
+        if not mask & AUTHENTICATED:
+            return 'not_authenticated'
+        return self.reason
+
+
+def user_permissions(user, registry=PERMISSIONS):
+    """
+    Compute the permission mask of a user
+    """
+    if not user.is_authenticated():
+        return 0
+    mask = AUTHENTICATED
+    if user.is_real():
+        mask |= REAL
+    if user.is_admin():
+        mask |= ADMIN
+    if user.type is not None:
+        mask |= registry.bit(type_permission(user.type))
+    mask |= registry.mask(user.get_permissions())
+    return mask
+
+
+def current_permissions():
+    """
+    Get the permission mask of the current user,
+    computed once per request
+    """
+    # pylint: disable=protected-access
+    user = current_user._get_current_object()
+    cached = getattr(g, 'easyauth_permissions', None)
+    if (cached is not None) and (cached[0] is user):
+        return cached[1]
+    if not hasattr(user, 'get_permissions'):
+        ## Anonymous user
+        mask = 0
+    else:
+        mask = user_permissions(user)
+    g.easyauth_permissions = (user, mask)
+    return mask
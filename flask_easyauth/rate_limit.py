@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Login rate limiting.
+
+Login attempts are charged against token buckets in Redis: one
+per account, one per client IP, and a global one which sheds
+load before password hashing can saturate the workers. All
+buckets are checked and charged atomically by a Lua script,
+before the user is looked up or any password is hashed.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+
+from .lua import RATE_LIMIT_SCRIPT
+
+SCOPES = ('account', 'ip', 'global')
+
+DEFAULT_LIMITS = {
+    'account': (10, 60),
+    'ip': (50, 60),
+    'global': (1000, 1)
+}
+
+
+class RateLimited(Exception):
+    """
+    Raised when a login attempt is over a rate limit
+    """
+
+    scope = None
+    retry_after = None
+
+    def __init__(self, scope, retry_after):
+        """
+        Constructor
+        """
+        Exception.__init__(
+            self, "Login rate limit exceeded (%s)" % scope)
+        self.scope = scope
+        self.retry_after = retry_after
+        return None
+
+
+class LoginRateLimiter(object):
+    """
+    Token bucket limits on login attempts
+    """
+
+    redis = None
+    limits = None
+    prefix = None
+
+    def __init__(self, redis, limits=None, prefix='ratelimit:'):
+        """
+        Constructor.
+        `limits` maps each scope to a tuple of attempts and
+        period in seconds, or to None to disable it.
+        """
+        self.redis = redis
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.prefix = prefix
+        return None
+
+    def get_buckets(self, account=None, remote_addr=None):
+        """
+        Get the scope and Redis key of each bucket
+        a login attempt is charged against
+        """
+        buckets = []
+        if account is not None:
+            digest = \
+                hashlib.sha1(
+                    account.strip().lower().encode('utf-8')).hexdigest()
+            buckets.append(('account', 'account:' + digest))
+        if remote_addr is not None:
+            buckets.append(('ip', 'ip:' + remote_addr))
+        buckets.append(('global', 'global'))
+        return [
+            (scope, self.prefix + key) for scope, key in buckets
+            if self.limits.get(scope) is not None
+        ]
+
+    def check(self, account=None, remote_addr=None):
+        """
+        Charge a login attempt.
+        Raises `RateLimited` when any bucket is empty.
+        """
+        buckets = self.get_buckets(account, remote_addr)
+        if not buckets:
+            return True
+        args = []
+        for scope, _ in buckets:
+            attempts, period = self.limits[scope]
+            args.extend([attempts, int(period * 1000)])
+        index, wait = \
+            RATE_LIMIT_SCRIPT(
+                self.redis, [key for _, key in buckets], args)
+        if index:
+            raise RateLimited(buckets[index - 1][0], wait / 1000.0)
+        return True
+
+
+def create_rate_limiter(app, redis):
+    """
+    Create the login rate limiter from app config,
+    or None when AUTH_RATE_LIMIT is not enabled
+    """
+    if not app.config.get('AUTH_RATE_LIMIT', False):
+        return None
+    limits = {}
+    for scope in SCOPES:
+        key = 'AUTH_RATE_LIMIT_%s' % scope.upper()
+        if key in app.config:
+            limits[scope] = app.config[key]
+    return \
+        LoginRateLimiter(
+            redis,
+            limits,
+            app.config.get('AUTH_RATE_LIMIT_PREFIX', 'ratelimit:'))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+Redis client creation.
+
+Clients are created lazily, once per process, so that
+pre-forked workers never share sockets with their parent.
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+
+from redis import Redis, BlockingConnectionPool, UnixDomainSocketConnection
+
+
+class InstrumentedConnectionPool(BlockingConnectionPool):
+    """
+    A blocking connection pool which records how
+    saturated it is and how long callers wait on it.
+    Counters are updated under a lock, as the pool
+    is shared by the threads of a process.
+    """
+
+    in_use = 0
+    peak_in_use = 0
+    waits = 0
+    wait_time = 0.0
+    max_wait_time = 0.0
+    timeouts = 0
+
+    def reset(self):
+        """
+        Reset the pool, and its counters
+        """
+        BlockingConnectionPool.reset(self)
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        return None
+
+    def get_connection(self, command_name, *keys, **options):
+        """
+        Get a connection, timing the wait
+        """
+        start = time.time()
+        try:
+            conn = \
+                BlockingConnectionPool.get_connection(
+                    self, command_name, *keys, **options)
+        except Exception:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        waited = time.time() - start
+        with self._stats_lock:
+            self.waits += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return conn
+
+    def release(self, connection):
+        """
+        Release a connection.
+        Counted first, as another thread may take it
+        as soon as it is back in the pool.
+        """
+        with self._stats_lock:
+            self.in_use -= 1
+        BlockingConnectionPool.release(self, connection)
+        return None
+
+    def stats(self):
+        """
+        Get pool counters
+        """
+        with self._stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'timeouts': self.timeouts
+            }
+
+
+def get_redis_options(
+        config,
+        prefix='SESSION_REDIS_',
+        unix_cls=UnixDomainSocketConnection
+):
+    """
+    Read connection pool options from app config
+    """
+
+    def opt(key, default=None):
+        """
+        Get a config value
+        """
+        return config.get(prefix + key, default)
+
+    options = {
+        'max_connections': opt('MAX_CONNECTIONS', 50),
+        'timeout': opt('POOL_TIMEOUT', 20),
+        'socket_timeout': opt('SOCKET_TIMEOUT', None),
+        'socket_connect_timeout': opt('SOCKET_CONNECT_TIMEOUT', None),
+        'db': opt('DB', 0),
+        'password': opt('PASS', None)
+    }
+    ## Only newer clients support these
+    if opt('HEALTH_CHECK_INTERVAL') is not None:
+        options['health_check_interval'] = opt('HEALTH_CHECK_INTERVAL')
+    if opt('UNIX_SOCKET_PATH') is not None:
+        options['connection_class'] = unix_cls
+        options['path'] = opt('UNIX_SOCKET_PATH')
+    else:
+        options['host'] = opt('HOST', '127.0.0.1')
+        options['port'] = opt('PORT', 6379)
+        options['socket_keepalive'] = opt('SOCKET_KEEPALIVE', False)
+    return options
+
+
+def create_redis(
+        config,
+        prefix='SESSION_REDIS_',
+        pool_cls=InstrumentedConnectionPool,
+        client_cls=Redis,
+        unix_cls=UnixDomainSocketConnection
+):
+    """
+    Create a Redis client from app config.
+    A URL, when configured, takes precedence
+    over host, port, db and password.
+    """
+    options = get_redis_options(config, prefix, unix_cls)
+    url = config.get(prefix + 'URL', None)
+    if url is not None:
+        for key in ('host', 'port', 'db', 'password', 'path'):
+            options.pop(key, None)
+        options.pop('connection_class', None)
+        if url.startswith('unix://'):
+            options.pop('socket_keepalive', None)
+        pool = pool_cls.from_url(url, **options)
+    else:
+        pool = pool_cls(**options)
+    return client_cls(connection_pool=pool)
+
+
+class LazyRedis(object):
+    """
+    Proxy to a Redis client which is only created on first
+    use, and re-created in every new process
+    """
+
+    def __init__(self, factory):
+        """
+        Constructor
+        """
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        return None
+
+    def get_client(self):
+        """
+        Get the client for the current process
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._client = self._factory()
+                    self._pid = pid
+        return self._client
+
+    def pool_stats(self):
+        """
+        Get connection pool counters for this process
+        """
+        pool = self.get_client().connection_pool
+        if not hasattr(pool, 'stats'):
+            return None
+        return pool.stats()
+
+    def __getattr__(self, name):
+        """
+        Proxy to the client
+        """
+        return getattr(self.get_client(), name)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""
+Read-replica routing for session reads.
+
+Sessions are read from replicas, and written to the primary.
+To read its own writes, a session is read from the primary
+for a short window after it is written. The window is tracked
+by a short-lived marker key, written to the primary in the
+same pipeline as the session and checked on the primary, and
+by a per-process record of recent writes. Sessions missing
+from a replica, e.g. right after login, are re-read from the
+primary.
+
+Replica lag is measured with a heartbeat key, written by a
+single elected process, and replicas lagging more than a
+limit are not read from.
+"""
+
+from __future__ import absolute_import
+
+import os
+import random
+import threading
+import time
+import uuid
+
+from redis.exceptions import RedisError
+
+from .lua import HEARTBEAT_SCRIPT
+from .metrics import NULL_METRICS
+from .redis_client import LazyRedis, create_redis
+
+HEARTBEAT_KEY = 'easyauth:heartbeat'
+HEARTBEAT_WRITER_KEY = 'easyauth:heartbeat-writer'
+
+
+class ReplicaRouter(object):
+    """
+    Picks where session reads go, and keeps count
+    """
+
+    primary = None
+    replicas = None
+    window = None
+    max_lag = None
+    interval = None
+    metrics = NULL_METRICS
+
+    def __init__(self, primary, replicas, window=5, max_lag=1.0,
+                 interval=1.0, max_recent=10000):
+        """
+        Constructor.
+        `replicas` maps replica names to clients.
+        """
+        self.primary = primary
+        self.replicas = dict(replicas)
+        self.window = window
+        self.max_lag = max_lag
+        self.interval = interval
+        self.max_recent = max_recent
+        self._recent = {}
+        self._lags = {}
+        self._counts = {
+            'replica_reads': 0,
+            'primary_reads': 0,
+            'fallbacks': {}
+        }
+        self._lock = threading.Lock()
+        self._pid = None
+        self._writer_id = uuid.uuid4().hex
+        return None
+
+    def marker_key(self, session_key):
+        """
+        Get the key marking a session as recently written
+        """
+        return session_key + ':rw'
+
+    def queue_mark_written(self, pipe, sid, session_key):
+        """
+        Queue the marker which makes a session be read from
+        the primary for a while, after writing or deleting it
+        """
+        deadline = time.time() + self.window
+        with self._lock:
+            if len(self._recent) >= self.max_recent:
+                now = time.time()
+                for key, until in list(self._recent.items()):
+                    if until <= now:
+                        del self._recent[key]
+                if len(self._recent) >= self.max_recent:
+                    self._recent.clear()
+            self._recent[sid] = deadline
+        pipe.set(self.marker_key(session_key), 1, ex=int(self.window))
+        return pipe
+
+    def recently_written(self, session_key):
+        """
+        Whether any process wrote a session within the window.
+        Checked on the primary, since a lagging replica is
+        missing the marker as well as the write.
+        """
+        return bool(self.primary.exists(self.marker_key(session_key)))
+
+    def get_replica(self, sid):
+        """
+        Get a replica to read a session from, or None
+        when it must be read from the primary
+        """
+        self.ensure_monitoring()
+        until = self._recent.get(sid)
+        if (until is not None) and (until > time.time()):
+            self.record_fallback('recent_write')
+            return None
+        names = [
+            name for name in self.replicas
+            if self._lags.get(name, 0.0) <= self.max_lag
+        ]
+        if not names:
+            self.record_fallback('lag')
+            return None
+        return self.replicas[random.choice(names)]
+
+    def record_replica_read(self):
+        """
+        Count a read served by a replica
+        """
+        with self._lock:
+            self._counts['replica_reads'] += 1
+        self.metrics.incr('session_replica_reads_total')
+        return None
+
+    def record_fallback(self, reason):
+        """
+        Count a read sent to the primary
+        """
+        with self._lock:
+            self._counts['primary_reads'] += 1
+            fallbacks = self._counts['fallbacks']
+            fallbacks[reason] = fallbacks.get(reason, 0) + 1
+        self.metrics.incr('session_replica_fallback_total', reason=reason)
+        return None
+
+    def ensure_monitoring(self):
+        """
+        Start the lag monitor thread for this process
+        if it is not running yet
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return False
+        with self._lock:
+            if self._pid == pid:
+                return False
+            ## Forked processes are elected on their own
+            self._writer_id = uuid.uuid4().hex
+            thread = threading.Thread(target=self._monitor)
+            thread.daemon = True
+            thread.start()
+            self._pid = pid
+        return True
+
+    def beat(self):
+        """
+        Write a heartbeat, when this process is the elected
+        heartbeat writer. Returns the current heartbeat of
+        the primary, or None when there is none yet.
+        """
+        val = \
+            HEARTBEAT_SCRIPT(
+                self.primary,
+                [HEARTBEAT_KEY, HEARTBEAT_WRITER_KEY],
+                [
+                    self._writer_id,
+                    int(self.interval * 3000),
+                    repr(time.time())
+                ])
+        if val is None:
+            return None
+        return float(val)
+
+    def measure_lag(self):
+        """
+        Measure the lag of every replica against the heartbeat
+        of the primary. Replicas which have it have no lag, to
+        the resolution of the heartbeat interval. Heartbeats
+        are only compared with each other, so the clocks of
+        processes do not need to agree.
+        """
+        last_beat = self.beat()
+        for name, client in self.replicas.items():
+            try:
+                val = client.get(HEARTBEAT_KEY)
+            except RedisError:
+                self._lags[name] = float('inf')
+                continue
+            seen = float(val) if val is not None else 0.0
+            if (last_beat is None) or (seen >= last_beat):
+                lag = 0.0
+            else:
+                lag = last_beat - seen - self.interval
+            self._lags[name] = max(0.0, lag)
+            self.metrics.observe(
+                'session_replica_lag_seconds', self._lags[name],
+                replica=name)
+        return last_beat
+
+    def _monitor(self):
+        """
+        Lag monitor loop
+        """
+        while True:
+            try:
+                self.measure_lag()
+            # pylint: disable=broad-except
+            except Exception:
+                pass
+            # pylint: enable=broad-except
+            time.sleep(self.interval)
+
+    def stats(self):
+        """
+        Get read counts and replica lag
+        """
+        with self._lock:
+            return {
+                'replica_reads': self._counts['replica_reads'],
+                'primary_reads': self._counts['primary_reads'],
+                'fallbacks': dict(self._counts['fallbacks']),
+                'lag': dict(self._lags)
+            }
+
+
+def _replica_factory(config, url):
+    """
+    Get a factory for the client of one replica
+    """
+    replica_config = dict(config)
+    replica_config['SESSION_REDIS_URL'] = url
+    return lambda: create_redis(replica_config)
+
+
+def _sentinel_factory(sentinels, service, socket_timeout):
+    """
+    Get a factory for a client reading from the
+    replicas Sentinel knows of
+    """
+
+    def factory():
+        """
+        Factory
+        """
+        from redis.sentinel import Sentinel
+        sentinel = Sentinel(sentinels, socket_timeout=socket_timeout)
+        return sentinel.slave_for(service, socket_timeout=socket_timeout)
+
+    return factory
+
+
+def create_replica_router(config, primary):
+    """
+    Create the replica router from app config, or None
+    when neither SESSION_REDIS_REPLICA_URLS nor
+    SESSION_REDIS_SENTINELS is configured
+    """
+    replicas = {}
+    for url in config.get('SESSION_REDIS_REPLICA_URLS', None) or []:
+        replicas[url] = LazyRedis(_replica_factory(config, url))
+    sentinels = config.get('SESSION_REDIS_SENTINELS', None)
+    if sentinels:
+        service = config.get('SESSION_REDIS_SENTINEL_SERVICE', 'mymaster')
+        replicas['sentinel:' + service] = \
+            LazyRedis(
+                _sentinel_factory(
+                    sentinels,
+                    service,
+                    config.get('SESSION_REDIS_SOCKET_TIMEOUT', None)))
+    if not replicas:
+        return None
+    return \
+        ReplicaRouter(
+            primary,
+            replicas,
+            window=config.get('SESSION_REDIS_READ_YOUR_WRITES_WINDOW', 5),
+            max_lag=config.get('SESSION_REDIS_MAX_REPLICA_LAG', 1.0))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+Session serializers.
+
+Every payload written by `SessionSerializer` starts with a
+small header:
+
+    byte 0: MAGIC
+    byte 1: format id
+    byte 2: flags (see FLAG_* constants)
+
+Payloads without the header are assumed to be
+legacy pickle sessions, so they can still be read
+during a rollout. Once it is over, they should be
+rejected, as unpickling runs arbitrary code.
+"""
+
+from __future__ import absolute_import
+
+import pickle
+import struct
+import zlib
+
+from flask.sessions import session_json_serializer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = 0xEA
+HEADER = struct.Struct('BBB')
+FLAG_ZLIB = 0x01
+
+
+class LegacyPayloadRejected(Exception):
+    """
+    Raised when a headerless, legacy pickle payload
+    is read with legacy pickle disabled
+    """
+    pass
+
+
+class PickleFormat(object):
+    """
+    Pickle format.
+    Only kept so legacy sessions can be decoded and
+    re-encoded, it is not recommended for new payloads.
+    """
+
+    def dumps(self, data):
+        """
+        Dump
+        """
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, val):
+        """
+        Load
+        """
+        return pickle.loads(val)
+
+
+class JSONFormat(object):
+    """
+    Tagged JSON format, as used by Flask cookie sessions
+    """
+
+    def dumps(self, data):
+        """
+        Dump
+        """
+        return session_json_serializer.dumps(data).encode('utf-8')
+
+    def loads(self, val):
+        """
+        Load
+        """
+        return session_json_serializer.loads(val.decode('utf-8'))
+
+
+class MsgpackFormat(object):
+    """
+    Msgpack format.
+    Requires the `msgpack` package.
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        if msgpack is None:
+            raise Exception("The msgpack format requires msgpack")
+        return None
+
+    def dumps(self, data):
+        """
+        Dump
+        """
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, val):
+        """
+        Load
+        """
+        return msgpack.unpackb(val, raw=False)
+
+
+## Format name -> (format id, format class)
+FORMATS = {
+    'pickle': (0, PickleFormat),
+    'json': (1, JSONFormat),
+    'msgpack': (2, MsgpackFormat)
+}
+
+
+def register_format(name, fmt_id, fmt_cls):
+    """
+    Register a custom session format.
+    `fmt_cls` must provide `dumps` and `loads`.
+    """
+    for other_id, _ in FORMATS.values():
+        if other_id == fmt_id:
+            raise Exception("Format id already registered")
+    FORMATS[name] = (fmt_id, fmt_cls)
+    return True
+
+
+class SessionSerializer(object):
+    """
+    Versioned session serializer with optional compression
+    """
+
+    fmt_id = None
+    fmt = None
+    compress_threshold = None
+    legacy_pickle = True
+
+    def __init__(self, fmt='json', compress_threshold=None,
+                 legacy_pickle=True):
+        """
+        Constructor.
+        Unless `legacy_pickle` is set, headerless payloads
+        raise `LegacyPayloadRejected` instead of being unpickled.
+        """
+        if fmt not in FORMATS:
+            raise Exception("Invalid session serializer")
+        self.fmt_id, fmt_cls = FORMATS[fmt]
+        self.fmt = fmt_cls()
+        self.compress_threshold = compress_threshold
+        self.legacy_pickle = legacy_pickle
+        self._decoders = {}
+        return None
+
+    def _get_decoder(self, fmt_id):
+        """
+        Get a format instance by format id
+        """
+        if fmt_id == self.fmt_id:
+            return self.fmt
+        if fmt_id not in self._decoders:
+            for other_id, fmt_cls in FORMATS.values():
+                if other_id == fmt_id:
+                    self._decoders[fmt_id] = fmt_cls()
+                    break
+            else:
+                raise Exception("Unknown session format")
+        return self._decoders[fmt_id]
+
+    def dumps(self, data):
+        """
+        Serialize session data
+        """
+        body = self.fmt.dumps(data)
+        flags = 0
+        if (
+                (self.compress_threshold is not None) and
+                (len(body) >= self.compress_threshold)
+        ):
+            body = zlib.compress(body)
+            flags |= FLAG_ZLIB
+        return HEADER.pack(MAGIC, self.fmt_id, flags) + body
+
+    def loads(self, val):
+        """
+        Deserialize session data
+        """
+        if (
+                (len(val) < HEADER.size) or
+                (bytearray(val[:1])[0] != MAGIC)
+        ):
+            ## Legacy, headerless pickle
+            if not self.legacy_pickle:
+                raise LegacyPayloadRejected("Headerless session payload")
+            return pickle.loads(val)
+        _, fmt_id, flags = HEADER.unpack(val[:HEADER.size])
+        body = val[HEADER.size:]
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+        return self._get_decoder(fmt_id).loads(body)
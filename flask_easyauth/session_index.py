@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Per-user index of tokens.
+
+Sessions are keyed by token, so indexing the tokens of each
+user is enough to find all of a user's sessions and tokens.
+"""
+
+from __future__ import absolute_import
+
+from datetime import timedelta
+
+UNLINK_BATCH_SIZE = 1000
+
+
+def chunks(seq, size):
+    """
+    Split a sequence into lists of at most `size` items
+    """
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:(i + size)]
+
+
+def unlink_keys(redis, keys, batch_size=UNLINK_BATCH_SIZE):
+    """
+    Delete keys in pipelined batches.
+    UNLINK is used when the client supports it, so that
+    large deletes are reclaimed in the background.
+    """
+    keys = list(keys)
+    if not keys:
+        return 0
+    pipe = redis.pipeline(transaction=False)
+    unlink = getattr(pipe, 'unlink', None) or pipe.delete
+    for batch in chunks(keys, batch_size):
+        unlink(*batch)
+    return sum(pipe.execute())
+
+
+class SessionIndex(object):
+    """
+    A Redis set of tokens per user
+    """
+
+    redis = None
+    prefix = None
+    ttl = None
+
+    def __init__(self, redis, prefix='user-tokens:', ttl=timedelta(days=30)):
+        """
+        Constructor
+        """
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+        return None
+
+    def get_key(self, user_id):
+        """
+        Get the index key of a user
+        """
+        return self.prefix + str(user_id)
+
+    def add(self, user_id, token):
+        """
+        Index a token.
+        The index expires once no token has been added for
+        a full token lifetime.
+        """
+        key = self.get_key(user_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd(key, token)
+        pipe.expire(key, int(self.ttl.total_seconds()))
+        pipe.execute()
+        return True
+
+    def remove(self, user_id, token):
+        """
+        Remove a token from the index
+        """
+        self.redis.srem(self.get_key(user_id), token)
+        return True
+
+    def pop_tokens(self, user_ids):
+        """
+        Get and clear the indexed tokens of several users,
+        in one round trip
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        for user_id in user_ids:
+            pipe.smembers(self.get_key(user_id))
+        for user_id in user_ids:
+            pipe.delete(self.get_key(user_id))
+        results = pipe.execute()[:len(user_ids)]
+        tokens = set()
+        for members in results:
+            for token in members:
+                if isinstance(token, bytes):
+                    token = token.decode('utf-8')
+                tokens.add(token)
+        return tokens
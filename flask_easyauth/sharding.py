@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""
+Session storage across several Redis nodes.
+
+Keys are routed with consistent hashing over virtual nodes, so
+adding a node only moves a small fraction of sessions. As in
+Redis Cluster, a key containing a `{hash tag}` is routed by the
+tag alone, so a session and its token land on the same node and
+can be fetched in one pipeline.
+
+A Redis Cluster can be used instead, through redis-py's
+`RedisCluster` client, relying on the same hash tags.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+from bisect import bisect
+from functools import partial
+
+from .redis_client import (
+    InstrumentedConnectionPool,
+    LazyRedis,
+    create_redis,
+    get_redis_options
+)
+
+DEFAULT_VNODES = 160
+
+
+def hash_tag(key):
+    """
+    Get the part of a key used for routing: its hash tag,
+    when it has one, or else the whole key
+    """
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > (start + 1):
+            return key[(start + 1):end]
+    return key
+
+
+def _hash(value):
+    """
+    Hash a string onto the ring
+    """
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    A consistent hash ring with virtual nodes
+    """
+
+    nodes = None
+    vnodes = None
+
+    def __init__(self, nodes, vnodes=DEFAULT_VNODES):
+        """
+        Constructor
+        """
+        self.nodes = list(nodes)
+        self.vnodes = vnodes
+        points = []
+        for node in self.nodes:
+            for i in range(vnodes):
+                points.append((_hash('%s#%d' % (node, i)), node))
+        points.sort()
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+        return None
+
+    def get_node(self, key):
+        """
+        Get the node a key routes to
+        """
+        index = bisect(self._hashes, _hash(hash_tag(key)))
+        if index == len(self._hashes):
+            index = 0
+        return self._nodes[index]
+
+
+class ShardedPipeline(object):
+    """
+    A non-transactional pipeline across nodes.
+    Commands are grouped into one pipeline per node,
+    and results are returned in the order queued.
+    """
+
+    def __init__(self, sharded):
+        """
+        Constructor
+        """
+        self.sharded = sharded
+        self.commands = []
+        return None
+
+    def __getattr__(self, name):
+        """
+        Queue a command
+        """
+
+        def queue(*args, **kwargs):
+            """
+            Queue wrapper
+            """
+            self.commands.append(
+                self.sharded.split_command(name, args, kwargs))
+            return self
+
+        return queue
+
+    def execute(self):
+        """
+        Run the queued commands
+        """
+        commands = self.commands
+        self.commands = []
+        pipes = {}
+        queued = {}
+        positions = []
+        for parts in commands:
+            slots = []
+            for node, name, args, kwargs in parts:
+                if node not in pipes:
+                    pipes[node] = \
+                        self.sharded.clients[node].pipeline(transaction=False)
+                    queued[node] = 0
+                getattr(pipes[node], name)(*args, **kwargs)
+                slots.append((node, queued[node]))
+                queued[node] += 1
+            positions.append(slots)
+        results = {}
+        for node, pipe in pipes.items():
+            results[node] = pipe.execute()
+        output = []
+        for slots in positions:
+            values = [results[node][index] for node, index in slots]
+            ## Commands split across nodes return counts
+            output.append(values[0] if len(values) == 1 else sum(values))
+        return output
+
+
+class ShardedRedis(object):
+    """
+    Routes commands to Redis nodes by key.
+    Supports the commands used for sessions and tokens.
+    """
+
+    ring = None
+    clients = None
+
+    ## Commands whose keys are all of their positional arguments
+    MULTI_KEY_COMMANDS = ('delete', 'unlink', 'exists')
+    ## Commands whose keys follow a key count
+    SCRIPT_COMMANDS = ('eval', 'evalsha')
+
+    def __init__(self, clients, vnodes=DEFAULT_VNODES):
+        """
+        Constructor.
+        `clients` maps node names to Redis clients.
+        """
+        self.clients = dict(clients)
+        self.ring = HashRing(sorted(self.clients), vnodes)
+        return None
+
+    def get_client(self, key):
+        """
+        Get the client a key routes to
+        """
+        return self.clients[self.ring.get_node(key)]
+
+    def split_command(self, name, args, kwargs):
+        """
+        Split a command into its parts per node.
+        Returns a list of (node, name, args, kwargs).
+        """
+        if name in self.SCRIPT_COMMANDS:
+            keys = args[2:(2 + args[1])]
+            nodes = set(self.ring.get_node(key) for key in keys)
+            if len(nodes) > 1:
+                raise Exception("Script keys span several nodes")
+            return [(nodes.pop(), name, args, kwargs)]
+        if name in self.MULTI_KEY_COMMANDS:
+            by_node = {}
+            for key in args:
+                by_node.setdefault(self.ring.get_node(key), []).append(key)
+            return [
+                (node, name, tuple(keys), kwargs)
+                for node, keys in sorted(by_node.items())
+            ]
+        return [(self.ring.get_node(args[0]), name, args, kwargs)]
+
+    def pipeline(self, transaction=False):
+        """
+        Get a pipeline.
+        Transactions are not supported across nodes.
+        """
+        if transaction:
+            raise Exception("Transactions are not supported when sharded")
+        return ShardedPipeline(self)
+
+    def scan_iter(self, *args, **kwargs):
+        """
+        Iterate over matching keys, on every node
+        """
+        for node in sorted(self.clients):
+            for key in self.clients[node].scan_iter(*args, **kwargs):
+                yield key
+
+    def pool_stats(self):
+        """
+        Get connection pool counters for each node
+        """
+        return dict(
+            (node, getattr(client, 'pool_stats', lambda: None)())
+            for node, client in self.clients.items()
+        )
+
+    def __getattr__(self, name):
+        """
+        Route a command by its keys
+        """
+
+        def command(*args, **kwargs):
+            """
+            Command wrapper
+            """
+            parts = self.split_command(name, args, kwargs)
+            values = [
+                getattr(self.clients[node], cmd)(*cmd_args, **cmd_kwargs)
+                for node, cmd, cmd_args, cmd_kwargs in parts
+            ]
+            return values[0] if len(values) == 1 else sum(values)
+
+        return command
+
+
+def create_cluster_redis(url, config=None, prefix='SESSION_REDIS_'):
+    """
+    Create a Redis Cluster client (redis-py 4.1+).
+    Every node gets a connection pool with the pool size,
+    timeouts and password of the SESSION_REDIS_* options.
+    The URL password takes precedence.
+    """
+    try:
+        from redis.cluster import RedisCluster
+    except ImportError:
+        raise Exception("Redis Cluster support requires redis-py 4.1+")
+    options = get_redis_options(config or {}, prefix)
+    return \
+        RedisCluster.from_url(
+            url,
+            connection_pool_class=partial(
+                InstrumentedConnectionPool, timeout=options['timeout']),
+            max_connections=options['max_connections'],
+            socket_timeout=options['socket_timeout'],
+            socket_connect_timeout=options['socket_connect_timeout'],
+            password=options['password'])
+
+
+def _node_factory(config, url):
+    """
+    Get a factory for the client of one node
+    """
+    node_config = dict(config)
+    node_config['SESSION_REDIS_URL'] = url
+    return lambda: create_redis(node_config)
+
+
+def create_session_redis(config, redis):
+    """
+    Create the client sessions are stored with.
+    Returns the client, and whether keys need hash tags.
+    Without SESSION_REDIS_CLUSTER_URL or SESSION_REDIS_NODES,
+    sessions are stored in `redis`.
+    """
+    cluster_url = config.get('SESSION_REDIS_CLUSTER_URL', None)
+    if cluster_url is not None:
+        return (
+            LazyRedis(lambda: create_cluster_redis(cluster_url, config)),
+            True
+        )
+    nodes = config.get('SESSION_REDIS_NODES', None)
+    if not nodes:
+        return (redis, False)
+    clients = {}
+    for url in nodes:
+        clients[url] = LazyRedis(_node_factory(config, url))
+    return (
+        ShardedRedis(
+            clients,
+            config.get('SESSION_REDIS_VNODES', DEFAULT_VNODES)),
+        True
+    )
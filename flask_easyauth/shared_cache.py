@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+
+"""
+Host-wide cache of token to user resolution, shared by every
+worker process on a machine through a memory-mapped file.
+
+The file holds a fixed number of slots, in buckets of four.
+Each slot maps the digest of a token, never the token itself, to
+a user id, user type and flags, with an expiry time and the
+generation it was written in. Clearing the cache bumps the
+generation in the file header, which invalidates every slot.
+
+Readers take no locks: each slot carries a sequence number,
+odd while a write is in progress, and a read which sees it
+change is treated as a miss. Writers lock the bucket they
+write, with `fcntl` record locks between processes and a
+thread lock within one. Hit, miss and eviction counters
+are kept per process, under their own lock, and start again
+from zero in a forked child.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import mmap
+import numbers
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = b'EZATOKC1'
+HEADER = struct.Struct('<8sIQ')
+HEADER_SIZE = 64
+## Sequence number, then the payload
+SEQ = struct.Struct('<I')
+PAYLOAD = struct.Struct('<Q16sdB64sB31sB')
+SLOT_SIZE = 136
+BUCKET_SLOTS = 4
+MAX_ID_SIZE = 64
+MAX_TYPE_SIZE = 31
+
+## Slot flags
+FLAG_ACTIVE = 1
+FLAG_REAL = 2
+FLAG_INT_ID = 4
+
+EMPTY = (0, b'\0' * 16, 0.0, 0, b'', 0, b'', 0)
+
+
+class SharedTokenCache(object):
+    """
+    A bounded cache of token to user identity, with
+    entries expiring after a TTL, shared between processes.
+    Stores and returns user snapshots, as `TokenCache` does,
+    keeping only their id, type, and active and real flags.
+    """
+
+    ## Shared with running workers, so not cleared on fork
+    clear_on_fork = False
+
+    path = None
+    slots = None
+    ttl = None
+    id_key = None
+    type_key = None
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, path, slots=65536, ttl=60, id_key='id',
+                 type_key='type'):
+        """
+        Constructor.
+        `id_key` and `type_key` name the user attributes
+        holding the primary key and polymorphic identity.
+        """
+        if fcntl is None:
+            raise Exception("The shared token cache requires fcntl")
+        self.path = path
+        self.slots = -(-slots // BUCKET_SLOTS) * BUCKET_SLOTS
+        self.ttl = ttl
+        self.id_key = id_key
+        self.type_key = type_key
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._fd, self._map = self._open()
+        return None
+
+    def _open(self):
+        """
+        Open the cache file, creating it when missing
+        """
+        fileno = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fileno, fcntl.LOCK_EX)
+            try:
+                cache_map = self._map_file(fileno)
+            finally:
+                fcntl.lockf(fileno, fcntl.LOCK_UN)
+        except Exception:
+            os.close(fileno)
+            raise
+        return (fileno, cache_map)
+
+    def _map_file(self, fileno):
+        """
+        Map the cache file, initializing it when empty.
+        The file lock must be held.
+        """
+        size = HEADER_SIZE + (self.slots * SLOT_SIZE)
+        current = os.fstat(fileno).st_size
+        if current == 0:
+            os.ftruncate(fileno, size)
+            cache_map = mmap.mmap(fileno, size)
+            HEADER.pack_into(cache_map, 0, MAGIC, self.slots, 1)
+            return cache_map
+        if current != size:
+            raise \
+                Exception(
+                    "Shared token cache %s has another size" % self.path)
+        cache_map = mmap.mmap(fileno, size)
+        magic, slots, _ = HEADER.unpack_from(cache_map, 0)
+        if (magic != MAGIC) or (slots != self.slots):
+            cache_map.close()
+            raise \
+                Exception(
+                    "Shared token cache %s has another layout" % self.path)
+        return cache_map
+
+    def _check_fork(self):
+        """
+        Reset the locks and counters in a forked child.
+        Locks copied from the parent may be held by one of
+        its threads, and its counters are not this process'.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return False
+        self._pid = pid
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        return True
+
+    def _count(self, name):
+        """
+        Increment a counter of this process
+        """
+        self._check_fork()
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+        return None
+
+    def _digest(self, token):
+        """
+        Digest of a token, as stored in the cache
+        """
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).digest()[:16]
+
+    def _generation(self):
+        """
+        Get the current generation
+        """
+        return HEADER.unpack_from(self._map, 0)[2]
+
+    def _bucket(self, digest):
+        """
+        Get the slot indexes of the bucket for a digest
+        """
+        start = \
+            (struct.unpack('<Q', digest[:8])[0] %
+             (self.slots // BUCKET_SLOTS)) * BUCKET_SLOTS
+        return range(start, start + BUCKET_SLOTS)
+
+    def _read(self, index):
+        """
+        Read a slot, or None when it is being written
+        """
+        offset = HEADER_SIZE + (index * SLOT_SIZE)
+        seq = SEQ.unpack_from(self._map, offset)[0]
+        if seq & 1:
+            return None
+        entry = PAYLOAD.unpack_from(self._map, offset + SEQ.size)
+        if SEQ.unpack_from(self._map, offset)[0] != seq:
+            return None
+        return entry
+
+    def _read_locked(self, index):
+        """
+        Read a slot. The bucket lock must be held.
+        """
+        offset = HEADER_SIZE + (index * SLOT_SIZE)
+        return PAYLOAD.unpack_from(self._map, offset + SEQ.size)
+
+    def _write(self, index, entry):
+        """
+        Write a slot. The bucket lock must be held.
+        """
+        offset = HEADER_SIZE + (index * SLOT_SIZE)
+        ## Odd while writing, even when done. A sequence number
+        ## left odd by a writer which died is recovered.
+        seq = SEQ.unpack_from(self._map, offset)[0] | 1
+        SEQ.pack_into(self._map, offset, seq)
+        PAYLOAD.pack_into(self._map, offset + SEQ.size, *entry)
+        SEQ.pack_into(self._map, offset, (seq + 1) & 0xffffffff)
+        return True
+
+    def _locked(self, start, length, func):
+        """
+        Run `func` holding the lock on a byte range
+        """
+        self._check_fork()
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                return func()
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+    def _lock_bucket(self, bucket, func):
+        """
+        Run `func` holding the lock on a bucket
+        """
+        return \
+            self._locked(
+                HEADER_SIZE + (bucket[0] * SLOT_SIZE),
+                BUCKET_SLOTS * SLOT_SIZE,
+                func)
+
+    def encode(self, snapshot):
+        """
+        Get the slot fields of a user snapshot,
+        or None when it does not fit a slot
+        """
+        values = snapshot['values']
+        user_id = values.get(self.id_key)
+        if user_id is None:
+            return None
+        flags = 0
+        if isinstance(user_id, numbers.Integral):
+            flags |= FLAG_INT_ID
+        user_id = str(user_id).encode('utf-8')
+        user_type = values.get(self.type_key, snapshot['identity'])
+        user_type = (user_type or '').encode('utf-8')
+        if (len(user_id) > MAX_ID_SIZE) or (len(user_type) > MAX_TYPE_SIZE):
+            return None
+        if values.get('active', False):
+            flags |= FLAG_ACTIVE
+        if values.get('real', False):
+            flags |= FLAG_REAL
+        return (user_id, user_type, flags)
+
+    def decode(self, user_id, user_type, flags):
+        """
+        Rebuild a user snapshot from slot fields
+        """
+        user_id = user_id.decode('utf-8')
+        if flags & FLAG_INT_ID:
+            user_id = int(user_id)
+        user_type = user_type.decode('utf-8') or None
+        values = {
+            self.id_key: user_id,
+            'active': bool(flags & FLAG_ACTIVE),
+            'real': bool(flags & FLAG_REAL)
+        }
+        if user_type is not None:
+            values[self.type_key] = user_type
+        return {
+            'identity': user_type,
+            'values': values
+        }
+
+    def get(self, token):
+        """
+        Get a cached snapshot, or None
+        """
+        digest = self._digest(token)
+        generation = self._generation()
+        now = time.time()
+        for index in self._bucket(digest):
+            entry = self._read(index)
+            if (
+                    (entry is not None) and
+                    (entry[1] == digest) and
+                    (entry[0] == generation) and
+                    (entry[2] > now)
+            ):
+                self._count('hits')
+                return \
+                    self.decode(
+                        entry[4][:entry[3]],
+                        entry[6][:entry[5]],
+                        entry[7])
+        self._count('misses')
+        return None
+
+    def set(self, token, snapshot):
+        """
+        Cache a snapshot
+        """
+        fields = self.encode(snapshot)
+        if fields is None:
+            return False
+        user_id, user_type, flags = fields
+        digest = self._digest(token)
+        bucket = self._bucket(digest)
+
+        def write():
+            """
+            Pick a slot in the bucket and write it
+            """
+            generation = self._generation()
+            now = time.time()
+            target = None
+            ## Evict the first slot when all expire at once
+            oldest = (bucket[0], float('inf'))
+            for index in bucket:
+                entry = self._read_locked(index)
+                if entry[1] == digest:
+                    target = index
+                    break
+                if (entry[0] != generation) or (entry[2] <= now):
+                    if target is None:
+                        target = index
+                elif entry[2] < oldest[1]:
+                    oldest = (index, entry[2])
+            if target is None:
+                target = oldest[0]
+                self._count('evictions')
+            return self._write(target, (
+                generation,
+                digest,
+                now + self.ttl,
+                len(user_id),
+                user_id,
+                len(user_type),
+                user_type,
+                flags
+            ))
+
+        return self._lock_bucket(bucket, write)
+
+    def delete(self, token):
+        """
+        Remove a token from the cache
+        """
+        digest = self._digest(token)
+        bucket = self._bucket(digest)
+
+        def remove():
+            """
+            Empty the slot of the token
+            """
+            for index in bucket:
+                if self._read_locked(index)[1] == digest:
+                    self._write(index, EMPTY)
+            return True
+
+        return self._lock_bucket(bucket, remove)
+
+    def clear(self):
+        """
+        Empty the cache, for every process
+        """
+
+        def bump():
+            """
+            Move to the next generation
+            """
+            HEADER.pack_into(
+                self._map, 0, MAGIC, self.slots, self._generation() + 1)
+            return True
+
+        return self._locked(0, HEADER_SIZE, bump)
+
+    def stats(self):
+        """
+        Get cache counters.
+        The counters are those of this process,
+        the size is that of the whole cache.
+        """
+        generation = self._generation()
+        now = time.time()
+        size = 0
+        for index in range(self.slots):
+            entry = self._read(index)
+            if (
+                    (entry is not None) and
+                    (entry[0] == generation) and
+                    (entry[2] > now)
+            ):
+                size += 1
+        self._check_fork()
+        with self._stats_lock:
+            return {
+                'size': size,
+                'max_size': self.slots,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Stateless, HMAC signed tokens.
+
+A token has the form:
+
+    <key id>.<payload>.<signature>
+
+where the payload is base64 encoded JSON holding the user id,
+user type, active and real flags, issue time, expiry and a
+unique token id, and the
+signature is an HMAC-SHA256 over `<key id>.<payload>`. Keys are
+looked up by key id, so new keys can be rolled out while tokens
+signed with older keys remain valid.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+
+def _b64encode(val):
+    """
+    Unpadded URL safe base64 encode
+    """
+    return base64.urlsafe_b64encode(val).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(val):
+    """
+    Unpadded URL safe base64 decode
+    """
+    val = val.encode('ascii')
+    return base64.urlsafe_b64decode(val + (b'=' * (-len(val) % 4)))
+
+
+class TokenSigner(object):
+    """
+    Signs and verifies tokens
+    """
+
+    keys = None
+    key_id = None
+    ttl = None
+    leeway = None
+
+    def __init__(self, keys, key_id, ttl, leeway=30):
+        """
+        Constructor.
+        `keys` maps key ids to secrets, and `key_id` selects
+        the key used to sign new tokens.
+        """
+        if key_id not in keys:
+            raise Exception("Signing key id is not configured")
+        for kid in keys:
+            if '.' in kid:
+                raise Exception("Signing key ids may not contain '.'")
+        self.keys = keys
+        self.key_id = key_id
+        self.ttl = ttl
+        self.leeway = leeway
+        return None
+
+    def _sign(self, key_id, msg):
+        """
+        Sign a message with a key
+        """
+        secret = self.keys[key_id]
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf-8')
+        return hmac.new(secret, msg.encode('ascii'), hashlib.sha256).digest()
+
+    def sign(self, user_id, user_type, active=True, real=True):
+        """
+        Create a signed token
+        """
+        now = int(time.time())
+        claims = {
+            'u': user_id,
+            't': user_type,
+            'a': bool(active),
+            'r': bool(real),
+            'iat': now,
+            'exp': now + int(self.ttl.total_seconds()),
+            'jti': uuid.uuid4().hex[:16]
+        }
+        payload = \
+            _b64encode(
+                json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        msg = '.'.join([self.key_id, payload])
+        return '.'.join([msg, _b64encode(self._sign(self.key_id, msg))])
+
+    def verify(self, token):
+        """
+        Verify a token.
+        Returns its claims, or None when it is malformed,
+        wrongly signed, or outside its lifetime.
+        """
+        parts = token.split('.')
+        if len(parts) != 3:
+            return None
+        key_id, payload, sig = parts
+        if key_id not in self.keys:
+            return None
+        try:
+            sig = _b64decode(sig)
+            expected = self._sign(key_id, '.'.join([key_id, payload]))
+            if not hmac.compare_digest(sig, expected):
+                return None
+            claims = json.loads(_b64decode(payload).decode('utf-8'))
+        except (ValueError, TypeError, UnicodeError):
+            return None
+        now = time.time()
+        if (
+                (claims['exp'] <= now) or
+                (claims['iat'] > (now + self.leeway))
+        ):
+            return None
+        return claims
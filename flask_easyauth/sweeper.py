@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""
+Deletes expired tokens from the token table.
+
+Tokens are deleted in bounded batches, with a pause between
+batches, so that cleanup never holds long locks or causes
+replication lag. Run it from a background thread with
+`TokenSweeper.start`, or from the command line:
+
+    python -m flask_easyauth.sweeper myapp:app
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import importlib
+import sys
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import inspect
+
+
+class TokenSweeper(object):
+    """
+    Sweeps expired tokens in batches
+    """
+
+    app = None
+    db = None
+    token_cls = None
+    batch_size = None
+    pause = None
+
+    def __init__(self, app, db, token_cls, batch_size=1000, pause=0.5):
+        """
+        Constructor
+        """
+        if not hasattr(token_cls, 'expires'):
+            raise Exception("Token model has no `expires` column")
+        self.app = app
+        self.db = db
+        self.token_cls = token_cls
+        self.batch_size = batch_size
+        self.pause = pause
+        return None
+
+    def sweep_batch(self, now=None):
+        """
+        Delete one batch of expired tokens.
+        Returns the number of tokens deleted.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        pkey = inspect(self.token_cls).primary_key[0]
+        ids = [
+            row[0] for row in
+            self.db.session.query(pkey)
+            .filter(self.token_cls.expires <= now)
+            .order_by(self.token_cls.expires)
+            .limit(self.batch_size)
+            .all()
+        ]
+        if not ids:
+            self.db.session.rollback()
+            return 0
+        (
+            self.db.session.query(self.token_cls)
+            .filter(pkey.in_(ids))
+            .delete(synchronize_session=False)
+        )
+        self.db.session.commit()
+        return len(ids)
+
+    def sweep(self, max_batches=None):
+        """
+        Delete expired tokens, batch by batch, until none are
+        left. Returns the number of tokens deleted.
+        """
+        now = datetime.utcnow()
+        total = 0
+        batches = 0
+        while (max_batches is None) or (batches < max_batches):
+            deleted = self.sweep_batch(now)
+            total += deleted
+            batches += 1
+            if deleted < self.batch_size:
+                break
+            time.sleep(self.pause)
+        return total
+
+    def start(self, interval=3600):
+        """
+        Sweep every `interval` seconds from a daemon thread
+        """
+
+        def run():
+            """
+            Sweeper loop
+            """
+            while True:
+                try:
+                    with self.app.app_context():
+                        self.sweep()
+                # pylint: disable=broad-except
+                except Exception:
+                    self.app.logger.exception("Token sweep failed")
+                # pylint: enable=broad-except
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def create_sweeper(app, batch_size=1000, pause=0.5):
+    """
+    Create a sweeper for an app using easyauth
+    """
+    auth = app.extensions['easyauth']
+    return TokenSweeper(app, auth.db, auth.token_cls, batch_size, pause)
+
+
+def load_app(app_path):
+    """
+    Import an app from a `module:attribute` path
+    """
+    module_name, _, attr = app_path.partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, attr or 'app')
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Sweep expired tokens")
+    parser.add_argument('app', help="Flask app, as module:attribute")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--pause', type=float, default=0.5)
+    parser.add_argument(
+        '--max-batches', type=int, default=None,
+        help="Stop after this many batches")
+    args = parser.parse_args(argv)
+    app = load_app(args.app)
+    sweeper = create_sweeper(app, args.batch_size, args.pause)
+    with app.app_context():
+        deleted = sweeper.sweep(args.max_batches)
+    print("Deleted %d expired tokens" % deleted)
+    return True
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
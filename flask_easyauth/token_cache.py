@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+Per-process cache of token to user resolution
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+TOKEN_CACHE_CHANNEL = "easyauth:token-invalidate"
+
+
+class TokenCache(object):
+    """
+    A bounded LRU cache whose entries also expire after a TTL.
+    Safe to share between threads.
+    """
+
+    ## Entries copied into a forked child may be stale
+    clear_on_fork = True
+
+    max_size = None
+    ttl = None
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, max_size=1024, ttl=60):
+        """
+        Constructor
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        return None
+
+    def get(self, token):
+        """
+        Get a cached value, or None
+        """
+        with self._lock:
+            entry = self._data.pop(token, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                self.misses += 1
+                self.evictions += 1
+                return None
+            ## Re-insert as most recently used
+            self._data[token] = entry
+            self.hits += 1
+            return value
+
+    def set(self, token, value):
+        """
+        Cache a value
+        """
+        with self._lock:
+            self._data.pop(token, None)
+            self._data[token] = (time.time() + self.ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def delete(self, token):
+        """
+        Remove a token from the cache
+        """
+        with self._lock:
+            self._data.pop(token, None)
+        return True
+
+    def clear(self):
+        """
+        Empty the cache
+        """
+        with self._lock:
+            self._data.clear()
+        return True
+
+    def stats(self):
+        """
+        Get cache counters
+        """
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class TokenCacheInvalidator(object):
+    """
+    Propagates token invalidations between workers over
+    Redis pub/sub. Missed messages are bounded by the
+    cache TTL.
+    """
+
+    cache = None
+    redis = None
+    channel = None
+
+    def __init__(self, cache, redis, channel=TOKEN_CACHE_CHANNEL):
+        """
+        Constructor
+        """
+        self.cache = cache
+        self.redis = redis
+        self.channel = channel
+        self._pid = None
+        self._lock = threading.Lock()
+        return None
+
+    def publish(self, token):
+        """
+        Evict a token locally and in every other worker
+        """
+        self.cache.delete(token)
+        self.redis.publish(self.channel, token)
+        return True
+
+    def publish_many(self, tokens):
+        """
+        Evict many tokens, pipelined
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for token in tokens:
+            self.cache.delete(token)
+            pipe.publish(self.channel, token)
+        pipe.execute()
+        return True
+
+    def ensure_listening(self):
+        """
+        Start the listener thread for this process if it is
+        not running yet. Forked workers each start their own.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return False
+        with self._lock:
+            if self._pid == pid:
+                return False
+            if self.cache.clear_on_fork:
+                self.cache.clear()
+            thread = threading.Thread(target=self._listen)
+            thread.daemon = True
+            thread.start()
+            self._pid = pid
+        return True
+
+    def _listen(self):
+        """
+        Listener loop
+        """
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    token = message['data']
+                    if isinstance(token, bytes):
+                        token = token.decode('utf-8')
+                    self.cache.delete(token)
+            # pylint: disable=broad-except
+            except Exception:
+                ## Connection lost; nothing was received in the
+                ## meantime, so drop everything and resubscribe
+                self.cache.clear()
+                time.sleep(1)
+            # pylint: enable=broad-except
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+"""
+Probabilistic filter of live tokens.
+
+A Bloom filter of every issued token is kept as a Redis bitmap,
+and mirrored in each process. A token which the filter does not
+contain can not exist, so it is rejected without a query.
+
+Bloom filters can not forget, so the filter is periodically rebuilt
+from the token store, which drops tokens that were logged out.
+Stores which can not list their tokens, e.g. signed tokens, can
+not be filtered.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import math
+import os
+import struct
+import threading
+import time
+
+BIT_MASKS = [0x80 >> i for i in range(8)]
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter, using the bit order of Redis bitmaps
+    """
+
+    size = None
+    num_hashes = None
+    bits = None
+
+    def __init__(self, size, num_hashes, bits=None):
+        """
+        Constructor
+        """
+        self.size = size
+        self.num_hashes = num_hashes
+        num_bytes = (size + 7) // 8
+        if bits is None:
+            bits = bytearray(num_bytes)
+        else:
+            bits = bytearray(bits)
+            bits.extend(bytearray(num_bytes - len(bits)))
+        self.bits = bits
+        return None
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        """
+        Create a filter sized for a capacity and error rate
+        """
+        size = \
+            int(math.ceil(
+                -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        num_hashes = max(1, int(round(size / float(capacity) * math.log(2))))
+        return cls(size, num_hashes)
+
+    def positions(self, token):
+        """
+        Get the bit positions for a token, by double hashing
+        """
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        digest = hashlib.sha256(token).digest()
+        hash1, hash2 = struct.unpack('>QQ', digest[:16])
+        return [
+            (hash1 + (i * hash2)) % self.size
+            for i in range(self.num_hashes)
+        ]
+
+    def add(self, token):
+        """
+        Add a token
+        """
+        for pos in self.positions(token):
+            self.bits[pos >> 3] |= BIT_MASKS[pos & 7]
+        return True
+
+    def __contains__(self, token):
+        """
+        Check for a token
+        """
+        for pos in self.positions(token):
+            if not self.bits[pos >> 3] & BIT_MASKS[pos & 7]:
+                return False
+        return True
+
+    def estimated_error_rate(self):
+        """
+        Estimate the false positive rate from how full the filter is
+        """
+        bits_set = sum(bin(byte).count('1') for byte in self.bits)
+        return (bits_set / float(self.size)) ** self.num_hashes
+
+
+class TokenFilter(object):
+    """
+    A Bloom filter of live tokens, kept in Redis
+    and mirrored in process
+    """
+
+    app = None
+    token_store = None
+    redis = None
+    key = None
+    built_key = None
+    refresh_interval = None
+    rebuild_interval = None
+
+    def __init__(self, app, token_store, redis):
+        """
+        Constructor
+        """
+        if not token_store.enumerable:
+            raise \
+                Exception(
+                    "AUTH_TOKEN_FILTER requires a token store "
+                    "which can list its tokens")
+        self.app = app
+        self.token_store = token_store
+        self.redis = redis
+        self.key = app.config.get('AUTH_TOKEN_FILTER_KEY', 'token-filter')
+        ## Set by `rebuild`. `add` creates the filter key itself,
+        ## so it existing does not mean it holds every token.
+        self.built_key = self.key + ':built'
+        self.refresh_interval = \
+            app.config.get('AUTH_TOKEN_FILTER_REFRESH', 60)
+        self.rebuild_interval = \
+            app.config.get('AUTH_TOKEN_FILTER_REBUILD', 3600)
+        template = \
+            BloomFilter.for_capacity(
+                app.config.get('AUTH_TOKEN_FILTER_CAPACITY', 1000000),
+                app.config.get('AUTH_TOKEN_FILTER_ERROR_RATE', 0.001))
+        self.size = template.size
+        self.num_hashes = template.num_hashes
+        self.mirror = template
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'checks': 0,
+            'rejected': 0,
+            'false_positives': 0
+        }
+        return None
+
+    def _count(self, name):
+        """
+        Increment a counter
+        """
+        with self._stats_lock:
+            self._stats[name] += 1
+        return None
+
+    def add(self, token):
+        """
+        Add a newly issued token.
+        Bits are also set on the filter being rebuilt, if any.
+        """
+        positions = self.mirror.positions(token)
+        pipe = self.redis.pipeline(transaction=False)
+        for pos in positions:
+            pipe.setbit(self.key, pos, 1)
+            pipe.setbit(self.key + ':next', pos, 1)
+        pipe.execute()
+        self.mirror.add(token)
+        return True
+
+    def might_contain(self, token):
+        """
+        Determines if a token might exist.
+        The local mirror is checked first. It may be missing
+        tokens issued by other workers since its last refresh,
+        so negatives are confirmed against Redis. Until the
+        filter has first been built, every token passes.
+        """
+        self.ensure_running()
+        self._count('checks')
+        if token in self.mirror:
+            return True
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.exists(self.built_key)
+        for pos in self.mirror.positions(token):
+            pipe.getbit(self.key, pos)
+        results = pipe.execute()
+        if (not results[0]) or all(results[1:]):
+            return True
+        self._count('rejected')
+        return False
+
+    def record_false_positive(self):
+        """
+        Record a token which passed the filter but did not exist
+        """
+        self._count('false_positives')
+        return True
+
+    def refresh(self):
+        """
+        Reload the local mirror from Redis
+        """
+        val = self.redis.get(self.key)
+        if val is None:
+            return False
+        self.mirror = BloomFilter(self.size, self.num_hashes, val)
+        return True
+
+    def rebuild(self, batch_size=10000):
+        """
+        Rebuild the filter from the token store.
+        Tokens issued during the rebuild are added to the
+        `:next` key by `add`, and merged in with BITOP OR.
+        """
+        next_key = self.key + ':next'
+        build_key = self.key + ':build'
+        self.redis.delete(next_key)
+        bloom = BloomFilter(self.size, self.num_hashes)
+        for token in self.token_store.iter_tokens(batch_size):
+            bloom.add(token)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(build_key, bytes(bloom.bits))
+        pipe.bitop('OR', next_key, next_key, build_key)
+        pipe.delete(build_key)
+        pipe.rename(next_key, self.key)
+        pipe.set(self.built_key, 1)
+        pipe.execute()
+        self.mirror = bloom
+        return True
+
+    def ensure_running(self):
+        """
+        Start the refresh thread for this process
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return False
+        with self._lock:
+            if self._pid == pid:
+                return False
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._pid = pid
+        return True
+
+    def _run(self):
+        """
+        Refresh the mirror, and rebuild the filter when no
+        other worker holds the rebuild lock
+        """
+        while True:
+            try:
+                lock = \
+                    self.redis.set(
+                        self.key + ':lock',
+                        os.getpid(),
+                        nx=True,
+                        ex=self.rebuild_interval)
+                if lock:
+                    with self.app.app_context():
+                        self.rebuild()
+                else:
+                    self.refresh()
+            # pylint: disable=broad-except
+            except Exception:
+                self.app.logger.exception("Could not refresh token filter")
+            # pylint: enable=broad-except
+            time.sleep(self.refresh_interval)
+
+    def stats(self):
+        """
+        Get filter counters.
+        `measured_error_rate` is the share of tokens which did
+        not exist but passed the filter anyway.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        absent = stats['false_positives'] + stats['rejected']
+        stats['measured_error_rate'] = \
+            (stats['false_positives'] / float(absent)) if absent else 0.0
+        stats['estimated_error_rate'] = self.mirror.estimated_error_rate()
+        stats['size'] = self.size
+        stats['num_hashes'] = self.num_hashes
+        return stats
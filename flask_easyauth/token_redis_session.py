@@ -11,25 +11,52 @@ Original Author: Armin Ronacher
 
 from __future__ import absolute_import
 
-import pickle
+import numbers
 import uuid
 from datetime import timedelta
 
-from redis import Redis
-
 from flask.sessions import SessionInterface, SessionMixin
+from redis.exceptions import RedisError
 from werkzeug.datastructures import CallbackDict
 
 from .constants import REQ_TOK_TYPES
+from .lua import AUTH_SCRIPT, HASH_AUTH_SCRIPT
+from .metrics import NULL_METRICS
+from .redis_client import LazyRedis, create_redis
+from .replicas import create_replica_router
+from .serializers import SessionSerializer, LegacyPayloadRejected
+from .session_index import UNLINK_BATCH_SIZE
+from .sharding import create_session_redis
+from .write_behind import PendingSessionWrite, create_session_writer
 from . import request_helpers
 
+DEFAULT_LIFETIME = timedelta(days=1)
+STORAGE_MODES = ('blob', 'hash')
+## Keys Flask-Login sets in sessions of anonymous users too
+LOGIN_BOOKKEEPING_KEYS = frozenset(['_id', '_fresh', 'remember'])
+## Values which can not be changed in place
+IMMUTABLE_TYPES = (type(None), numbers.Number, bytes, type(u''), frozenset)
+
+
+class SessionFieldTooLarge(Exception):
+    """
+    Raised when a session value is over the
+    per-field size limit of hash storage
+    """
+    pass
+
 
 class TokenRedisSession(CallbackDict, SessionMixin):
     """
     A Redis Session Class
     """
 
-    def __init__(self, initial=None, sid=None, new=False):
+    loaded = True
+    ## Set when the session must be written before the response,
+    ## even with write-behind enabled
+    write_through = False
+
+    def __init__(self, initial=None, sid=None, new=False, ttl=None):
         """
         Constructor
         """
@@ -38,41 +65,282 @@ class TokenRedisSession(CallbackDict, SessionMixin):
             """
             On Update Callback
             """
-            self.modified = True
+            # pylint: disable=protected-access
+            self._modified = True
             return None
 
         CallbackDict.__init__(self, initial, on_update)
         self.sid = sid
         self.new = new
-        self.modified = False
+        self.ttl = ttl
+        self._modified = False
+        ## Keys set and deleted since the session was loaded
+        self.changed = set()
+        self.deleted = set()
+        ## Set when changes can not be tracked per key
+        self.full_write = False
+        ## Raw Redis values fetched along with the session,
+        ## keyed by Redis key
+        self.prefetched = {}
+        return None
+
+    @property
+    def modified(self):
+        """
+        Whether the session has changed
+        """
+        return self._modified
+
+    @modified.setter
+    def modified(self, value):
+        """
+        Mark the session as changed.
+        Setting this directly, e.g. after mutating a nested
+        value, means every key is considered changed.
+        """
+        self._modified = value
+        self.full_write = bool(value)
         return None
 
+    def __setitem__(self, key, value):
+        """
+        Set an item.
+        Assignments which do not change the stored
+        value will not mark the session as modified.
+        Mutable values may have been changed in place,
+        so assigning them always does.
+        """
+        if key in self:
+            current = self[key]
+            if (
+                    isinstance(current, IMMUTABLE_TYPES) and
+                    (type(current) is type(value)) and
+                    (current == value)
+            ):
+                return None
+        self.changed.add(key)
+        CallbackDict.__setitem__(self, key, value)
+        return None
+
+    def __delitem__(self, key):
+        """
+        Delete an item
+        """
+        CallbackDict.__delitem__(self, key)
+        self.deleted.add(key)
+        return None
+
+    def pop(self, key, *default):
+        """
+        Remove an item and return its value
+        """
+        if key in self:
+            self.deleted.add(key)
+        return CallbackDict.pop(self, key, *default)
+
+    def popitem(self):
+        """
+        Remove and return an item
+        """
+        item = CallbackDict.popitem(self)
+        self.deleted.add(item[0])
+        return item
+
+    def setdefault(self, key, default=None):
+        """
+        Get an item, setting it if missing
+        """
+        if key not in self:
+            self.changed.add(key)
+        return CallbackDict.setdefault(self, key, default)
+
+    def clear(self):
+        """
+        Remove all items
+        """
+        self.deleted.update(self.keys())
+        CallbackDict.clear(self)
+        return None
+
+    def update(self, *args, **kwargs):
+        """
+        Update items, ignoring no-op assignments
+        """
+        for key, val in dict(*args, **kwargs).items():
+            self[key] = val
+        return None
+
+    def update_on_load(self, *args, **kwargs):
+        """
+        Update items once the session is loaded
+        """
+        return self.update(*args, **kwargs)
+
+
+class LazyTokenRedisSession(TokenRedisSession):
+    """
+    A Redis Session which is only fetched on first use.
+    Requests which never touch the session never hit Redis.
+    """
+
+    def __init__(self, sid, loader):
+        """
+        Constructor.
+        `loader` returns the loaded session.
+        """
+        self._prefetched = {}
+        TokenRedisSession.__init__(self, sid=sid)
+        self.loaded = False
+        self._loader = loader
+        self._on_load = {}
+        return None
+
+    def load(self):
+        """
+        Fetch the session contents, if not fetched yet
+        """
+        if self.loaded:
+            return False
+        loaded = self._loader()
+        self.loaded = True
+        self._loader = None
+        ## Bypass the update callback, loading is not a change
+        dict.update(self, loaded)
+        self.new = loaded.new
+        self.ttl = loaded.ttl
+        self._prefetched = loaded.prefetched
+        on_load, self._on_load = self._on_load, {}
+        self.update(on_load)
+        return True
+
+    def update_on_load(self, *args, **kwargs):
+        """
+        Update items once the session is loaded.
+        Does not load the session, so a session which is never
+        used is never fetched, even if the update would
+        have changed it.
+        """
+        if self.loaded:
+            return self.update(*args, **kwargs)
+        self._on_load.update(*args, **kwargs)
+        return None
+
+    @property
+    def prefetched(self):
+        """
+        Raw Redis values fetched along with the session
+        """
+        self.load()
+        return self._prefetched
+
+    @prefetched.setter
+    def prefetched(self, value):
+        """
+        Set prefetched values
+        """
+        self._prefetched = value
+        return None
+
+
+def _loading(name):
+    """
+    Wrap a dict method so it loads a lazy session first
+    """
+    method = getattr(TokenRedisSession, name)
+
+    def wrapper(self, *args, **kwargs):
+        """
+        Wrapper
+        """
+        self.load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _name in (
+        '__getitem__', '__setitem__', '__delitem__', '__contains__',
+        '__iter__', '__len__', '__eq__', '__ne__', '__repr__',
+        'get', 'keys', 'values', 'items', 'copy', 'setdefault',
+        'pop', 'popitem', 'clear', 'update', 'has_key',
+        'iterkeys', 'itervalues', 'iteritems',
+        'viewkeys', 'viewvalues', 'viewitems'
+):
+    if hasattr(TokenRedisSession, _name):
+        setattr(LazyTokenRedisSession, _name, _loading(_name))
+
 
 class TokenRedisSessionInterface(SessionInterface):
     """
     A Redis Session Interface
     """
-    serializer = pickle
+    serializer = None
     session_class = TokenRedisSession
+    lazy_session_class = LazyTokenRedisSession
+    lazy = True
     req_tok_type = None
+    token_prefix = None
+    use_auth_script = False
+    storage = 'blob'
+    session_redis = None
+    hash_tags = False
+    replica_router = None
+    session_writer = None
+    unlink_batch_size = UNLINK_BATCH_SIZE
+    max_field_size = None
+    auth_script = AUTH_SCRIPT
+    metrics = NULL_METRICS
 
     def __init__(self, app, redis=None, prefix='session:'):
         """
         Constructor
         """
-        redis_host = app.config.get('SESSION_REDIS_HOST', '127.0.0.1')
-        redis_port = app.config.get('SESSION_REDIS_PORT', 6379)
-        redis_pass = app.config.get('SESSION_REDIS_PASS', None)
-        redis_db = app.config.get('SESSION_REDIS_DB', 0)
+        self.serializer = \
+            SessionSerializer(
+                app.config.get('SESSION_SERIALIZER', 'json'),
+                app.config.get('SESSION_COMPRESS_THRESHOLD', None),
+                app.config.get('SESSION_SERIALIZER_LEGACY_PICKLE', True))
+        self.refresh_threshold = \
+            app.config.get('SESSION_REDIS_REFRESH_THRESHOLD', None)
         if redis is None:
-            redis = \
-                Redis(
-                    host=redis_host,
-                    port=redis_port,
-                    db=redis_db,
-                    password=redis_pass)
+            config = dict(app.config)
+            redis = LazyRedis(lambda: create_redis(config))
         self.redis = redis
         self.prefix = prefix
+        ## Sessions, and tokens kept in Redis, may be sharded
+        ## across nodes or stored in a Redis Cluster. Everything
+        ## else stays on `redis`.
+        self.session_redis, self.hash_tags = \
+            create_session_redis(app.config, redis)
+        if self.hash_tags:
+            ## Multi-key commands can not span nodes
+            self.unlink_batch_size = 1
+        ## Session reads may go to replicas
+        self.replica_router = \
+            create_replica_router(app.config, self.session_redis)
+        if self.hash_tags and (self.replica_router is not None):
+            raise Exception("Read replicas are not supported with sharding")
+        ## Tokens kept in Redis are fetched along with the session
+        if app.config.get('AUTH_TOKEN_STORE', 'sql') in ('redis', 'redis_sql'):
+            self.token_prefix = \
+                app.config.get('AUTH_TOKEN_STORE_PREFIX', 'token:')
+        self.use_auth_script = \
+            app.config.get('SESSION_REDIS_AUTH_SCRIPT', False)
+        self.lazy = app.config.get('SESSION_LAZY', True)
+        ## Hash storage keeps each session key in its own field,
+        ## under a separate prefix, as the Redis types differ
+        self.storage = app.config.get('SESSION_STORAGE', 'blob')
+        if self.storage not in STORAGE_MODES:
+            raise Exception("Invalid session storage mode")
+        if self.storage == 'hash':
+            self.prefix = \
+                app.config.get('SESSION_HASH_PREFIX', 'session-hash:')
+            self.auth_script = HASH_AUTH_SCRIPT
+        self.max_field_size = \
+            app.config.get('SESSION_HASH_MAX_FIELD_SIZE', 65536)
+        self.session_writer = create_session_writer(app, self.write_sessions)
         self.req_tok_type = (
             app.config.get(
                 'AUTH_TOKEN_TYPE',
@@ -81,11 +349,27 @@ class TokenRedisSessionInterface(SessionInterface):
         )
         return None
 
+    def key_id(self, sid):
+        """
+        Get the part of a session's Redis keys which identifies
+        it. When sharded, it is a hash tag, so that all keys of
+        a session route to the same node.
+        """
+        if self.hash_tags:
+            return '{%s}' % sid
+        return sid
+
+    def session_key(self, sid):
+        """
+        Get the Redis key of a session
+        """
+        return self.prefix + self.key_id(sid)
+
     def generate_sid(self):
         """
         Generate a session ID
         """
-        return uuid.uuid4().get_hex()
+        return uuid.uuid4().hex
 
     def get_redis_expiration_time(self, app, sess):
         """
@@ -93,7 +377,24 @@ class TokenRedisSessionInterface(SessionInterface):
         """
         if sess.permanent:
             return app.permanent_session_lifetime
-        return timedelta(days=1)
+        return DEFAULT_LIFETIME
+
+    def get_refresh_threshold(self, redis_exp):
+        """
+        Get the remaining lifetime, in seconds, below which
+        an unmodified session will have its TTL refreshed.
+        Defaults to half of the session lifetime.
+        """
+        if self.refresh_threshold is not None:
+            return int(self.refresh_threshold)
+        return int(redis_exp.total_seconds()) // 2
+
+    def is_empty(self, sess):
+        """
+        Determines if a session holds nothing
+        but Flask-Login bookkeeping
+        """
+        return all(key in LOGIN_BOOKKEEPING_KEYS for key in sess)
 
     def open_session(self, app, request):
         """
@@ -106,28 +407,311 @@ class TokenRedisSessionInterface(SessionInterface):
                 request
             )
         )
+        ## No token, the sid is only generated if the session
+        ## ends up being saved
         if sid is None:
-            sid = self.generate_sid()
-            return self.session_class(sid=sid, new=True)
-        val = self.redis.get(self.prefix + sid)
-        if val is not None:
-            data = self.serializer.loads(val)
-            return self.session_class(data, sid=sid)
-        return self.session_class(sid=sid, new=True)
+            return self.session_class(new=True)
+        if self.lazy:
+            return \
+                self.lazy_session_class(
+                    sid, lambda: self.load_session(sid, app))
+        return self.load_session(sid, app)
+
+    def load_session(self, sid, app=None):
+        """
+        Fetch and build a session.
+        A session with a queued write is built from that write.
+        """
+        if self.session_writer is not None:
+            queued = self.session_writer.get(sid)
+            if queued is not None:
+                data, redis_exp = queued
+                return \
+                    self.session_class(
+                        data,
+                        sid=sid,
+                        ttl=int(redis_exp.total_seconds()))
+        with self.metrics.timer('session_load_seconds'):
+            val, ttl, prefetched = self.fetch_session(sid, app)
+            return self.make_session(sid, val, ttl, prefetched)
+
+    def make_session(self, sid, val, ttl, prefetched):
+        """
+        Build a session from its fetched Redis values
+        """
+        try:
+            data = self.decode_session(val)
+        except LegacyPayloadRejected:
+            ## Dropped, as if it had expired
+            self.metrics.incr('session_rejected_total')
+            data = None
+        if data is not None:
+            if (ttl is None) or (ttl < 0):
+                ttl = None
+            sess = self.session_class(data, sid=sid, ttl=ttl)
+        else:
+            sess = self.session_class(sid=sid, new=True)
+        sess.prefetched = prefetched
+        return sess
+
+    def decode_session(self, val):
+        """
+        Decode a fetched session value.
+        Returns the session data, or None when missing.
+        """
+        if self.storage == 'blob':
+            if val is None:
+                return None
+            return self.serializer.loads(val)
+        if not val:
+            return None
+        ## From a script, a hash is a flat list of fields and values
+        if isinstance(val, list):
+            val = dict(zip(val[::2], val[1::2]))
+        data = {}
+        for field, fval in val.items():
+            if isinstance(field, bytes):
+                field = field.decode('utf-8')
+            data[field] = self.serializer.loads(fval)
+        return data
+
+    def queue_fetch(self, pipe, keys):
+        """
+        Queue the commands which fetch a session
+        """
+        if self.storage == 'hash':
+            pipe.hgetall(keys[0])
+        else:
+            pipe.get(keys[0])
+        pipe.ttl(keys[0])
+        if len(keys) > 1:
+            pipe.get(keys[1])
+        return pipe
+
+    def get_fetch_keys(self, sid):
+        """
+        Get the Redis keys fetched when opening a session
+        """
+        keys = [self.session_key(sid)]
+        if self.token_prefix is not None:
+            keys.append(self.token_prefix + self.key_id(sid))
+        return keys
+
+    def get_auth_script_args(self, app):
+        """
+        Get the arguments for the auth script.
+        Whether a session is permanent is only known once it is
+        decoded, so the script slides the lifetime of sessions
+        which are not. Permanent sessions with another lifetime
+        have it set when saved, see `needs_refresh`.
+        """
+        redis_exp = self.get_redis_expiration_time(app, self.session_class())
+        return [
+            self.get_refresh_threshold(redis_exp),
+            int(redis_exp.total_seconds())
+        ]
+
+    def fetch_session(self, sid, app=None):
+        """
+        Fetch a session value, its remaining lifetime and,
+        when tokens are kept in Redis, its token, all in
+        one round trip.
+
+        With SESSION_REDIS_AUTH_SCRIPT this runs as a Lua
+        script which also slides the TTL of a session that
+        is running low, so no follow-up EXPIRE is needed.
+
+        With read replicas configured, the session is read
+        from a replica when possible.
+        """
+        keys = self.get_fetch_keys(sid)
+        results = None
+        if self.replica_router is not None:
+            results = self.fetch_from_replica(sid, keys)
+        if results is not None:
+            val, ttl, tok = results
+        elif self.use_auth_script:
+            val, ttl, tok = \
+                self.auth_script(
+                    self.session_redis, keys, self.get_auth_script_args(app))
+        else:
+            pipe = self.session_redis.pipeline(transaction=False)
+            self.queue_fetch(pipe, keys)
+            results = pipe.execute()
+            val, ttl = results[:2]
+            tok = results[2] if (len(keys) > 1) else None
+        prefetched = {}
+        if len(keys) > 1:
+            prefetched[keys[1]] = tok
+        return (val, ttl, prefetched)
+
+    def fetch_from_replica(self, sid, keys):
+        """
+        Fetch a session from a replica. Returns the session
+        value, its remaining lifetime and its token, or None
+        when it must be read from the primary instead: when
+        its recently written marker is set on the primary, it
+        is missing from the replica, or the replica can not
+        be reached.
+        """
+        router = self.replica_router
+        client = router.get_replica(sid)
+        if client is None:
+            return None
+        try:
+            if router.recently_written(keys[0]):
+                router.record_fallback('recent_write')
+                return None
+            pipe = client.pipeline(transaction=False)
+            self.queue_fetch(pipe, keys)
+            results = pipe.execute()
+        except RedisError:
+            router.record_fallback('error')
+            return None
+        if not results[0]:
+            router.record_fallback('missing')
+            return None
+        router.record_replica_read()
+        tok = results[2] if (len(keys) > 1) else None
+        return (results[0], results[1], tok)
 
     def save_session(self, app, sess, response):
         """
         Save Session
         """
-        if not sess:
-            self.redis.delete(self.prefix + sess.sid)
+        ## Never used, so nothing can have changed
+        if not sess.loaded:
+            return None
+        if self.is_empty(sess):
+            ## Only sessions which exist in Redis need deleting
+            if not sess.new:
+                if self.session_writer is not None:
+                    self.session_writer.discard(sess.sid)
+                with self.metrics.timer('session_delete_seconds'):
+                    pipe = self.session_redis.pipeline(transaction=False)
+                    pipe.delete(self.session_key(sess.sid))
+                    self.queue_mark_written(pipe, sess.sid)
+                    pipe.execute()
             return None
         redis_exp = self.get_redis_expiration_time(app, sess)
+        if not sess.modified:
+            self.refresh_session(sess, redis_exp)
+            return None
+        if sess.sid is None:
+            sess.sid = self.generate_sid()
+        if self.session_writer is not None:
+            if (
+                    (not sess.write_through) and
+                    self.session_writer.submit(
+                        PendingSessionWrite(sess, redis_exp))
+            ):
+                return None
+            ## Must land after any write still queued
+            self.session_writer.discard(sess.sid)
         #cookie_exp = self.get_expiration_time(app, sess)
-        val = self.serializer.dumps(dict(sess))
-        self.redis.setex(
-            self.prefix + sess.sid,
-            val,
+        with self.metrics.timer('session_save_seconds'):
+            pipe = self.session_redis.pipeline(transaction=False)
+            if self.storage == 'hash':
+                size = self.queue_hash_save(pipe, sess, redis_exp)
+            else:
+                val = self.serializer.dumps(dict(sess))
+                size = len(val)
+                pipe.set(
+                    self.session_key(sess.sid),
+                    val,
+                    ex=int(redis_exp.total_seconds())
+                )
+            self.queue_mark_written(pipe, sess.sid)
+            pipe.execute()
+        self.metrics.observe('session_bytes', size)
+        return None
+
+    def write_sessions(self, writes):
+        """
+        Write queued sessions, in one pipeline
+        """
+        pipe = self.session_redis.pipeline(transaction=False)
+        sizes = []
+        for sess in writes:
+            if self.storage == 'hash':
+                sizes.append(self.queue_hash_save(pipe, sess, sess.redis_exp))
+            else:
+                val = self.serializer.dumps(dict(sess))
+                sizes.append(len(val))
+                pipe.set(
+                    self.session_key(sess.sid),
+                    val,
+                    ex=int(sess.redis_exp.total_seconds())
+                )
+            self.queue_mark_written(pipe, sess.sid)
+        with self.metrics.timer('session_save_seconds'):
+            pipe.execute()
+        for size in sizes:
+            self.metrics.observe('session_bytes', size)
+        return True
+
+    def queue_mark_written(self, pipe, sid):
+        """
+        Queue the marker which makes a session just written be
+        read from the primary, until replicas have caught up
+        """
+        if self.replica_router is None:
+            return pipe
+        return \
+            self.replica_router.queue_mark_written(
+                pipe, sid, self.session_key(sid))
+
+    def queue_hash_save(self, pipe, sess, redis_exp):
+        """
+        Queue the commands which write the changed fields
+        of a hash stored session. Returns the bytes written.
+        """
+        key = self.session_key(sess.sid)
+        if sess.new or sess.full_write:
+            changed = list(sess.keys())
+        else:
+            changed = [field for field in sess.changed if field in sess]
+        values = {}
+        for field in changed:
+            values[field] = self.serializer.dumps(sess[field])
+            if len(values[field]) > self.max_field_size:
+                raise \
+                    SessionFieldTooLarge(
+                        "Session field %r is %d bytes" %
+                        (field, len(values[field])))
+        deleted = [field for field in sess.deleted if field not in sess]
+        if deleted and (not sess.new):
+            pipe.hdel(key, *deleted)
+        if values:
+            pipe.hset(key, mapping=values)
+        pipe.expire(key, int(redis_exp.total_seconds()))
+        return sum(len(val) for val in values.values())
+
+    def needs_refresh(self, sess, redis_exp):
+        """
+        Determines if an unmodified session is running low
+        on lifetime, or has more than its lifetime left, and
+        should have its TTL refreshed
+        """
+        if sess.new:
+            return False
+        return (
+            (sess.ttl is None) or
+            (sess.ttl < self.get_refresh_threshold(redis_exp)) or
+            (sess.ttl > int(redis_exp.total_seconds()))
+        )
+
+    def refresh_session(self, sess, redis_exp):
+        """
+        Slide the TTL of an unmodified session with a cheap
+        EXPIRE, but only once its remaining lifetime
+        drops below the refresh threshold.
+        """
+        if not self.needs_refresh(sess, redis_exp):
+            return None
+        self.session_redis.expire(
+            self.session_key(sess.sid),
             int(redis_exp.total_seconds())
         )
+        self.metrics.incr('session_refresh_total')
         return None
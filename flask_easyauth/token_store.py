@@ -0,0 +1,721 @@
+#!/usr/bin/env python
+
+"""
+Token storage backends.
+
+    sql:        Tokens live in the token table (default)
+    redis:      Tokens live in Redis only, with a TTL
+    redis_sql:  Tokens live in Redis, and are persisted to the
+                token table asynchronously. Redis misses fall
+                back to the token table and are backfilled,
+                unless the token was revoked.
+    signed:     Tokens are HMAC signed and carry their user,
+                so they are verified without any storage lookup.
+                Revoked tokens are kept in Redis until they expire.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import os
+from abc import ABCMeta, abstractmethod
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from flask import session, has_request_context
+from sqlalchemy import bindparam, or_
+from sqlalchemy.orm import joinedload, with_polymorphic
+
+try:
+    from sqlalchemy.ext import baked
+except ImportError:
+    baked = None
+
+from .identity import snapshot_user, restore_user, identity_keys
+from .lua import BACKFILL_TOKEN_SCRIPT
+from .serializers import SessionSerializer
+from .session_index import chunks, unlink_keys
+from .signed_tokens import TokenSigner
+
+
+def get_prefetched(key):
+    """
+    Get a Redis value prefetched along with the session.
+    Returns a 1-tuple holding the value, or None
+    when the key was not prefetched.
+    """
+    if not has_request_context():
+        return None
+    prefetched = getattr(session, 'prefetched', None)
+    if (prefetched is None) or (key not in prefetched):
+        return None
+    return (prefetched.pop(key),)
+
+
+## Base class with ABCMeta, on Python 2 and 3
+AbstractBase = ABCMeta('AbstractBase', (object,), {})
+
+
+class TokenStore(AbstractBase):
+    """
+    Base token store.
+    Subclasses must implement `add`, `remove` and `get_user`.
+    """
+
+    app = None
+    db = None
+    user_cls = None
+    token_cls = None
+    ## Whether `iter_tokens` is supported
+    enumerable = False
+
+    def __init__(self, app, db, user_cls, token_cls):
+        """
+        Constructor
+        """
+        self.app = app
+        self.db = db
+        self.user_cls = user_cls
+        self.token_cls = token_cls
+        return None
+
+    def create_token(self, user=None):
+        """
+        Create a new token
+        """
+        # pylint: disable=unused-argument
+        return uuid.uuid4().hex
+
+    @abstractmethod
+    def add(self, token, user, **kwargs):
+        """
+        Store a token for a user.
+        Extra kwargs are stored as token metadata.
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, token):
+        """
+        Remove a token
+        """
+        pass
+
+    def remove_many(self, tokens, user_ids):
+        """
+        Remove many tokens, and any other tokens belonging
+        to the given users
+        """
+        # pylint: disable=unused-argument
+        for token in tokens:
+            self.remove(token)
+        return True
+
+    @abstractmethod
+    def get_user(self, token):
+        """
+        Get the user for a token, or None
+        """
+        pass
+
+    def iter_tokens(self, batch_size=10000):
+        """
+        Iterate over every stored token.
+        Only supported when `enumerable` is set.
+        """
+        raise Exception("This token store can not list its tokens")
+
+
+class SQLTokenStore(TokenStore):
+    """
+    Stores tokens in the token table.
+    When the token model has an `expires` column, tokens
+    past their expiry are ignored, and new tokens expire
+    after AUTH_TOKEN_LIFETIME.
+    """
+
+    token_query = None
+    has_expiry = False
+    lifetime = None
+    enumerable = True
+
+    def __init__(self, app, db, user_cls, token_cls):
+        """
+        Constructor
+        """
+        TokenStore.__init__(self, app, db, user_cls, token_cls)
+        self.has_expiry = hasattr(token_cls, 'expires')
+        self.lifetime = app.config.get('AUTH_TOKEN_LIFETIME', None)
+        return None
+
+    def add(self, token, user, **kwargs):
+        """
+        Store a token for a user
+        """
+        self.insert(token, user.id, kwargs)
+        return True
+
+    def insert(self, token, user_id, meta):
+        """
+        Insert a token row
+        """
+        auth_token = self.token_cls()
+        auth_token.user_id = user_id
+        auth_token.token = token
+        if (
+                self.has_expiry and
+                (self.lifetime is not None) and
+                ('expires' not in meta)
+        ):
+            auth_token.expires = datetime.utcnow() + self.lifetime
+        for key, val in meta.items():
+            setattr(auth_token, key, val)
+        self.db.session.add(auth_token)
+        self.db.session.commit()
+        return True
+
+    def remove(self, token):
+        """
+        Remove a token
+        """
+        auth_token = self.token_cls.query.filter_by(token=token).first()
+        if auth_token is None:
+            return False
+        self.db.session.delete(auth_token)
+        self.db.session.commit()
+        return True
+
+    def remove_many(self, tokens, user_ids):
+        """
+        Remove all tokens of the given users,
+        with bulk deletes
+        """
+        for batch in chunks(user_ids, 500):
+            (
+                self.token_cls.query
+                .filter(self.token_cls.user_id.in_(batch))
+                .delete(synchronize_session=False)
+            )
+        self.db.session.commit()
+        return True
+
+    def get_user(self, token):
+        """
+        Get the user for a token
+        """
+        auth_token = self.get_auth_token(token)
+        if auth_token is None:
+            return None
+        return auth_token.user
+
+    def iter_tokens(self, batch_size=10000):
+        """
+        Iterate over every unexpired token
+        """
+        query = self.db.session.query(self.token_cls.token)
+        if self.has_expiry:
+            query = query.filter(self._unexpired(datetime.utcnow()))
+        for (token,) in query.yield_per(batch_size):
+            yield token
+
+    def _load_user_option(self):
+        """
+        Query option which eagerly joins the user, including
+        any polymorphic subclass columns, onto the token
+        """
+        user_entity = with_polymorphic(self.user_cls, '*', flat=True)
+        return joinedload(self.token_cls.user.of_type(user_entity))
+
+    def _build_token_query(self):
+        """
+        Build the query used to resolve a token to its user
+        in a single statement. A baked query is used so
+        that the compiled SQL is cached between requests.
+        """
+        load_user = self._load_user_option()
+        token_cls = self.token_cls
+        bakery = baked.bakery()
+        query = bakery(lambda sess: sess.query(token_cls))
+        query += lambda q: q.options(load_user)
+        query += lambda q: q.filter(token_cls.token == bindparam('token'))
+        if self.has_expiry:
+            query += \
+                lambda q: q.filter(self._unexpired(bindparam('now')))
+        return query
+
+    def _unexpired(self, now):
+        """
+        Criterion matching tokens which have not expired
+        """
+        return or_(
+            self.token_cls.expires.is_(None),
+            self.token_cls.expires > now
+        )
+
+    def get_auth_token(self, token):
+        """
+        Get an auth token, with its user loaded, in a single query
+        """
+        if baked is None:
+            query = (
+                self.token_cls.query
+                .options(self._load_user_option())
+                .filter_by(token=token)
+            )
+            if self.has_expiry:
+                query = query.filter(self._unexpired(datetime.utcnow()))
+            return query.first()
+        ## Built lazily, so that mappers are configured
+        if self.token_query is None:
+            self.token_query = self._build_token_query()
+        params = {'token': token}
+        if self.has_expiry:
+            params['now'] = datetime.utcnow()
+        return (
+            self.token_query(self.db.session())
+            .params(**params)
+            .first()
+        )
+
+
+class RedisTokenStore(TokenStore):
+    """
+    Stores tokens in Redis.
+    Each token holds a snapshot of a few user columns, so
+    resolving a token needs no query. Other columns are
+    loaded from the database on first access.
+    Tokens expire from Redis at their `expires`, after
+    AUTH_TOKEN_LIFETIME, or after AUTH_TOKEN_STORE_TTL,
+    whichever comes first.
+    """
+
+    redis = None
+    key_id = None
+    unlink_batch_size = None
+    prefix = None
+    ttl = None
+    lifetime = None
+    user_fields = None
+    serializer = None
+    enumerable = True
+
+    def __init__(self, app, db, user_cls, token_cls):
+        """
+        Constructor
+        """
+        TokenStore.__init__(self, app, db, user_cls, token_cls)
+        ## Tokens are stored alongside their sessions
+        self.redis = app.session_interface.session_redis
+        self.key_id = app.session_interface.key_id
+        self.unlink_batch_size = app.session_interface.unlink_batch_size
+        self.prefix = app.config.get('AUTH_TOKEN_STORE_PREFIX', 'token:')
+        self.ttl = \
+            app.config.get('AUTH_TOKEN_STORE_TTL', timedelta(days=30))
+        self.lifetime = app.config.get('AUTH_TOKEN_LIFETIME', None)
+        self.user_fields = \
+            app.config.get(
+                'AUTH_TOKEN_STORE_USER_FIELDS',
+                ('id', 'type', 'active', 'real'))
+        ## Tokens were never stored with legacy pickle
+        self.serializer = SessionSerializer('json', legacy_pickle=False)
+        return None
+
+    def key(self, token):
+        """
+        Get the Redis key of a token
+        """
+        return self.prefix + self.key_id(token)
+
+    def dump_token(self, user, **kwargs):
+        """
+        Serialize the value stored for a token
+        """
+        payload = {
+            'user': snapshot_user(user, self.user_fields),
+            'meta': kwargs
+        }
+        return self.serializer.dumps(payload)
+
+    def load_user(self, val):
+        """
+        Rebuild the user from a stored token value
+        """
+        payload = self.serializer.loads(val)
+        return restore_user(self.db, self.user_cls, payload['user'])
+
+    def token_ttl(self, expires=None):
+        """
+        Get the number of seconds a token is kept in Redis.
+        Zero or less when it has already expired.
+        """
+        ttl = self.ttl
+        if (self.lifetime is not None) and (self.lifetime < ttl):
+            ttl = self.lifetime
+        if expires is not None:
+            ttl = min(ttl, expires - datetime.utcnow())
+        return int(ttl.total_seconds())
+
+    def add(self, token, user, **kwargs):
+        """
+        Store a token for a user.
+        Tokens which have already expired are not stored.
+        """
+        ttl = self.token_ttl(kwargs.get('expires', None))
+        if ttl <= 0:
+            return True
+        self.redis.set(
+            self.key(token),
+            self.dump_token(user, **kwargs),
+            ex=ttl
+        )
+        return True
+
+    def remove(self, token):
+        """
+        Remove a token
+        """
+        return bool(self.redis.delete(self.key(token)))
+
+    def remove_many(self, tokens, user_ids):
+        """
+        Remove many tokens, with pipelined UNLINKs
+        """
+        unlink_keys(
+            self.redis,
+            [self.key(token) for token in tokens],
+            self.unlink_batch_size)
+        return True
+
+    def get_raw(self, token):
+        """
+        Get the raw value stored for a token.
+        Uses the value prefetched with the session, if any.
+        """
+        key = self.key(token)
+        prefetched = get_prefetched(key)
+        if prefetched is not None:
+            return prefetched[0]
+        return self.redis.get(key)
+
+    def get_user(self, token):
+        """
+        Get the user for a token
+        """
+        val = self.get_raw(token)
+        if val is None:
+            return None
+        return self.load_user(val)
+
+    def iter_tokens(self, batch_size=10000):
+        """
+        Iterate over every token, scanning their keys
+        """
+        start = len(self.prefix)
+        for key in \
+                self.redis.scan_iter(match=self.prefix + '*', count=batch_size):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            ## Strip the hash tag of sharded keys
+            yield key[start:].lstrip('{').rstrip('}')
+
+
+class RedisSQLTokenStore(RedisTokenStore):
+    """
+    Stores tokens in Redis, and persists them to the
+    token table from a background thread.
+    Removed tokens are marked as revoked in Redis, so that
+    the token table, whose rows are deleted asynchronously,
+    never backfills them.
+    """
+
+    sql_store = None
+    revoked_prefix = None
+    revoked_ttl = None
+
+    def __init__(self, app, db, user_cls, token_cls):
+        """
+        Constructor
+        """
+        RedisTokenStore.__init__(self, app, db, user_cls, token_cls)
+        self.sql_store = SQLTokenStore(app, db, user_cls, token_cls)
+        self.revoked_prefix = \
+            app.config.get(
+                'AUTH_TOKEN_STORE_REVOKED_PREFIX',
+                'token-revoked:')
+        self.revoked_ttl = \
+            app.config.get('AUTH_TOKEN_STORE_REVOKED_TTL', self.ttl)
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        return None
+
+    def add(self, token, user, **kwargs):
+        """
+        Store a token for a user
+        """
+        RedisTokenStore.add(self, token, user, **kwargs)
+        self.persist(self.sql_store.insert, token, user.id, kwargs)
+        return True
+
+    def revoked_key(self, token):
+        """
+        Get the Redis key marking a token as revoked
+        """
+        return self.revoked_prefix + self.key_id(token)
+
+    def queue_revoke(self, pipe, token):
+        """
+        Queue the commands which delete a token from
+        Redis and mark it as revoked
+        """
+        pipe.delete(self.key(token))
+        pipe.set(
+            self.revoked_key(token),
+            1,
+            ex=int(self.revoked_ttl.total_seconds()))
+        return pipe
+
+    def remove(self, token):
+        """
+        Remove a token
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        self.queue_revoke(pipe, token)
+        pipe.execute()
+        self.persist(self.sql_store.remove, token)
+        return True
+
+    def remove_many(self, tokens, user_ids):
+        """
+        Remove many tokens
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for token in tokens:
+            self.queue_revoke(pipe, token)
+        pipe.execute()
+        self.persist(self.sql_store.remove_many, [], list(user_ids))
+        return True
+
+    def get_user(self, token):
+        """
+        Get the user for a token, falling back to the
+        token table when Redis does not have it
+        """
+        user = RedisTokenStore.get_user(self, token)
+        if user is not None:
+            return user
+        if self.redis.exists(self.revoked_key(token)):
+            return None
+        auth_token = self.sql_store.get_auth_token(token)
+        if auth_token is None:
+            return None
+        self.backfill(
+            token,
+            auth_token.user,
+            getattr(auth_token, 'expires', None))
+        return auth_token.user
+
+    def backfill_args(self, token, user, expires=None):
+        """
+        Get the keys and arguments of the backfill script.
+        None when the token expires too soon to be stored.
+        """
+        ttl = self.token_ttl(expires)
+        if ttl <= 0:
+            return None
+        return (
+            [self.key(token), self.revoked_key(token)],
+            [self.dump_token(user), ttl]
+        )
+
+    def backfill(self, token, user, expires=None):
+        """
+        Copy a token found in the token table to Redis, until
+        it expires, unless it was revoked since it was read
+        """
+        backfill_args = self.backfill_args(token, user, expires)
+        if backfill_args is None:
+            return False
+        keys, args = backfill_args
+        return bool(BACKFILL_TOKEN_SCRIPT(self.redis, keys, args))
+
+    def iter_tokens(self, batch_size=10000):
+        """
+        Iterate over every token, in the token table or
+        in Redis and not yet persisted. Tokens in both
+        are listed twice.
+        """
+        for token in self.sql_store.iter_tokens(batch_size):
+            yield token
+        for token in RedisTokenStore.iter_tokens(self, batch_size):
+            yield token
+
+    def persist(self, func, *args):
+        """
+        Queue a write to the token table
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._queue = Queue()
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                    atexit.register(self.flush)
+                    self._pid = pid
+        self._queue.put((func, args))
+        return True
+
+    def _work(self):
+        """
+        Background writer loop
+        """
+        while True:
+            func, args = self._queue.get()
+            try:
+                with self.app.app_context():
+                    func(*args)
+            # pylint: disable=broad-except
+            except Exception:
+                self.app.logger.exception("Could not persist token")
+            # pylint: enable=broad-except
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Wait for queued writes to finish
+        """
+        if (self._queue is not None) and (self._pid == os.getpid()):
+            self._queue.join()
+        return True
+
+
+class SignedTokenStore(TokenStore):
+    """
+    Stateless signed tokens.
+    Tokens are verified with CPU work alone. Unless
+    AUTH_SIGNED_TOKEN_CHECK_REVOKED is disabled, tokens
+    which pass verification are also checked against the
+    revocation set in Redis.
+    """
+
+    signer = None
+    redis = None
+    prefix = None
+    check_revoked = None
+    id_key = None
+    type_key = None
+
+    def __init__(self, app, db, user_cls, token_cls):
+        """
+        Constructor
+        """
+        TokenStore.__init__(self, app, db, user_cls, token_cls)
+        keys = app.config.get('AUTH_SIGNING_KEYS', None)
+        if not keys:
+            raise Exception("AUTH_SIGNING_KEYS must be configured")
+        self.signer = \
+            TokenSigner(
+                keys,
+                app.config.get('AUTH_SIGNING_KEY_ID', None),
+                app.config.get('AUTH_SIGNED_TOKEN_TTL', timedelta(days=1)))
+        self.redis = app.session_interface.redis
+        self.prefix = app.config.get('AUTH_REVOKED_PREFIX', 'revoked:')
+        self.check_revoked = \
+            app.config.get('AUTH_SIGNED_TOKEN_CHECK_REVOKED', True)
+        self.id_key, self.type_key = identity_keys(user_cls)
+        return None
+
+    def create_token(self, user=None):
+        """
+        Create a signed token for a user
+        """
+        if user is None:
+            raise Exception("Signed tokens require a user")
+        return \
+            self.signer.sign(
+                getattr(user, self.id_key),
+                getattr(user, self.type_key),
+                user.active,
+                user.real)
+
+    def add(self, token, user, **kwargs):
+        """
+        Nothing is stored for signed tokens
+        """
+        return True
+
+    def remove(self, token):
+        """
+        Revoke a token until it expires
+        """
+        claims = self.signer.verify(token)
+        if claims is None:
+            return False
+        remaining = int(claims['exp'] - time.time()) + 1
+        self.redis.set(self.prefix + claims['jti'], 1, ex=remaining)
+        return True
+
+    def remove_many(self, tokens, user_ids):
+        """
+        Revoke many tokens, pipelined
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for token in tokens:
+            claims = self.signer.verify(token)
+            if claims is None:
+                continue
+            remaining = int(claims['exp'] - time.time()) + 1
+            pipe.set(self.prefix + claims['jti'], 1, ex=remaining)
+        pipe.execute()
+        return True
+
+    def get_user(self, token):
+        """
+        Get the user for a token
+        """
+        claims = self.signer.verify(token)
+        if claims is None:
+            return None
+        if (
+                self.check_revoked and
+                self.redis.exists(self.prefix + claims['jti'])
+        ):
+            return None
+        values = {self.id_key: claims['u'], self.type_key: claims['t']}
+        ## Without flags, they are loaded from the database on access
+        if 'a' in claims:
+            values['active'] = claims['a']
+            values['real'] = claims['r']
+        snapshot = {
+            'identity': claims['t'],
+            'values': values
+        }
+        return restore_user(self.db, self.user_cls, snapshot)
+
+
+TOKEN_STORES = {
+    'sql': SQLTokenStore,
+    'redis': RedisTokenStore,
+    'redis_sql': RedisSQLTokenStore,
+    'signed': SignedTokenStore
+}
+
+
+def create_token_store(app, db, user_cls, token_cls):
+    """
+    Create the token store selected by AUTH_TOKEN_STORE
+    """
+    mode = app.config.get('AUTH_TOKEN_STORE', 'sql')
+    if mode not in TOKEN_STORES:
+        raise Exception("Invalid token store")
+    return TOKEN_STORES[mode](app, db, user_cls, token_cls)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+"""
+Write-behind session persistence.
+
+Session writes are queued, and written by a background thread in
+each process once the response has been returned. Queued writes to
+the same session are coalesced into one, and whatever is still
+queued is written when the process exits. Failed writes are
+retried with a bounded backoff, then dropped and counted. A write
+can be lost if the process crashes before it is flushed.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import os
+import threading
+import time
+
+from .metrics import NULL_METRICS
+
+
+class PendingSessionWrite(dict):
+    """
+    A snapshot of a session waiting to be written.
+    Has the attributes of a session which the session
+    interface reads when writing it.
+    """
+
+    sid = None
+    new = False
+    full_write = False
+    changed = None
+    deleted = None
+    redis_exp = None
+
+    def __init__(self, sess, redis_exp):
+        """
+        Constructor
+        """
+        dict.__init__(self, sess)
+        self.sid = sess.sid
+        self.new = sess.new
+        self.full_write = sess.full_write
+        self.changed = set(sess.changed)
+        self.deleted = set(sess.deleted)
+        self.redis_exp = redis_exp
+        return None
+
+    def merge(self, later):
+        """
+        Coalesce a later write of the same session into this one
+        """
+        self.clear()
+        self.update(later)
+        self.full_write = self.full_write or later.full_write
+        self.changed |= later.changed
+        self.deleted |= later.deleted
+        self.redis_exp = later.redis_exp
+        return self
+
+
+class SessionWriter(object):
+    """
+    Writes queued sessions from a background thread.
+    `write` is called with a list of pending writes.
+    """
+
+    app = None
+    write = None
+    max_pending = None
+    retries = None
+    retry_delay = None
+    max_retry_delay = None
+    metrics = NULL_METRICS
+
+    def __init__(self, app, write, max_pending=10000, retries=3,
+                 retry_delay=0.1, max_retry_delay=1.0):
+        """
+        Constructor.
+        A failed batch is retried `retries` times, waiting
+        `retry_delay` seconds, doubled after each retry up
+        to `max_retry_delay`.
+        """
+        self.app = app
+        self.write = write
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._pending = {}
+        self._writing = {}
+        self._counts = {
+            'queued': 0,
+            'coalesced': 0,
+            'written': 0,
+            'errors': 0,
+            'dropped': 0,
+            'overflows': 0
+        }
+        self._cond = threading.Condition()
+        self._pid = None
+        return None
+
+    def ensure_running(self):
+        """
+        Start the writer thread for this process
+        if it is not running yet
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return False
+        with self._cond:
+            if self._pid == pid:
+                return False
+            ## Writes queued before a fork belong to the parent
+            self._pending = {}
+            self._writing = {}
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            atexit.register(self.flush)
+            self._pid = pid
+        return True
+
+    def submit(self, write):
+        """
+        Queue a write, coalescing it with a queued write of the
+        same session. Returns False when the queue is full, and
+        the write should be made by the caller.
+        """
+        self.ensure_running()
+        with self._cond:
+            queued = self._pending.get(write.sid)
+            if queued is not None:
+                queued.merge(write)
+                self._counts['coalesced'] += 1
+                return True
+            if len(self._pending) >= self.max_pending:
+                self._counts['overflows'] += 1
+                return False
+            self._pending[write.sid] = write
+            self._counts['queued'] += 1
+            self._cond.notify_all()
+        return True
+
+    def get(self, sid):
+        """
+        Get the data and lifetime of the latest write
+        of a session not yet in Redis, or None
+        """
+        with self._cond:
+            write = self._pending.get(sid)
+            if write is None:
+                write = self._writing.get(sid)
+            if write is None:
+                return None
+            return (dict(write), write.redis_exp)
+
+    def discard(self, sid):
+        """
+        Drop the queued write of a session, and wait for one
+        being written, so that a write made by the caller
+        lands after it
+        """
+        with self._cond:
+            self._pending.pop(sid, None)
+            while sid in self._writing:
+                self._cond.wait()
+        return True
+
+    def write_batch(self, writes):
+        """
+        Write a batch, retrying it with a bounded backoff.
+        Returns whether it was written.
+        """
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                self.write(writes)
+                return True
+            # pylint: disable=broad-except
+            except Exception:
+                with self._cond:
+                    self._counts['errors'] += 1
+                if attempt == self.retries:
+                    self.app.logger.exception(
+                        "Could not write %d sessions, dropping them",
+                        len(writes))
+                    return False
+                self.app.logger.warning(
+                    "Could not write sessions, retrying", exc_info=True)
+            # pylint: enable=broad-except
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+        return False
+
+    def _work(self):
+        """
+        Background writer loop
+        """
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch = self._pending
+                self._pending = {}
+                self._writing = batch
+            written = self.write_batch(list(batch.values()))
+            with self._cond:
+                self._writing = {}
+                self._counts['written' if written else 'dropped'] += \
+                    len(batch)
+                self._cond.notify_all()
+            if not written:
+                self.metrics.incr('session_write_dropped_total', len(batch))
+
+    def flush(self, timeout=None):
+        """
+        Wait for queued writes to finish.
+        Returns False on timeout.
+        """
+        if self._pid != os.getpid():
+            return True
+        deadline = None if timeout is None else (time.time() + timeout)
+        with self._cond:
+            while self._pending or self._writing:
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        """
+        Get queue counters
+        """
+        with self._cond:
+            stats = dict(self._counts)
+            stats['pending'] = len(self._pending) + len(self._writing)
+            return stats
+
+
+def create_session_writer(app, write):
+    """
+    Create the session writer from app config,
+    or None when SESSION_WRITE_BEHIND is not enabled
+    """
+    if not app.config.get('SESSION_WRITE_BEHIND', False):
+        return None
+    return \
+        SessionWriter(
+            app,
+            write,
+            app.config.get('SESSION_WRITE_BEHIND_MAX_PENDING', 10000),
+            app.config.get('SESSION_WRITE_BEHIND_RETRIES', 3),
+            app.config.get('SESSION_WRITE_BEHIND_RETRY_DELAY', 0.1))
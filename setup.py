@@ -33,7 +33,19 @@ setup(
         'passlib>=1.6.2',
         'Flask-SQLAlchemy>=1.0',
         'redis>=2.9.1',
+        ## Backport of concurrent.futures, for the hashing pool
+        'futures>=3.0; python_version < "3"',
         'pep8>=1.5.6',
         'pylint>=1.2.0'
-    ]
+    ],
+    extras_require={
+        ## flask_easyauth.aio needs Python 3
+        'asyncio': [
+            'redis>=4.2; python_version >= "3.7"'
+        ],
+        ## SESSION_REDIS_CLUSTER_URL
+        'cluster': [
+            'redis>=4.1; python_version >= "3.6"'
+        ]
+    }
 )
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+Test fixtures.
+
+Apps are backed by SQLite and an in-process fake Redis.
+"""
+
+from __future__ import absolute_import
+
+import fakeredis
+import pytest
+from flask import Flask
+# pylint: disable=no-name-in-module
+from flask.ext.sqlalchemy import SQLAlchemy
+# pylint: enable=no-name-in-module
+
+from flask_easyauth import Auth, AuthTokenMixin, AuthUserMixin
+
+PASSWORD = "test-password"
+
+
+class AuthEnv(object):
+    """
+    An app, its models and its Redis
+    """
+
+    app = None
+    db = None
+    auth = None
+    redis = None
+    user_cls = None
+    admin_cls = None
+    token_cls = None
+
+
+def create_env(config=None, redis=None, auth_cls=Auth, **iface_kwargs):
+    """
+    Create an app with a joined-table AdminUser model.
+    `iface_kwargs` are passed to the session interface.
+    """
+    env = AuthEnv()
+    env.redis = redis if redis is not None else fakeredis.FakeStrictRedis()
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = 'test'
+    app.config['TESTING'] = True
+    app.config.update(config or {})
+    db = SQLAlchemy(app)
+
+    # pylint: disable=too-few-public-methods,invalid-name
+    class User(db.Model, AuthUserMixin):
+        """
+        User
+        """
+        __tablename__ = 'user'
+        id = db.Column(db.Integer, primary_key=True)
+        email = db.Column(db.String(255), index=True, unique=True)
+        password = db.Column(db.String(255))
+        active = db.Column(db.Boolean(), nullable=False, default=True)
+        real = db.Column(db.Boolean(), nullable=False, default=True)
+        type = db.Column(db.String(10), index=True)
+        __mapper_args__ = {
+            'polymorphic_identity': 'user',
+            'polymorphic_on': type
+        }
+
+        @classmethod
+        def get(cls, user_id):
+            """
+            Get by id
+            """
+            return cls.query.get(user_id)
+
+    class AdminUser(User):
+        """
+        Admin user
+        """
+        __tablename__ = 'adminuser'
+        __mapper_args__ = {
+            'polymorphic_identity': 'admin'
+        }
+        id = \
+            db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+        level = db.Column(db.Integer, default=1)
+
+    class AuthToken(db.Model, AuthTokenMixin):
+        """
+        Token
+        """
+        __tablename__ = 'auth_token'
+        id = db.Column(db.Integer, primary_key=True)
+        user_id = \
+            db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+        user = \
+            db.relationship(
+                'User',
+                backref=db.backref('auth_tokens', lazy='dynamic'))
+        token = db.Column(db.String(255), nullable=False, unique=True)
+        expires = db.Column(db.DateTime, nullable=True, index=True)
+    # pylint: enable=too-few-public-methods,invalid-name
+
+    iface_cls = auth_cls.session_interface_cls
+
+    class EnvSessionInterface(iface_cls):
+        """
+        Session interface on the fake Redis
+        """
+
+        def __init__(self, app):
+            """
+            Constructor
+            """
+            iface_cls.__init__(self, app, redis=env.redis, **iface_kwargs)
+            return None
+
+    class EnvAuth(auth_cls):
+        """
+        Auth on the fake Redis
+        """
+        session_interface_cls = EnvSessionInterface
+
+    env.app = app
+    env.db = db
+    env.user_cls = User
+    env.admin_cls = AdminUser
+    env.token_cls = AuthToken
+    env.auth = EnvAuth(app, db, User, AuthToken)
+    with app.app_context():
+        db.create_all()
+    return env
+
+
+def add_user(env, email, user_cls=None, **kwargs):
+    """
+    Add a user, and return its id
+    """
+    user = (user_cls or env.user_cls)(**kwargs)
+    user.set_security_attrs(email, password=PASSWORD)
+    env.db.session.add(user)
+    env.db.session.commit()
+    return user.id
+
+
+@pytest.fixture
+def make_env():
+    """
+    Factory of app environments
+    """
+    return create_env
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+Asyncio tests
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+from datetime import datetime, timedelta
+
+import fakeredis
+import pytest
+
+from .conftest import PASSWORD, add_user
+
+## Python 3 only
+aio = pytest.importorskip('flask_easyauth.aio')
+fake_aioredis = pytest.importorskip('fakeredis.aioredis')
+
+CRYPT_CONTEXT = {
+    'schemes': ['sha256_crypt', 'md5_crypt'],
+    'deprecated': ['md5_crypt']
+}
+
+
+def test_authenticate_rehashes_outdated_hash(make_env):
+    """
+    AsyncAuth.authenticate replaces a hash of a deprecated scheme
+    """
+    env = \
+        make_env(
+            {'AUTH_CRYPT_CONTEXT': CRYPT_CONTEXT},
+            auth_cls=aio.AsyncAuth,
+            aioredis_client=fake_aioredis.FakeRedis())
+    hasher = env.auth.hasher
+    with env.app.app_context():
+        user = env.user_cls()
+        user.set_security_attrs(
+            'user@example.com',
+            encrypted_password=hasher.context.hash(
+                PASSWORD, scheme='md5_crypt'))
+        env.db.session.add(user)
+        env.db.session.commit()
+        user_id = user.id
+    with env.app.app_context():
+        user = \
+            asyncio.run(
+                env.auth.authenticate(
+                    'user@example.com', PASSWORD, '127.0.0.1'))
+        assert user.id == user_id
+    with env.app.app_context():
+        user = env.user_cls.get(user_id)
+        assert hasher.context.identify(user.password) == 'sha256_crypt'
+        assert hasher.context.verify(PASSWORD, user.password)
+
+
+def test_authenticate_wrong_password(make_env):
+    """
+    AsyncAuth.authenticate rejects a wrong password
+    """
+    env = \
+        make_env(
+            auth_cls=aio.AsyncAuth,
+            aioredis_client=fake_aioredis.FakeRedis())
+    with env.app.app_context():
+        user = env.user_cls()
+        user.set_security_attrs('user@example.com', password=PASSWORD)
+        env.db.session.add(user)
+        env.db.session.commit()
+    with env.app.app_context():
+        user = \
+            asyncio.run(
+                env.auth.authenticate(
+                    'user@example.com', 'wrong', '127.0.0.1'))
+        assert user is None
+
+
+def test_redis_sql_removed_token_not_backfilled(make_env):
+    """
+    A token removed from Redis, but not yet from the token
+    table, is not resolved or backfilled from the table
+    """
+    server = fakeredis.FakeServer()
+    env = \
+        make_env(
+            {'AUTH_TOKEN_STORE': 'redis_sql'},
+            redis=fakeredis.FakeStrictRedis(server=server),
+            auth_cls=aio.AsyncAuth,
+            aioredis_client=fake_aioredis.FakeRedis(server=server))
+    store = env.auth.token_store
+    async_store = env.auth.async_token_store
+    token = 'a' * 32
+    held = []
+
+    async def scenario():
+        """
+        Add, persist, then remove with the table write held back
+        """
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        await async_store.add(token, user)
+        store.flush()
+        store.persist = lambda func, *args: held.append((func, args))
+        assert (await async_store.get_user(token)) is not None
+        await async_store.remove(token)
+        return await async_store.get_user(token)
+
+    with env.app.app_context():
+        assert asyncio.run(scenario()) is None
+    assert held
+    assert not env.redis.exists(store.key(token))
+
+
+def test_redis_sql_ttl_follows_expiry(make_env):
+    """
+    Tokens added and backfilled asynchronously
+    expire from Redis at their `expires`
+    """
+    server = fakeredis.FakeServer()
+    env = \
+        make_env(
+            {'AUTH_TOKEN_STORE': 'redis_sql'},
+            redis=fakeredis.FakeStrictRedis(server=server),
+            auth_cls=aio.AsyncAuth,
+            aioredis_client=fake_aioredis.FakeRedis(server=server))
+    store = env.auth.token_store
+    async_store = env.auth.async_token_store
+    token = 'a' * 32
+    expires = datetime.utcnow() + timedelta(minutes=10)
+
+    async def scenario():
+        """
+        Add, then drop the Redis copy and resolve from the table
+        """
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        await async_store.add(token, user, expires=expires)
+        assert 590 <= env.redis.ttl(store.key(token)) <= 600
+        store.flush()
+        env.redis.delete(store.key(token))
+        return await async_store.get_user(token)
+
+    with env.app.app_context():
+        assert asyncio.run(scenario()) is not None
+    assert 590 <= env.redis.ttl(store.key(token)) <= 600
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Auth tests
+"""
+
+from __future__ import absolute_import
+
+from flask import session
+
+from flask_easyauth.constants import REQ_TOKEN_HEADER
+
+from .conftest import add_user
+
+
+def add_routes(env):
+    """
+    Add login and logout routes
+    """
+
+    @env.app.route('/login', methods=['POST'])
+    def login_view():
+        """
+        Log the test user in
+        """
+        user = env.user_cls.get_by_email('user@example.com')
+        env.auth.login(user)
+        return session['auth_token']
+
+    @env.app.route('/logout', methods=['POST'])
+    def logout_view():
+        """
+        Log the current user out
+        """
+        env.auth.logout()
+        return "ok"
+
+    return env
+
+
+def test_login_stores_session_under_token(make_env):
+    """
+    The session of a login is stored under its token
+    """
+    env = add_routes(make_env())
+    with env.app.app_context():
+        add_user(env, 'user@example.com')
+    client = env.app.test_client()
+    token = client.post('/login').data.decode('utf-8')
+    iface = env.app.session_interface
+    assert env.redis.exists(iface.session_key(token))
+    with env.app.test_request_context(headers={REQ_TOKEN_HEADER: token}):
+        env.app.preprocess_request()
+        assert session['auth_token'] == token
+
+
+def test_logout_removes_token_from_index(make_env):
+    """
+    Logging out removes the token from the user's index
+    """
+    env = add_routes(make_env())
+    with env.app.app_context():
+        user_id = add_user(env, 'user@example.com')
+    client = env.app.test_client()
+    token = client.post('/login').data.decode('utf-8')
+    index = env.auth.session_index
+    assert env.redis.sismember(index.get_key(user_id), token)
+    resp = client.post('/logout', headers={REQ_TOKEN_HEADER: token})
+    assert resp.status_code == 200
+    assert not env.redis.sismember(index.get_key(user_id), token)
+    with env.app.app_context():
+        assert env.auth.token_store.get_user(token) is None
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Decorator tests.
+
+The decorators check compiled permission bitmasks. These tests
+compare them with the checks they replaced, which called the
+user's methods on every request.
+"""
+
+from __future__ import absolute_import
+
+import itertools
+
+import pytest
+from flask import _request_ctx_stack, session
+
+from flask_easyauth import decorators
+
+TYPES = ('user', 'admin', 'other', None)
+CASES = list(itertools.product([True, False], [True, False], TYPES))
+
+
+def baseline_failure(check, user, types=()):
+    """
+    The reason a user failed a check before permission
+    bitmasks, or None when it passed
+    """
+    authenticated = user.is_authenticated()
+    if check == 'real':
+        if not authenticated:
+            return 'not_authenticated'
+        if not user.is_real():
+            return 'not_real'
+        return None
+    if check == 'admin':
+        if not authenticated:
+            return 'not_authenticated'
+        if not user.is_admin():
+            return 'not_admin'
+        return None
+    if (
+            (user.type != 'admin') and
+            ((not authenticated) or (user.type not in types))
+    ):
+        if not authenticated:
+            return 'not_authenticated'
+        return 'wrong_type'
+    return None
+
+
+def check_user(env, view, user, authenticated, *baseline_args):
+    """
+    Call a decorated view as a user.
+    Returns the reason it was refused, or None, and
+    the result of the baseline check, if given.
+    """
+    with env.app.test_request_context():
+        session['is_authenticated'] = authenticated
+        _request_ctx_stack.top.user = user
+        expected = None
+        if baseline_args:
+            expected = \
+                baseline_failure(baseline_args[0], user, *baseline_args[1:])
+        return (view(), expected)
+
+
+@pytest.fixture
+def env(make_env, monkeypatch):
+    """
+    App whose unauthorized handler returns its reason
+    """
+    env = make_env()
+    monkeypatch.setattr(
+        env.auth.login_manager,
+        'unauthorized',
+        lambda reason='login_required': reason)
+    return env
+
+
+def allowed():
+    """
+    View
+    """
+    return None
+
+
+@pytest.mark.parametrize('authenticated,real,user_type', CASES)
+def test_real_and_admin_required_match_baseline(
+        env, authenticated, real, user_type):
+    """
+    `real_required` and `admin_required` refuse
+    the same users, for the same reasons
+    """
+    user = env.user_cls(type=user_type, real=real, active=True)
+    for check, decorator in (
+            ('real', decorators.real_required),
+            ('admin', decorators.admin_required)
+    ):
+        reason, expected = \
+            check_user(env, decorator(allowed), user, authenticated, check)
+        assert reason == expected
+
+
+@pytest.mark.parametrize('authenticated,real,user_type', CASES)
+@pytest.mark.parametrize('types', [('user',), ('user', 'other'), ()])
+def test_user_types_required_matches_baseline(
+        env, authenticated, real, user_type, types):
+    """
+    `user_types_required` refuses the same users, for the
+    same reasons. Unlike before, unauthenticated admins
+    are refused too.
+    """
+    user = env.user_cls(type=user_type, real=real, active=True)
+    view = decorators.user_types_required(*types)(allowed)
+    reason, expected = \
+        check_user(env, view, user, authenticated, 'types', types)
+    if (user_type == 'admin') and (not authenticated):
+        assert expected is None
+        expected = 'not_authenticated'
+    assert reason == expected
+
+
+def test_anonymous_user_refused(env):
+    """
+    Anonymous users are refused as not authenticated
+    """
+    for view in (
+            decorators.real_required(allowed),
+            decorators.admin_required(allowed),
+            decorators.user_types_required('user')(allowed),
+            decorators.permissions_required('edit')(allowed)
+    ):
+        with env.app.test_request_context():
+            assert view() == 'not_authenticated'
+
+
+@pytest.mark.parametrize('granted,expected', [
+    ((), 'missing_permission'),
+    (('edit',), 'missing_permission'),
+    (('edit', 'publish'), None),
+    (('edit', 'publish', 'delete'), None)
+])
+def test_permissions_required(env, granted, expected):
+    """
+    `permissions_required` needs every permission named
+    """
+    user = env.user_cls(type='user', real=True, active=True)
+    user.get_permissions = lambda: granted
+    view = decorators.permissions_required('edit', 'publish')(allowed)
+    assert check_user(env, view, user, True)[0] == expected
+    assert check_user(env, view, user, False)[0] == 'not_authenticated'
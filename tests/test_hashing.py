@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+Password hashing tests
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+import pytest
+from passlib.context import CryptContext
+
+from flask_easyauth import hashing
+from flask_easyauth.hashing import (
+    PasswordHasher,
+    HashingUnavailable,
+    calibrate_context
+)
+
+from .conftest import PASSWORD, add_user
+
+CONTEXT = CryptContext(schemes=['md5_crypt'])
+CRYPT_CONTEXT = {
+    'schemes': ['sha256_crypt', 'md5_crypt'],
+    'deprecated': ['md5_crypt']
+}
+
+
+class BlockingHasher(PasswordHasher):
+    """
+    A hasher whose hashes wait until released
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Constructor
+        """
+        PasswordHasher.__init__(self, CONTEXT, *args, **kwargs)
+        self.release = threading.Event()
+        self.threads = []
+        return None
+
+    def _run_local(self, method, args):
+        """
+        Wait, then hash
+        """
+        self.threads.append(threading.current_thread())
+        self.release.wait(5)
+        return PasswordHasher._run_local(self, method, args)
+
+
+def test_full_queue_fails_fast():
+    """
+    Once every worker is busy and the queue is full,
+    new hashes raise HashingUnavailable
+    """
+    hasher = BlockingHasher(executor='thread', workers=1, queue_size=1)
+    futures = [hasher.submit('encrypt', 'one'), hasher.submit('encrypt', 'two')]
+    assert hasher.stats()['pending'] == 2
+    assert hasher.stats()['queued'] == 1
+    with pytest.raises(HashingUnavailable):
+        hasher.submit('encrypt', 'three')
+    hasher.release.set()
+    hashes = [future.result(5) for future in futures]
+    assert CONTEXT.verify('two', hashes[1])
+    stats = hasher.stats()
+    assert (stats['rejected'], stats['completed']) == (1, 2)
+    assert stats['pending'] == 0
+    assert hasher.verify('one', hashes[0])
+
+
+def test_unavailable_answered_with_503(make_env):
+    """
+    A full hashing queue is answered with a JSON 503
+    """
+    env = make_env()
+
+    @env.app.route('/hash')
+    def hash_view():
+        """
+        Hash while the queue is full
+        """
+        raise HashingUnavailable("Password hashing queue is full")
+
+    resp = env.app.test_client().get('/hash')
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '1'
+    assert b'unavailable' in resp.data
+
+
+def test_async_inline_hash_runs_off_the_loop():
+    """
+    Without a pool, async hashes run in the default
+    executor, not on the event loop thread
+    """
+    asyncio = pytest.importorskip('asyncio')
+    hasher = BlockingHasher()
+    hasher.release.set()
+
+    async def verify():
+        """
+        Hash and verify from the loop
+        """
+        hashed = await hasher.encrypt_async('secret')
+        valid = await hasher.verify_async('secret', hashed)
+        return (valid, threading.current_thread())
+
+    valid, loop_thread = asyncio.run(verify())
+    assert valid
+    assert len(hasher.threads) == 2
+    assert loop_thread not in hasher.threads
+
+
+def test_rehash_committed_by_authenticate_only(make_env):
+    """
+    verify_password upgrades an outdated hash without committing
+    the caller's pending changes, and authenticate commits it
+    """
+    env = make_env({'AUTH_CRYPT_CONTEXT': CRYPT_CONTEXT})
+    context = env.auth.hasher.context
+    with env.app.test_request_context():
+        user_id = add_user(env, 'user@example.com')
+        other_id = add_user(env, 'other@example.com')
+        user = env.user_cls.get(user_id)
+        user.password = context.hash(PASSWORD, scheme='md5_crypt')
+        env.db.session.commit()
+        env.db.session.remove()
+        user = env.user_cls.get(user_id)
+        env.user_cls.get(other_id).email = 'pending@example.com'
+        assert user.verify_password(PASSWORD)
+        env.db.session.rollback()
+        env.db.session.remove()
+        user = env.user_cls.get(user_id)
+        assert context.identify(user.password) == 'md5_crypt'
+        assert env.user_cls.get(other_id).email == 'other@example.com'
+        env.db.session.remove()
+        assert env.auth.authenticate('user@example.com', PASSWORD).id == user_id
+        env.db.session.remove()
+        user = env.user_cls.get(user_id)
+        assert context.identify(user.password) == 'sha256_crypt'
+
+
+def test_calibration_keeps_min_rounds(monkeypatch):
+    """
+    Calibration only sets default rounds, rounded so that
+    slightly different timings agree. Hashes made with
+    another host's rounds are not flagged for an upgrade.
+    """
+    context = \
+        CryptContext(
+            schemes=['sha256_crypt'],
+            sha256_crypt__min_rounds=10000,
+            sha256_crypt__default_rounds=80000,
+            admin__sha256_crypt__min_rounds=900000,
+            admin__sha256_crypt__default_rounds=900000)
+    results = []
+    for elapsed in (0.0101, 0.01015, 0.0125):
+        monkeypatch.setattr(
+            hashing, '_time_hash', lambda *args, **kwargs: elapsed)
+        results.append(calibrate_context(context, 0.05))
+    config = results[0].to_dict()
+    assert config == results[1].to_dict()
+    assert config['sha256_crypt__min_rounds'] == 10000
+    assert config['sha256_crypt__default_rounds'] == 49000
+    assert config['admin__sha256_crypt__min_rounds'] == 900000
+    assert config['admin__sha256_crypt__default_rounds'] == 900000
+    slower = results[2].hash(PASSWORD)
+    assert results[2].to_dict()['sha256_crypt__default_rounds'] == 40000
+    assert not results[0].needs_update(slower)
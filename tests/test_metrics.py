@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+Metrics tests
+"""
+
+from __future__ import absolute_import
+
+import pytest
+
+from flask_easyauth import decorators, metrics
+from flask_easyauth.metrics import PrometheusSink, SignalSink
+
+from .conftest import add_user
+from .test_core import add_routes
+
+
+class ListSink(object):
+    """
+    Keeps every metric in a list
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.records = []
+        return None
+
+    def incr(self, name, value, labels):
+        """
+        Increment a counter
+        """
+        self.records.append(('counter', name, value, labels))
+        return None
+
+    def observe(self, name, value, labels):
+        """
+        Record an observation
+        """
+        self.records.append(('observation', name, value, labels))
+        return None
+
+
+def test_no_sinks_records_nothing(make_env):
+    """
+    Without AUTH_METRICS, metrics are disabled
+    and timers are shared no-ops
+    """
+    env = make_env()
+    assert not env.auth.metrics.enabled
+    assert env.auth.metrics.timer('hash_seconds') is metrics.NULL_TIMER
+    assert env.auth.metrics.get_sink(PrometheusSink) is None
+
+
+def test_prometheus_render():
+    """
+    Counters and histograms render in the
+    Prometheus text exposition format
+    """
+    sink = PrometheusSink()
+    recorder = metrics.Metrics([sink])
+    recorder.incr('login_total')
+    recorder.incr('token_lookup_total', result='hit')
+    recorder.incr('token_lookup_total', 2, result='hit')
+    recorder.observe('hash_seconds', 0.003, method='verify')
+    recorder.observe('session_bytes', 100)
+    lines = sink.render().splitlines()
+    assert 'easyauth_login_total 1.0' in lines
+    assert 'easyauth_token_lookup_total{result="hit"} 3.0' in lines
+    ## Buckets are cumulative
+    assert \
+        'easyauth_hash_seconds_bucket{method="verify",le="0.0025"} 0' \
+        in lines
+    assert \
+        'easyauth_hash_seconds_bucket{method="verify",le="0.005"} 1' \
+        in lines
+    assert 'easyauth_hash_seconds_bucket{method="verify",le="5.0"} 1' in lines
+    assert \
+        'easyauth_hash_seconds_bucket{method="verify",le="+Inf"} 1' in lines
+    assert 'easyauth_hash_seconds_sum{method="verify"} 0.003' in lines
+    assert 'easyauth_hash_seconds_count{method="verify"} 1' in lines
+    ## Sizes use byte buckets
+    assert 'easyauth_session_bytes_bucket{le="64"} 0' in lines
+    assert 'easyauth_session_bytes_bucket{le="128"} 1' in lines
+
+
+def test_request_metrics_reach_every_sink(make_env):
+    """
+    Sinks named in AUTH_METRICS, and sink instances,
+    get the metrics of requests
+    """
+    custom = ListSink()
+    env = add_routes(make_env({'AUTH_METRICS': ['prometheus', custom]}))
+
+    @env.app.route('/protected')
+    @decorators.real_required
+    def protected_view():
+        """
+        Protected view
+        """
+        return "ok"
+
+    with env.app.app_context():
+        add_user(env, 'user@example.com')
+    client = env.app.test_client()
+    assert client.post('/login').status_code == 200
+    assert client.get('/protected').status_code == 401
+    names = set(record[1] for record in custom.records)
+    assert 'login_total' in names
+    assert 'session_save_seconds' in names
+    assert 'session_bytes' in names
+    assert \
+        ('counter', 'unauthorized_total', 1, {'reason': 'not_authenticated'}) \
+        in custom.records
+    rendered = env.auth.metrics.get_sink(PrometheusSink).render()
+    assert 'easyauth_login_total 1.0' in rendered
+    assert 'easyauth_unauthorized_total{reason="not_authenticated"} 1.0' \
+        in rendered
+
+
+def test_signal_sink_sends_metrics(make_env):
+    """
+    The signals sink sends every metric,
+    with the app as sender
+    """
+    pytest.importorskip('blinker')
+    env = make_env({'AUTH_METRICS': ['signals']})
+    assert env.auth.metrics.get_sink(SignalSink) is not None
+    received = []
+
+    def receiver(sender, **kwargs):
+        """
+        Keep the signal
+        """
+        received.append((sender, kwargs))
+
+    metrics.metric_recorded.connect(receiver)
+    try:
+        with env.app.app_context():
+            env.auth.metrics.incr('login_total')
+            with env.auth.metrics.timer('hash_seconds', method='hash'):
+                pass
+        env.auth.metrics.incr('logout_total')
+    finally:
+        metrics.metric_recorded.disconnect(receiver)
+    assert received[0] == (
+        env.app,
+        {'kind': 'counter', 'name': 'login_total', 'value': 1, 'labels': {}})
+    sender, kwargs = received[1]
+    assert sender is env.app
+    assert kwargs['kind'] == 'observation'
+    assert kwargs['labels'] == {'method': 'hash'}
+    assert kwargs['value'] >= 0
+    assert received[2][0] is None
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+Login rate limit tests
+"""
+
+from __future__ import absolute_import
+
+import time
+
+import fakeredis
+import pytest
+from flask import request
+
+from flask_easyauth.hashing import HashingUnavailable
+from flask_easyauth.metrics import PrometheusSink
+from flask_easyauth.rate_limit import LoginRateLimiter, RateLimited
+
+from .conftest import PASSWORD, add_user
+
+
+def test_limit_per_account():
+    """
+    Attempts over an account's limit are refused, with the
+    time until the bucket refills, and other accounts are not
+    """
+    limiter = \
+        LoginRateLimiter(
+            fakeredis.FakeStrictRedis(),
+            {'account': (2, 60), 'ip': None})
+    limiter.check('user@example.com')
+    limiter.check('USER@example.com ')
+    with pytest.raises(RateLimited) as exc_info:
+        limiter.check('user@example.com')
+    assert exc_info.value.scope == 'account'
+    assert 29 <= exc_info.value.retry_after <= 30
+    assert limiter.check('other@example.com')
+
+
+def test_refused_attempt_drains_no_bucket():
+    """
+    An attempt refused by one bucket is not
+    charged against the others
+    """
+    redis = fakeredis.FakeStrictRedis()
+    limiter = \
+        LoginRateLimiter(
+            redis, {'account': (1, 60), 'ip': (2, 60), 'global': None})
+    limiter.check('user@example.com', '10.0.0.1')
+    for _ in range(3):
+        with pytest.raises(RateLimited) as exc_info:
+            limiter.check('user@example.com', '10.0.0.1')
+        assert exc_info.value.scope == 'account'
+    assert limiter.check('other@example.com', '10.0.0.1')
+
+
+def test_buckets_refill_by_server_clock(monkeypatch):
+    """
+    Buckets refill over their period, by the Redis clock,
+    whatever the clock of the app server
+    """
+    limiter = \
+        LoginRateLimiter(
+            fakeredis.FakeStrictRedis(),
+            {'account': None, 'ip': None, 'global': (1, 0.2)})
+    monkeypatch.setattr(time, 'time', lambda: 0.0)
+    limiter.check()
+    with pytest.raises(RateLimited) as exc_info:
+        limiter.check()
+    assert exc_info.value.scope == 'global'
+    assert exc_info.value.retry_after <= 0.2
+    monkeypatch.undo()
+    time.sleep(0.25)
+    assert limiter.check()
+
+
+def test_disabled_without_config(make_env):
+    """
+    Rate limiting is off unless AUTH_RATE_LIMIT is set
+    """
+    env = make_env()
+    assert env.auth.rate_limiter is None
+    assert env.auth.check_login_rate('user@example.com')
+
+
+def add_login_route(env):
+    """
+    Add a route which authenticates the test user
+    """
+
+    @env.app.route('/authenticate', methods=['POST'])
+    def authenticate_view():
+        """
+        Authenticate
+        """
+        user = \
+            env.auth.authenticate(
+                'user@example.com', request.form['password'])
+        return "ok" if user is not None else "no"
+
+    return env
+
+
+def test_rate_limited_login_answered_with_429(make_env, monkeypatch):
+    """
+    Logins over the limit are answered with a JSON 429,
+    before any password is hashed
+    """
+    env = \
+        add_login_route(
+            make_env({
+                'AUTH_RATE_LIMIT': True,
+                'AUTH_RATE_LIMIT_ACCOUNT': (1, 60),
+                'AUTH_METRICS': ['prometheus']
+            }))
+    with env.app.app_context():
+        add_user(env, 'user@example.com')
+    client = env.app.test_client()
+    resp = client.post('/authenticate', data={'password': PASSWORD})
+    assert resp.data == b"ok"
+    hashed = []
+    monkeypatch.setattr(
+        env.auth.hasher, 'verify_and_update',
+        lambda *args: hashed.append(args))
+    resp = client.post('/authenticate', data={'password': PASSWORD})
+    assert resp.status_code == 429
+    assert int(resp.headers['Retry-After']) == 60
+    assert b'too_many_requests' in resp.data
+    assert hashed == []
+    rendered = env.auth.metrics.get_sink(PrometheusSink).render()
+    assert 'easyauth_rate_limited_total{scope="account"} 1.0' in rendered
+
+
+def test_overloaded_hashing_answered_with_503(make_env, monkeypatch):
+    """
+    Logins within the limits, but shed by the full
+    hashing queue, are answered with a JSON 503
+    """
+    env = add_login_route(make_env({'AUTH_RATE_LIMIT': True}))
+    with env.app.app_context():
+        add_user(env, 'user@example.com')
+
+    def full_queue(*args):
+        """
+        Shed the hash
+        """
+        raise HashingUnavailable("Password hashing queue is full")
+
+    monkeypatch.setattr(env.auth.hasher, 'verify_and_update', full_queue)
+    resp = \
+        env.app.test_client().post(
+            '/authenticate', data={'password': PASSWORD})
+    assert resp.status_code == 503
+    assert b'unavailable' in resp.data
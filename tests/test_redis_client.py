@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Redis client tests
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+import fakeredis
+from redis import Redis, UnixDomainSocketConnection
+
+from flask_easyauth import redis_client
+from flask_easyauth.redis_client import (
+    InstrumentedConnectionPool,
+    LazyRedis,
+    create_redis,
+    get_redis_options
+)
+
+
+def test_pool_options_from_config():
+    """
+    Pool size, timeouts and credentials come from config
+    """
+    options = \
+        get_redis_options({
+            'SESSION_REDIS_MAX_CONNECTIONS': 7,
+            'SESSION_REDIS_POOL_TIMEOUT': 3,
+            'SESSION_REDIS_SOCKET_TIMEOUT': 0.5,
+            'SESSION_REDIS_PASS': 'secret',
+            'SESSION_REDIS_HOST': 'redis.local',
+            'SESSION_REDIS_HEALTH_CHECK_INTERVAL': 30
+        })
+    assert options['max_connections'] == 7
+    assert options['timeout'] == 3
+    assert options['socket_timeout'] == 0.5
+    assert options['password'] == 'secret'
+    assert options['host'] == 'redis.local'
+    assert options['health_check_interval'] == 30
+    options = \
+        get_redis_options({'SESSION_REDIS_UNIX_SOCKET_PATH': '/tmp/r.sock'})
+    assert options['connection_class'] is UnixDomainSocketConnection
+    assert options['path'] == '/tmp/r.sock'
+    assert 'host' not in options
+
+
+def test_create_redis_from_url():
+    """
+    A URL takes precedence over host, port, db and password,
+    and the pool keeps its configured size
+    """
+    client = \
+        create_redis({
+            'SESSION_REDIS_URL': 'redis://:urlpass@urlhost:6380/2',
+            'SESSION_REDIS_HOST': 'ignored',
+            'SESSION_REDIS_MAX_CONNECTIONS': 9
+        })
+    pool = client.connection_pool
+    assert isinstance(client, Redis)
+    assert isinstance(pool, InstrumentedConnectionPool)
+    assert pool.max_connections == 9
+    kwargs = pool.connection_kwargs
+    assert (kwargs['host'], kwargs['port']) == ('urlhost', 6380)
+    assert (kwargs['db'], kwargs['password']) == (2, 'urlpass')
+
+
+def test_lazy_client_recreated_after_fork(monkeypatch):
+    """
+    The client is created on first use, and again
+    in every new process
+    """
+    created = []
+
+    def factory():
+        """
+        Client factory
+        """
+        created.append(fakeredis.FakeStrictRedis())
+        return created[-1]
+
+    pid = [100]
+    monkeypatch.setattr(redis_client.os, 'getpid', lambda: pid[0])
+    lazy = LazyRedis(factory)
+    assert not created
+    lazy.set('a', 1)
+    lazy.get('a')
+    assert len(created) == 1
+    pid[0] = 101
+    lazy.get('a')
+    assert len(created) == 2
+    assert lazy.get_client() is created[1]
+
+
+def test_pool_counters_under_threads():
+    """
+    Pool counters stay consistent when shared by threads
+    """
+    pool = \
+        InstrumentedConnectionPool(
+            connection_class=fakeredis.FakeConnection,
+            server=fakeredis.FakeServer(),
+            max_connections=4)
+    client = Redis(connection_pool=pool)
+
+    def work():
+        """
+        Run commands
+        """
+        for _ in range(200):
+            client.incr('n')
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = pool.stats()
+    assert int(client.get('n')) == 1600
+    assert stats['waits'] == 1600
+    assert stats['in_use'] == 0
+    assert 1 <= stats['peak_in_use'] <= 4
+    assert stats['timeouts'] == 0
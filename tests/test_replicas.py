@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+Read replica tests
+"""
+
+from __future__ import absolute_import
+
+import fakeredis
+
+from flask_easyauth.replicas import (
+    HEARTBEAT_KEY,
+    HEARTBEAT_WRITER_KEY,
+    ReplicaRouter
+)
+
+from .test_session import RecordingRedis
+
+
+class StillRouter(ReplicaRouter):
+    """
+    Replica router without the lag monitor thread
+    """
+
+    def ensure_monitoring(self):
+        """
+        Lag is set by the tests
+        """
+        return False
+
+
+def replica_env(make_env):
+    """
+    Env whose sessions are read from a replica, which only
+    gets the writes the tests copy to it
+    """
+    env = make_env()
+    replica = fakeredis.FakeStrictRedis()
+    iface = env.app.session_interface
+    iface.replica_router = \
+        StillRouter(iface.session_redis, {'replica': replica})
+    env.replica = replica
+    return env
+
+
+def save(env, sid, value):
+    """
+    Save a session holding a value
+    """
+    iface = env.app.session_interface
+    sess = iface.session_class(sid=sid, new=True)
+    sess['value'] = value
+    iface.save_session(env.app, sess, None)
+    return sess
+
+
+def replicate(env, sid):
+    """
+    Copy a session to the replica
+    """
+    key = env.app.session_interface.session_key(sid)
+    env.replica.set(key, env.redis.get(key), ex=env.redis.ttl(key))
+    return True
+
+
+def test_write_of_another_process_read_from_primary(make_env):
+    """
+    A session another process wrote within the window is read
+    from the primary, even though the lagging replica has
+    neither the write nor its marker
+    """
+    env = replica_env(make_env)
+    iface = env.app.session_interface
+    router = iface.replica_router
+    save(env, 'abc', 'old')
+    replicate(env, 'abc')
+    save(env, 'abc', 'new')
+    ## Another process has no record of the write
+    router._recent.clear()
+    assert iface.load_session('abc')['value'] == 'new'
+    assert router.stats()['fallbacks'] == {'recent_write': 1}
+    ## Once the window is over, and the replica caught up
+    env.redis.delete(router.marker_key(iface.session_key('abc')))
+    replicate(env, 'abc')
+    assert iface.load_session('abc')['value'] == 'new'
+    assert router.stats()['replica_reads'] == 1
+
+
+def test_missing_and_lagging_replica_read_from_primary(make_env):
+    """
+    Sessions missing from the replica, and reads while it
+    lags, go to the primary
+    """
+    env = replica_env(make_env)
+    iface = env.app.session_interface
+    router = iface.replica_router
+    save(env, 'abc', 'val')
+    router._recent.clear()
+    env.redis.delete(router.marker_key(iface.session_key('abc')))
+    assert iface.load_session('abc')['value'] == 'val'
+    router._lags['replica'] = 5.0
+    replicate(env, 'abc')
+    assert iface.load_session('abc')['value'] == 'val'
+    assert \
+        router.stats()['fallbacks'] == {'missing': 1, 'lag': 1}
+
+
+def test_marker_written_with_session(make_env):
+    """
+    The recently written marker is set in the pipeline of
+    the save, and of the delete, with no extra round trip
+    """
+    env = replica_env(make_env)
+    iface = env.app.session_interface
+    router = iface.replica_router
+    primary = RecordingRedis(iface.session_redis)
+    iface.session_redis = primary
+    router.primary = primary
+    sess = save(env, 'abc', 'val')
+    assert primary.commands == ['pipeline']
+    assert env.redis.ttl(router.marker_key(iface.session_key('abc'))) == 5
+    env.redis.delete(router.marker_key(iface.session_key('abc')))
+    sess.clear()
+    sess.new = False
+    iface.save_session(env.app, sess, None)
+    assert primary.commands == ['pipeline', 'pipeline']
+    assert not env.redis.exists(iface.session_key('abc'))
+    assert env.redis.exists(router.marker_key(iface.session_key('abc')))
+
+
+def test_single_heartbeat_writer():
+    """
+    Only one process writes heartbeats, and another
+    takes over once its lock expires
+    """
+    primary = fakeredis.FakeStrictRedis()
+    first = StillRouter(primary, {})
+    second = StillRouter(primary, {})
+    beat = first.beat()
+    assert float(primary.get(HEARTBEAT_KEY)) == beat
+    assert 2900 <= primary.pttl(HEARTBEAT_WRITER_KEY) <= 3000
+    assert second.beat() == beat
+    assert float(primary.get(HEARTBEAT_KEY)) == beat
+    primary.delete(HEARTBEAT_WRITER_KEY)
+    assert second.beat() > beat
+    assert first.beat() == float(primary.get(HEARTBEAT_KEY))
+
+
+def test_lag_measured_against_primary_heartbeat():
+    """
+    Replica lag is the age of the replica's heartbeat against
+    the primary's, less one interval
+    """
+    primary = fakeredis.FakeStrictRedis()
+    current = fakeredis.FakeStrictRedis()
+    behind = fakeredis.FakeStrictRedis()
+    router = StillRouter(primary, {'current': current, 'behind': behind})
+    primary.set(HEARTBEAT_WRITER_KEY, 'other')
+    primary.set(HEARTBEAT_KEY, '100.0')
+    current.set(HEARTBEAT_KEY, '100.0')
+    behind.set(HEARTBEAT_KEY, '95.0')
+    assert router.measure_lag() == 100.0
+    assert router.stats()['lag'] == {'current': 0.0, 'behind': 4.0}
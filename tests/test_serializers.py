@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+Session serializer tests
+"""
+
+from __future__ import absolute_import
+
+import pickle
+
+import pytest
+
+from flask_easyauth.serializers import (
+    SessionSerializer,
+    LegacyPayloadRejected
+)
+
+LEGACY = pickle.dumps({'auth_token': 'abc'})
+
+
+@pytest.mark.parametrize('fmt', ['json', 'pickle'])
+def test_round_trip(fmt):
+    """
+    Payloads read back as written, compressed or not
+    """
+    data = {'auth_token': 'abc', 'items': [1, 2], 'big': 'x' * 100}
+    for threshold in (None, 10):
+        serializer = SessionSerializer(fmt, threshold)
+        assert serializer.loads(serializer.dumps(data)) == data
+
+
+def test_legacy_pickle_read_by_default():
+    """
+    Headerless pickle payloads are read during a rollout
+    """
+    assert SessionSerializer('json').loads(LEGACY) == {'auth_token': 'abc'}
+
+
+def test_legacy_pickle_rejected():
+    """
+    With legacy pickle disabled, headerless payloads
+    are never unpickled
+    """
+    serializer = SessionSerializer('json', legacy_pickle=False)
+    with pytest.raises(LegacyPayloadRejected):
+        serializer.loads(LEGACY)
+    assert serializer.loads(serializer.dumps({'a': 1})) == {'a': 1}
+
+
+def test_rejected_legacy_session_dropped(make_env):
+    """
+    A rejected legacy session opens as a new, empty session
+    """
+    env = make_env({'SESSION_SERIALIZER_LEGACY_PICKLE': False})
+    iface = env.app.session_interface
+    env.redis.set(iface.session_key('abc'), LEGACY)
+    sess = iface.load_session('abc')
+    assert sess.new
+    assert dict(sess) == {}
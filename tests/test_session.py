@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+"""
+Session interface tests
+"""
+
+from __future__ import absolute_import
+
+from datetime import timedelta
+
+import fakeredis
+from flask import request, session
+
+from flask_easyauth import current_user
+from flask_easyauth.constants import REQ_TOKEN_HEADER
+
+from .conftest import add_user
+from .test_core import add_routes
+
+
+def test_save_session_sets_ttl(make_env):
+    """
+    Saved sessions expire after their lifetime
+    """
+    env = make_env()
+    iface = env.app.session_interface
+    sess = iface.session_class(new=True)
+    sess['key'] = 'val'
+    iface.save_session(env.app, sess, None)
+    assert len(sess.sid) == 32
+    assert env.redis.ttl(iface.session_key(sess.sid)) == 86400
+    assert iface.load_session(sess.sid)['key'] == 'val'
+
+
+def test_auth_script_keeps_permanent_session_lifetime(make_env):
+    """
+    A permanent session loaded through the auth script keeps
+    PERMANENT_SESSION_LIFETIME, not the default lifetime
+    """
+    env = make_env({
+        'SESSION_REDIS_AUTH_SCRIPT': True,
+        'PERMANENT_SESSION_LIFETIME': timedelta(days=7)
+    })
+    iface = env.app.session_interface
+    sess = iface.session_class(sid='abc', new=True)
+    sess.permanent = True
+    sess['auth_token'] = 'abc'
+    iface.save_session(env.app, sess, None)
+    key = iface.session_key('abc')
+    assert env.redis.ttl(key) == 7 * 86400
+    ## Running low, so the script and save slide it
+    env.redis.expire(key, 60)
+    with env.app.test_request_context(headers={REQ_TOKEN_HEADER: 'abc'}):
+        assert session.permanent
+        env.app.session_interface.save_session(env.app, session, None)
+    assert env.redis.ttl(key) == 7 * 86400
+
+
+def test_auth_script_short_permanent_lifetime(make_env):
+    """
+    The auth script does not leave a permanent session
+    with more than PERMANENT_SESSION_LIFETIME left
+    """
+    env = make_env({
+        'SESSION_REDIS_AUTH_SCRIPT': True,
+        'PERMANENT_SESSION_LIFETIME': timedelta(hours=1)
+    })
+    iface = env.app.session_interface
+    sess = iface.session_class(sid='abc', new=True)
+    sess.permanent = True
+    iface.save_session(env.app, sess, None)
+    key = iface.session_key('abc')
+    env.redis.expire(key, 60)
+    with env.app.test_request_context(headers={REQ_TOKEN_HEADER: 'abc'}):
+        assert session.permanent
+        env.app.session_interface.save_session(env.app, session, None)
+    assert env.redis.ttl(key) == 3600
+
+
+class RecordingRedis(object):
+    """
+    Records the commands sent to a Redis client
+    """
+
+    def __init__(self, redis):
+        """
+        Constructor
+        """
+        self.redis = redis
+        self.commands = []
+        return None
+
+    def __getattr__(self, name):
+        """
+        Record a command
+        """
+        self.commands.append(name)
+        return getattr(self.redis, name)
+
+
+def test_anonymous_request_writes_nothing(make_env):
+    """
+    A request without a token, whose session only gets
+    Flask-Login bookkeeping, causes no Redis I/O
+    """
+    redis = RecordingRedis(fakeredis.FakeStrictRedis())
+    env = make_env(redis=redis)
+
+    @env.app.route('/anonymous')
+    def anonymous_view():
+        """
+        Touch the current user
+        """
+        assert not current_user.is_authenticated()
+        assert '_id' in session
+        return "ok"
+
+    resp = env.app.test_client().get('/anonymous')
+    assert resp.status_code == 200
+    assert redis.commands == []
+
+
+def test_reassigning_mutated_value_marks_modified(make_env):
+    """
+    Reassigning a value mutated in place is saved
+    """
+    env = make_env()
+    iface = env.app.session_interface
+    sess = iface.session_class(new=True)
+    sess['cart'] = [1]
+    iface.save_session(env.app, sess, None)
+    loaded = iface.load_session(sess.sid)
+    loaded['cart'].append(2)
+    loaded['cart'] = loaded['cart']
+    assert loaded.modified
+    iface.save_session(env.app, loaded, None)
+    assert iface.load_session(sess.sid)['cart'] == [1, 2]
+
+
+def test_reassigning_copy_of_mutated_value_marks_modified(make_env):
+    """
+    Assigning an equal copy of a value mutated
+    in place is saved too
+    """
+    env = make_env()
+    iface = env.app.session_interface
+    sess = iface.session_class(new=True)
+    sess['cart'] = {'items': 1}
+    iface.save_session(env.app, sess, None)
+    loaded = iface.load_session(sess.sid)
+    loaded['cart']['items'] = 2
+    loaded['cart'] = dict(loaded['cart'])
+    assert loaded.modified
+    iface.save_session(env.app, loaded, None)
+    assert iface.load_session(sess.sid)['cart'] == {'items': 2}
+
+
+def test_unchanged_assignment_not_modified(make_env):
+    """
+    Assigning the stored value of an immutable type is a no-op
+    """
+    env = make_env()
+    iface = env.app.session_interface
+    sess = iface.session_class(new=True)
+    sess['auth_token'] = 'abc'
+    sess['is_authenticated'] = True
+    iface.save_session(env.app, sess, None)
+    loaded = iface.load_session(sess.sid)
+    loaded['auth_token'] = 'abc'
+    loaded['is_authenticated'] = True
+    loaded.update(auth_token='abc')
+    assert not loaded.modified
+    loaded['is_authenticated'] = 1
+    assert loaded.modified
+
+
+def test_authenticated_request_without_session_use(make_env):
+    """
+    A request with a token, whose view never uses the
+    session, does not fetch it
+    """
+    redis = RecordingRedis(fakeredis.FakeStrictRedis())
+    env = add_routes(make_env(redis=redis))
+
+    @env.app.route('/plain')
+    def plain_view():
+        """
+        Never touches the session
+        """
+        return "ok"
+
+    with env.app.app_context():
+        add_user(env, 'user@example.com')
+    client = env.app.test_client()
+    token = client.post('/login').data.decode('utf-8')
+    del redis.commands[:]
+    resp = client.get('/plain', headers={REQ_TOKEN_HEADER: token})
+    assert resp.status_code == 200
+    assert redis.commands == []
+
+
+def test_request_loader_does_not_load_session(make_env):
+    """
+    Resolving the request token does not load a lazy
+    session, and only changes it when its values differ
+    """
+    redis = RecordingRedis(fakeredis.FakeStrictRedis())
+    env = make_env(redis=redis)
+    iface = env.app.session_interface
+    manager = env.auth.login_manager
+    with env.app.app_context():
+        user_id = add_user(env, 'user@example.com')
+        user = env.user_cls.get(user_id)
+        env.auth.token_store.add('abc', user)
+        env.auth.token_store.add('def', user)
+    for sid in ('abc', 'def'):
+        sess = iface.session_class(sid=sid, new=True)
+        sess['auth_token'] = sid
+        if sid == 'abc':
+            sess['is_authenticated'] = True
+        iface.save_session(env.app, sess, None)
+    del redis.commands[:]
+    with env.app.test_request_context(headers={REQ_TOKEN_HEADER: 'abc'}):
+        assert manager._load_user_from_request(request).id == user_id
+        assert not session.loaded
+        assert redis.commands == []
+        assert session['is_authenticated']
+        assert not session.modified
+    with env.app.test_request_context(headers={REQ_TOKEN_HEADER: 'def'}):
+        manager._load_user_from_request(request)
+        assert session['is_authenticated']
+        assert session.modified
+
+
+def hash_env(make_env):
+    """
+    Env with hash session storage, and a saved session
+    of two keys
+    """
+    env = make_env({'SESSION_STORAGE': 'hash'})
+    iface = env.app.session_interface
+    sess = iface.session_class(sid='abc', new=True)
+    sess['cart'] = [1]
+    sess['theme'] = 'dark'
+    iface.save_session(env.app, sess, None)
+    return env
+
+
+def test_hash_storage_writes_changed_keys(make_env):
+    """
+    Saving a hash stored session only writes
+    the keys which changed
+    """
+    env = hash_env(make_env)
+    iface = env.app.session_interface
+    key = iface.session_key('abc')
+    assert sorted(env.redis.hkeys(key)) == [b'cart', b'theme']
+    ## Unchanged keys are never written back
+    env.redis.hset(key, 'theme', iface.serializer.dumps('light'))
+    loaded = iface.load_session('abc')
+    loaded['cart'] = [1, 2]
+    loaded['theme'] = 'light'
+    iface.save_session(env.app, loaded, None)
+    env.redis.hset(key, 'theme', iface.serializer.dumps('blue'))
+    loaded = iface.load_session('abc')
+    loaded['cart'].append(3)
+    loaded['cart'] = loaded['cart']
+    iface.save_session(env.app, loaded, None)
+    loaded = iface.load_session('abc')
+    assert loaded['cart'] == [1, 2, 3]
+    assert loaded['theme'] == 'blue'
+    assert env.redis.ttl(key) == 86400
+
+
+def test_hash_storage_deletes_keys(make_env):
+    """
+    Keys removed from a hash stored session are deleted
+    from its hash, and an emptied session is deleted
+    """
+    env = hash_env(make_env)
+    iface = env.app.session_interface
+    key = iface.session_key('abc')
+    loaded = iface.load_session('abc')
+    del loaded['cart']
+    iface.save_session(env.app, loaded, None)
+    assert env.redis.hkeys(key) == [b'theme']
+    loaded = iface.load_session('abc')
+    assert dict(loaded) == {'theme': 'dark'}
+    loaded.pop('theme')
+    iface.save_session(env.app, loaded, None)
+    assert not env.redis.exists(key)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Sharded and cluster session storage tests
+"""
+
+from __future__ import absolute_import
+
+import fakeredis
+import pytest
+from flask import session
+
+from flask_easyauth import sharding
+from flask_easyauth.constants import REQ_TOKEN_HEADER
+from flask_easyauth.redis_client import InstrumentedConnectionPool
+
+from .conftest import add_user
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    """
+    A stand-in for the Redis Cluster client
+    """
+    client = fakeredis.FakeStrictRedis()
+    urls = []
+
+    def create_cluster_redis(url, config=None):
+        """
+        Record the URL, and return the stand-in
+        """
+        # pylint: disable=unused-argument
+        urls.append(url)
+        return client
+
+    monkeypatch.setattr(sharding, 'create_cluster_redis', create_cluster_redis)
+    client.urls = urls
+    return client
+
+
+@pytest.mark.parametrize('storage', ['blob', 'hash'])
+def test_cluster_save_session(make_env, cluster, storage):
+    """
+    In cluster mode, sessions and Redis tokens are stored in the
+    cluster under hash tagged keys, and read back
+    """
+    env = \
+        make_env({
+            'SESSION_REDIS_CLUSTER_URL': 'redis://cluster:7000/0',
+            'SESSION_STORAGE': storage,
+            'SESSION_REDIS_AUTH_SCRIPT': True,
+            'AUTH_TOKEN_STORE': 'redis'
+        })
+    iface = env.app.session_interface
+    assert iface.hash_tags
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        env.auth.login(user)
+        token = session['auth_token']
+        session['key'] = 'val'
+        iface.save_session(env.app, session, None)
+    assert cluster.urls == ['redis://cluster:7000/0']
+    assert iface.session_key(token).endswith('{%s}' % token)
+    assert cluster.exists(iface.session_key(token))
+    assert cluster.exists('token:{%s}' % token)
+    assert cluster.ttl(iface.session_key(token)) == 86400
+    ## Nothing session related lands on the main Redis
+    assert env.redis.keys('session*') == []
+    with env.app.test_request_context(headers={REQ_TOKEN_HEADER: token}):
+        env.app.preprocess_request()
+        assert session['key'] == 'val'
+        assert env.auth.token_store.get_user(token).id == user.id
+
+
+def test_cluster_client_pool_options(monkeypatch):
+    """
+    The cluster client gets the SESSION_REDIS_* pool size,
+    timeouts and password, and blocking node pools
+    """
+    cluster_module = pytest.importorskip('redis.cluster')
+    calls = []
+    monkeypatch.setattr(
+        cluster_module.RedisCluster,
+        'from_url',
+        classmethod(lambda cls, url, **kwargs: calls.append((url, kwargs))))
+    sharding.create_cluster_redis(
+        'redis://cluster:7000/0',
+        {
+            'SESSION_REDIS_MAX_CONNECTIONS': 7,
+            'SESSION_REDIS_POOL_TIMEOUT': 3,
+            'SESSION_REDIS_SOCKET_TIMEOUT': 0.5,
+            'SESSION_REDIS_SOCKET_CONNECT_TIMEOUT': 0.25,
+            'SESSION_REDIS_PASS': 'secret'
+        })
+    url, kwargs = calls[0]
+    assert url == 'redis://cluster:7000/0'
+    pool_cls = kwargs.pop('connection_pool_class')
+    assert kwargs == {
+        'max_connections': 7,
+        'socket_timeout': 0.5,
+        'socket_connect_timeout': 0.25,
+        'password': 'secret'
+    }
+    pool = pool_cls(host='node', port=7001, max_connections=7)
+    assert isinstance(pool, InstrumentedConnectionPool)
+    assert pool.timeout == 3
+    assert pool.max_connections == 7
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""
+Shared token cache tests
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+
+import pytest
+
+from flask_easyauth import shared_cache
+from flask_easyauth.shared_cache import SharedTokenCache
+
+pytestmark = \
+    pytest.mark.skipif(
+        shared_cache.fcntl is None, reason="requires fcntl")
+
+
+def snapshot(user_id, user_type='user'):
+    """
+    User snapshot, as the login manager caches it
+    """
+    return {
+        'identity': user_type,
+        'values': {
+            'id': user_id,
+            'type': user_type,
+            'active': True,
+            'real': True
+        }
+    }
+
+
+def test_round_trip(tmpdir):
+    """
+    A cached snapshot is read back by another
+    instance over the same file
+    """
+    path = str(tmpdir.join('tokens'))
+    cache = SharedTokenCache(path, slots=64)
+    other = SharedTokenCache(path, slots=64)
+    assert cache.get('abc') is None
+    assert cache.set('abc', snapshot(7))
+    assert other.get('abc') == snapshot(7)
+    other.delete('abc')
+    assert cache.get('abc') is None
+    assert cache.stats()['hits'] == 0
+    assert cache.stats()['misses'] == 2
+    assert other.stats()['hits'] == 1
+
+
+def test_ttl_expiry(tmpdir, monkeypatch):
+    """
+    Entries expire after the TTL
+    """
+    now = [1000.0]
+    monkeypatch.setattr(shared_cache.time, 'time', lambda: now[0])
+    cache = SharedTokenCache(str(tmpdir.join('tokens')), slots=64, ttl=60)
+    cache.set('abc', snapshot(7))
+    now[0] += 59
+    assert cache.get('abc') == snapshot(7)
+    now[0] += 2
+    assert cache.get('abc') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_eviction(tmpdir, monkeypatch):
+    """
+    A full bucket evicts the entry closest to expiring,
+    preferring expired slots to live ones
+    """
+    now = [1000.0]
+    monkeypatch.setattr(shared_cache.time, 'time', lambda: now[0])
+    ## A single bucket
+    cache = \
+        SharedTokenCache(
+            str(tmpdir.join('tokens')), slots=shared_cache.BUCKET_SLOTS)
+    tokens = ['token%d' % i for i in range(shared_cache.BUCKET_SLOTS)]
+    for i, token in enumerate(tokens):
+        cache.set(token, snapshot(i))
+        now[0] += 1
+    ## Rewriting a cached token takes its own slot
+    cache.set(tokens[1], snapshot(1))
+    assert cache.stats()['evictions'] == 0
+    cache.set('new', snapshot(99))
+    assert cache.stats()['evictions'] == 1
+    assert cache.get(tokens[0]) is None
+    assert cache.get('new') == snapshot(99)
+    for i, token in enumerate(tokens[1:], 1):
+        assert cache.get(token) == snapshot(i)
+    ## An expired slot is reused without an eviction
+    now[0] += cache.ttl - 1
+    cache.set('later', snapshot(100))
+    assert cache.stats()['evictions'] == 1
+    assert cache.get('later') == snapshot(100)
+
+
+def test_concurrent_readers_and_writers(tmpdir):
+    """
+    Readers racing writers over a shared bucket only ever
+    see a miss or the snapshot of the token they asked for,
+    and no counter update is lost
+    """
+    path = str(tmpdir.join('tokens'))
+    cache = SharedTokenCache(path, slots=shared_cache.BUCKET_SLOTS * 2)
+    tokens = ['token%d' % i for i in range(16)]
+    rounds = 200
+    errors = []
+
+    def write():
+        """
+        Keep rewriting every token
+        """
+        writer = SharedTokenCache(path, slots=cache.slots)
+        for _ in range(rounds):
+            for i, token in enumerate(tokens):
+                writer.set(token, snapshot(i))
+        return None
+
+    def read():
+        """
+        Keep reading every token
+        """
+        for _ in range(rounds):
+            for i, token in enumerate(tokens):
+                found = cache.get(token)
+                if (found is not None) and (found != snapshot(i)):
+                    errors.append((token, found))
+        return None
+
+    threads = \
+        [threading.Thread(target=write) for _ in range(2)] + \
+        [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 4 * rounds * len(tokens)
+    assert stats['hits'] > 0
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="requires fork")
+def test_clear_in_child_invalidates_parent(tmpdir):
+    """
+    Clearing in a forked child bumps the generation for the
+    parent too, and the child starts its own counters
+    """
+    cache = SharedTokenCache(str(tmpdir.join('tokens')), slots=64)
+    cache.set('abc', snapshot(7))
+    assert cache.get('abc') == snapshot(7)
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            if (
+                    (cache.stats()['hits'] == 0) and
+                    (cache.get('abc') == snapshot(7)) and
+                    cache.clear() and
+                    (cache.get('abc') is None)
+            ):
+                status = 0
+        finally:
+            os._exit(status)  # pylint: disable=protected-access
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert cache.get('abc') is None
+    stats = cache.stats()
+    assert stats['size'] == 0
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    ## The new generation is written to as usual
+    cache.set('abc', snapshot(8))
+    assert cache.get('abc') == snapshot(8)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+Token sweeper tests
+"""
+
+from __future__ import absolute_import
+
+from datetime import datetime, timedelta
+
+from flask_easyauth import sweeper
+
+from .conftest import add_user
+
+
+def add_tokens(env, user_id, count, expires):
+    """
+    Add tokens to the token table
+    """
+    for _ in range(count):
+        auth_token = env.token_cls()
+        auth_token.user_id = user_id
+        auth_token.token = env.auth.token_store.create_token()
+        auth_token.expires = expires
+        env.db.session.add(auth_token)
+    env.db.session.commit()
+    return True
+
+
+def test_sweep_deletes_expired_tokens_in_batches(make_env, monkeypatch):
+    """
+    Expired tokens are deleted batch by batch, pausing between
+    batches, and unexpired tokens are kept
+    """
+    env = make_env()
+    pauses = []
+    monkeypatch.setattr(sweeper.time, 'sleep', pauses.append)
+    now = datetime.utcnow()
+    with env.app.app_context():
+        user_id = add_user(env, 'user@example.com')
+        add_tokens(env, user_id, 5, now - timedelta(1))
+        add_tokens(env, user_id, 2, now + timedelta(1))
+        add_tokens(env, user_id, 1, None)
+        token_sweeper = sweeper.create_sweeper(env.app, batch_size=2, pause=0)
+        assert token_sweeper.sweep() == 5
+        assert pauses == [0, 0]
+        assert env.token_cls.query.count() == 3
+        assert token_sweeper.sweep() == 0
+
+
+def test_sweep_stops_after_max_batches(make_env, monkeypatch):
+    """
+    A sweep stops after `max_batches`, leaving
+    the remaining expired tokens
+    """
+    env = make_env()
+    monkeypatch.setattr(sweeper.time, 'sleep', lambda pause: None)
+    with env.app.app_context():
+        user_id = add_user(env, 'user@example.com')
+        add_tokens(env, user_id, 5, datetime.utcnow() - timedelta(1))
+        token_sweeper = sweeper.create_sweeper(env.app, batch_size=2)
+        assert token_sweeper.sweep(max_batches=1) == 2
+        assert env.token_cls.query.count() == 3
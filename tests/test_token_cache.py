@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+Token cache tests
+"""
+
+from __future__ import absolute_import
+
+import time
+
+import fakeredis
+
+from flask_easyauth import token_cache
+from flask_easyauth.constants import REQ_TOKEN_HEADER
+from flask_easyauth.token_cache import TokenCache, TokenCacheInvalidator
+
+from .conftest import add_user
+from .test_core import add_routes
+from .test_token_store import StatementCounter
+
+
+def wait_for(predicate, timeout=2.0):
+    """
+    Wait until a predicate holds
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_lru_eviction():
+    """
+    The least recently used entry is evicted once full
+    """
+    cache = TokenCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_ttl_expiry(monkeypatch):
+    """
+    Entries expire after the TTL
+    """
+    now = [1000.0]
+    monkeypatch.setattr(token_cache.time, 'time', lambda: now[0])
+    cache = TokenCache(max_size=10, ttl=60)
+    cache.set('a', 1)
+    now[0] += 59
+    assert cache.get('a') == 1
+    now[0] += 2
+    assert cache.get('a') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (1, 1, 0)
+
+
+def test_pubsub_invalidates_other_workers():
+    """
+    A token published by one worker is evicted from the
+    cache of every other worker
+    """
+    server = fakeredis.FakeServer()
+    caches = [TokenCache(), TokenCache()]
+    invalidators = [
+        TokenCacheInvalidator(
+            cache, fakeredis.FakeStrictRedis(server=server), 'chan')
+        for cache in caches
+    ]
+    listener = invalidators[1]
+    listener.ensure_listening()
+    assert wait_for(
+        lambda: listener.redis.pubsub_numsub('chan')[0][1] == 1)
+    for cache in caches:
+        cache.set('tok', {'identity': None, 'values': {}})
+        cache.set('other', {'identity': None, 'values': {}})
+    invalidators[0].publish('tok')
+    assert caches[0].get('tok') is None
+    assert wait_for(lambda: caches[1].get('tok') is None)
+    assert caches[1].get('other') is not None
+
+
+def test_forked_worker_starts_empty():
+    """
+    A forked worker drops the entries copied from its parent
+    """
+    cache = TokenCache()
+    invalidator = \
+        TokenCacheInvalidator(cache, fakeredis.FakeStrictRedis(), 'chan')
+    invalidator.ensure_listening()
+    cache.set('tok', 1)
+    assert not invalidator.ensure_listening()
+    assert cache.get('tok') == 1
+    ## As seen from a child process
+    invalidator._pid = -1
+    assert invalidator.ensure_listening()
+    assert cache.get('tok') is None
+
+
+def test_cached_token_resolves_without_query(make_env):
+    """
+    A cached token resolves with no query, and
+    logging out evicts it
+    """
+    env = \
+        add_routes(make_env({
+            'AUTH_TOKEN_CACHE_SIZE': 10,
+            'AUTH_TOKEN_CACHE_CHANNEL': 'chan'
+        }))
+    with env.app.app_context():
+        user_id = add_user(env, 'user@example.com')
+    client = env.app.test_client()
+    token = client.post('/login').data.decode('utf-8')
+    headers = {REQ_TOKEN_HEADER: token}
+    manager = env.auth.login_manager
+    with env.app.test_request_context(headers=headers):
+        assert manager._resolve_token(token)[1] == 'hit'
+    with StatementCounter(env.db.engine) as counter:
+        with env.app.test_request_context(headers=headers):
+            user, result = manager._resolve_token(token)
+            assert result == 'cache_hit'
+            assert user.id == user_id
+    assert counter.count == 0
+    assert client.post('/logout', headers=headers).status_code == 200
+    assert manager.token_cache.get(token) is None
+    with env.app.test_request_context(headers=headers):
+        assert manager._resolve_token(token) == (None, 'miss')
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Token filter tests
+"""
+
+from __future__ import absolute_import
+
+import os
+
+import fakeredis
+import pytest
+from flask import session
+
+from flask_easyauth.sharding import ShardedRedis
+
+from .conftest import add_user
+from .test_token_store import SIGNED_CONFIG
+
+
+def login(env, email):
+    """
+    Log a new user in, and return the token
+    """
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, email))
+        env.auth.login(user)
+        return session['auth_token']
+
+
+@pytest.mark.parametrize('store', ['sql', 'redis', 'redis_sql'])
+def test_rebuild_keeps_live_tokens(make_env, store):
+    """
+    After a rebuild, live tokens pass the filter
+    and unknown tokens are filtered
+    """
+    env = \
+        make_env({
+            'AUTH_TOKEN_STORE': store,
+            'AUTH_TOKEN_FILTER': True,
+            'AUTH_TOKEN_FILTER_CAPACITY': 1000
+        })
+    manager = env.auth.login_manager
+    ## No refresh thread, the test rebuilds
+    manager.token_filter._pid = os.getpid()
+    token = login(env, 'user@example.com')
+    if store == 'redis_sql':
+        env.auth.token_store.flush()
+    with env.app.test_request_context():
+        manager.token_filter.rebuild()
+        assert manager.token_filter.might_contain(token)
+        assert manager._resolve_token(token)[0] is not None
+        assert manager._resolve_token('0' * 32) == (None, 'filtered')
+
+
+def test_tokens_pass_until_first_rebuild(make_env):
+    """
+    Tokens issued before the filter was ever built pass
+    it, even once a login has added bits to it
+    """
+    env = \
+        make_env({
+            'AUTH_TOKEN_FILTER': True,
+            'AUTH_TOKEN_FILTER_CAPACITY': 1000
+        })
+    manager = env.auth.login_manager
+    manager.token_filter._pid = os.getpid()
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, 'old@example.com'))
+        env.auth.token_store.add('a' * 32, user)
+    login(env, 'user@example.com')
+    assert env.redis.exists(manager.token_filter.key)
+    with env.app.test_request_context():
+        assert manager._resolve_token('a' * 32)[1] == 'hit'
+        manager.token_filter.rebuild()
+        assert manager._resolve_token('a' * 32)[1] == 'hit'
+        assert manager._resolve_token('0' * 32) == (None, 'filtered')
+    stats = manager.token_filter.stats()
+    assert (stats['checks'], stats['rejected']) == (3, 1)
+
+
+def test_signed_store_refuses_filter(make_env):
+    """
+    Signed tokens can not be listed, so can not be filtered
+    """
+    config = dict(SIGNED_CONFIG)
+    config['AUTH_TOKEN_FILTER'] = True
+    with pytest.raises(Exception) as exc:
+        make_env(config)
+    assert 'AUTH_TOKEN_FILTER' in str(exc.value)
+
+
+def test_sharded_scan_iter():
+    """
+    Keys are scanned on every node
+    """
+    clients = {
+        'a': fakeredis.FakeStrictRedis(),
+        'b': fakeredis.FakeStrictRedis()
+    }
+    sharded = ShardedRedis(clients)
+    keys = ['token:{%d}' % i for i in range(20)]
+    for key in keys:
+        sharded.set(key, 1)
+    assert all(client.dbsize() for client in clients.values())
+    found = [key.decode('utf-8') for key in sharded.scan_iter('token:*')]
+    assert sorted(found) == sorted(keys)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+"""
+Token store tests
+"""
+
+from __future__ import absolute_import
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from flask import session
+from sqlalchemy import event
+
+from flask_easyauth import current_user, decorators, token_store
+from flask_easyauth.constants import REQ_TOKEN_HEADER
+from flask_easyauth.token_store import TokenStore
+
+from .conftest import add_user
+
+
+class StatementCounter(object):
+    """
+    Counts the statements run on an engine
+    """
+
+    def __init__(self, engine):
+        """
+        Constructor
+        """
+        self.engine = engine
+        self.count = 0
+        return None
+
+    def __call__(self, *args):
+        """
+        Count a statement
+        """
+        self.count += 1
+        return None
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self)
+        return False
+
+
+@pytest.mark.parametrize('use_baked', [True, False])
+def test_sql_get_user_joined_subclass_single_query(
+        make_env, monkeypatch, use_baked):
+    """
+    A token of a joined-table subclass user resolves,
+    with the subclass columns, in one statement
+    """
+    if not use_baked:
+        monkeypatch.setattr(token_store, 'baked', None)
+    env = make_env()
+    with env.app.app_context():
+        user_id = add_user(env, 'admin@example.com', env.admin_cls, level=3)
+        env.db.session.add(env.token_cls(user_id=user_id, token='tok'))
+        env.db.session.commit()
+        env.db.session.remove()
+        with StatementCounter(env.db.engine) as counter:
+            user = env.auth.token_store.get_user('tok')
+            assert isinstance(user, env.admin_cls)
+            assert user.id == user_id
+            assert user.level == 3
+            assert user.email == 'admin@example.com'
+        assert counter.count == 1
+
+
+@pytest.mark.parametrize('admin', [True, False])
+def test_protected_request_single_query(make_env, admin):
+    """
+    A request to a protected view, which reads the columns of
+    the user and of its polymorphic subclass, runs one statement
+    """
+    env = make_env()
+
+    @env.app.route('/protected')
+    @decorators.user_types_required('user')
+    def protected_view():
+        """
+        Protected view
+        """
+        user = current_user
+        return "%s %s %s" % (user.email, user.type, getattr(user, 'level', 0))
+
+    with env.app.app_context():
+        if admin:
+            user_id = \
+                add_user(env, 'admin@example.com', env.admin_cls, level=3)
+        else:
+            user_id = add_user(env, 'user@example.com')
+        env.db.session.add(env.token_cls(user_id=user_id, token='tok'))
+        env.db.session.commit()
+        env.db.session.remove()
+    client = env.app.test_client()
+    with StatementCounter(env.db.engine) as counter:
+        resp = client.get('/protected', headers={REQ_TOKEN_HEADER: 'tok'})
+    assert resp.status_code == 200
+    if admin:
+        assert resp.data == b"admin@example.com admin 3"
+    else:
+        assert resp.data == b"user@example.com user 0"
+    assert counter.count == 1
+
+
+def test_redis_add_sets_ttl(make_env):
+    """
+    Tokens kept in Redis expire after AUTH_TOKEN_STORE_TTL
+    """
+    env = make_env({'AUTH_TOKEN_STORE': 'redis'})
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        env.auth.login(user)
+        token = session['auth_token']
+        store = env.auth.token_store
+        assert env.redis.ttl(store.key(token)) == 30 * 86400
+        assert store.get_user(token).id == user.id
+
+
+@pytest.mark.parametrize('mode', ['sql', 'redis', 'redis_sql'])
+def test_expired_token_rejected(make_env, mode):
+    """
+    A token past its `expires` is rejected by every store
+    """
+    env = make_env({'AUTH_TOKEN_STORE': mode})
+    store = env.auth.token_store
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        env.auth.login(user, expires=datetime.utcnow() - timedelta(1))
+        token = session['auth_token']
+        if mode == 'redis_sql':
+            store.flush()
+        assert store.get_user(token) is None
+        if mode != 'sql':
+            assert not env.redis.exists(store.key(token))
+
+
+@pytest.mark.parametrize('mode', ['redis', 'redis_sql'])
+def test_redis_ttl_follows_expiry(make_env, mode):
+    """
+    Tokens kept in Redis expire at their `expires`, or after
+    AUTH_TOKEN_LIFETIME, when sooner than AUTH_TOKEN_STORE_TTL
+    """
+    env = make_env({
+        'AUTH_TOKEN_STORE': mode,
+        'AUTH_TOKEN_LIFETIME': timedelta(hours=1)
+    })
+    store = env.auth.token_store
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        env.auth.login(user)
+        assert 3590 <= env.redis.ttl(store.key(session['auth_token'])) <= 3600
+        env.auth.login(user, expires=datetime.utcnow() + timedelta(minutes=10))
+        token = session['auth_token']
+        assert 590 <= env.redis.ttl(store.key(token)) <= 600
+        assert store.get_user(token).id == user.id
+
+
+def test_redis_sql_backfill_keeps_expiry(make_env):
+    """
+    A token backfilled from the token table
+    expires from Redis at its `expires`
+    """
+    env = make_env({'AUTH_TOKEN_STORE': 'redis_sql'})
+    store = env.auth.token_store
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        env.auth.login(user, expires=datetime.utcnow() + timedelta(minutes=10))
+        token = session['auth_token']
+        store.flush()
+        env.redis.delete(store.key(token))
+        assert store.get_user(token).id == user.id
+        assert 590 <= env.redis.ttl(store.key(token)) <= 600
+
+
+def test_store_must_implement_abstract_methods(make_env):
+    """
+    A token store missing a required method
+    fails when it is constructed
+    """
+    env = make_env()
+
+    class HalfStore(TokenStore):
+        """
+        Only stores tokens
+        """
+
+        def add(self, token, user, **kwargs):
+            """
+            Add
+            """
+            return True
+
+    with pytest.raises(TypeError):
+        HalfStore(env.app, env.db, env.user_cls, env.token_cls)
+
+
+def login_redis_sql(env):
+    """
+    Log a user in with the redis_sql store, and return the
+    token once it is persisted. Later writes to the token
+    table are held back, and returned.
+    """
+    store = env.auth.token_store
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        env.auth.login(user)
+        token = session['auth_token']
+    store.flush()
+    held = []
+    store.persist = lambda func, *args: held.append((func, args))
+    return (token, held)
+
+
+def test_redis_sql_removed_token_not_backfilled(make_env):
+    """
+    A token removed from Redis, but not yet from the token
+    table, is not resolved or backfilled from the table
+    """
+    env = make_env({'AUTH_TOKEN_STORE': 'redis_sql'})
+    store = env.auth.token_store
+    token, held = login_redis_sql(env)
+    with env.app.test_request_context():
+        store.remove(token)
+        assert store.sql_store.get_user(token) is not None
+        assert store.get_user(token) is None
+        assert not env.redis.exists(store.key(token))
+        for func, args in held:
+            func(*args)
+        assert store.get_user(token) is None
+    assert not env.redis.exists(store.key(token))
+
+
+def test_redis_sql_backfill_skips_revoked(make_env):
+    """
+    A token read from the token table before it was revoked
+    is not backfilled after it
+    """
+    env = make_env({'AUTH_TOKEN_STORE': 'redis_sql'})
+    store = env.auth.token_store
+    token, _ = login_redis_sql(env)
+    with env.app.test_request_context():
+        env.redis.delete(store.key(token))
+        user = store.sql_store.get_user(token)
+        assert store.get_user(token).id == user.id
+        env.redis.delete(store.key(token))
+        store.remove_many([token], [user.id])
+        assert not store.backfill(token, user)
+        assert not env.redis.exists(store.key(token))
+
+
+SIGNED_CONFIG = {
+    'AUTH_TOKEN_STORE': 'signed',
+    'AUTH_SIGNING_KEYS': {'k1': 'secret'},
+    'AUTH_SIGNING_KEY_ID': 'k1'
+}
+
+
+def test_signed_revoked_token_stays_revoked(make_env):
+    """
+    A revoked signed token is rejected until it expires,
+    not only for the first second
+    """
+    env = make_env(SIGNED_CONFIG)
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        store = env.auth.token_store
+        token = store.create_token(user)
+        other = store.create_token(user)
+        assert store.get_user(token) is not None
+        store.remove(token)
+        store.remove_many([other], [user.id])
+        time.sleep(1.5)
+        assert store.get_user(token) is None
+        assert store.get_user(other) is None
+
+
+def test_signed_token_expires(make_env):
+    """
+    A signed token is rejected after AUTH_SIGNED_TOKEN_TTL
+    """
+    config = dict(SIGNED_CONFIG, AUTH_SIGNED_TOKEN_TTL=timedelta(seconds=1))
+    env = make_env(config)
+    with env.app.test_request_context():
+        user = env.user_cls.get(add_user(env, 'user@example.com'))
+        store = env.auth.token_store
+        token = store.create_token(user)
+        assert store.get_user(token) is not None
+        time.sleep(1.5)
+        assert store.get_user(token) is None
+
+
+def test_signed_user_passes_real_required(make_env):
+    """
+    The user of a signed token keeps its id type and flags,
+    and passes `real_required`
+    """
+    env = make_env(SIGNED_CONFIG)
+
+    @env.app.route('/real')
+    @decorators.real_required
+    def real_view():
+        """
+        Real user view
+        """
+        return "ok"
+
+    with env.app.test_request_context():
+        user_id = add_user(env, 'user@example.com')
+        token = env.auth.token_store.create_token(env.user_cls.get(user_id))
+    with env.app.test_request_context():
+        user = env.auth.token_store.get_user(token)
+        assert user.id == user_id
+        assert user.active and user.real
+    client = env.app.test_client()
+    resp = client.get('/real', headers={REQ_TOKEN_HEADER: token})
+    assert resp.status_code == 200
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Write-behind session persistence tests
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+from flask import Flask
+
+from flask_easyauth import write_behind
+from flask_easyauth.metrics import Metrics, PrometheusSink
+from flask_easyauth.token_redis_session import TokenRedisSession
+from flask_easyauth.write_behind import PendingSessionWrite, SessionWriter
+
+
+class HeldWriter(object):
+    """
+    Session write function, which holds the first batch
+    until released, and fails a number of times
+    """
+
+    def __init__(self, failures=0):
+        """
+        Constructor
+        """
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.failures = failures
+        return None
+
+    def __call__(self, writes):
+        """
+        Record a batch
+        """
+        self.started.set()
+        self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Redis is down")
+        self.batches.append(
+            sorted((write.sid, dict(write)) for write in writes))
+        return True
+
+
+def pending(sid, **values):
+    """
+    Get a pending write of a session
+    """
+    sess = TokenRedisSession(sid=sid, new=True)
+    sess.update(values)
+    return PendingSessionWrite(sess, None)
+
+
+def held_writer(write, **kwargs):
+    """
+    Session writer whose thread is busy writing a first
+    session, until `write.release` is set
+    """
+    writer = SessionWriter(Flask(__name__), write, **kwargs)
+    writer.submit(pending('first', n=0))
+    assert write.started.wait(5)
+    return writer
+
+
+def test_writes_to_one_session_coalesced():
+    """
+    Writes of a session queued while the writer is busy are
+    coalesced into the latest, and read back until written
+    """
+    write = HeldWriter()
+    writer = held_writer(write)
+    writer.submit(pending('abc', n=1, a=1))
+    writer.submit(pending('abc', n=2))
+    writer.submit(pending('def', n=1))
+    assert writer.get('abc')[0] == {'n': 2}
+    assert writer.get('first')[0] == {'n': 0}
+    write.release.set()
+    assert writer.flush(5)
+    assert write.batches == [
+        [('first', {'n': 0})],
+        [('abc', {'n': 2}), ('def', {'n': 1})]
+    ]
+    assert writer.get('abc') is None
+    stats = writer.stats()
+    assert (stats['queued'], stats['coalesced']) == (3, 1)
+    assert (stats['written'], stats['pending']) == (3, 0)
+
+
+def test_discard_drops_queued_write():
+    """
+    A discarded session is never written
+    """
+    write = HeldWriter()
+    writer = held_writer(write)
+    writer.submit(pending('abc', n=1))
+    writer.discard('abc')
+    write.release.set()
+    assert writer.flush(5)
+    assert write.batches == [[('first', {'n': 0})]]
+
+
+def test_flush_waits_for_writes(monkeypatch):
+    """
+    A flush waits for queued writes, up to its timeout,
+    and is registered to run at exit
+    """
+    registered = []
+    monkeypatch.setattr(write_behind.atexit, 'register', registered.append)
+    write = HeldWriter()
+    writer = held_writer(write)
+    assert registered == [writer.flush]
+    writer.submit(pending('abc', n=1))
+    assert not writer.flush(0.1)
+    write.release.set()
+    assert writer.flush(5)
+    assert writer.stats()['written'] == 2
+
+
+def test_failed_batch_retried():
+    """
+    A batch which fails is retried, and written
+    """
+    write = HeldWriter(failures=2)
+    write.release.set()
+    writer = held_writer(write, retry_delay=0.01)
+    assert writer.flush(5)
+    assert write.batches == [[('first', {'n': 0})]]
+    stats = writer.stats()
+    assert (stats['errors'], stats['written'], stats['dropped']) == \
+        (2, 1, 0)
+
+
+def test_failed_batch_dropped_after_retries():
+    """
+    A batch which fails every retry is dropped,
+    and counted in the metrics
+    """
+    write = HeldWriter(failures=3)
+    write.release.set()
+    sink = PrometheusSink()
+    writer = SessionWriter(Flask(__name__), write, retries=2,
+                           retry_delay=0.01)
+    writer.metrics = Metrics([sink])
+    writer.submit(pending('abc', n=1))
+    assert writer.flush(5)
+    assert write.batches == []
+    stats = writer.stats()
+    assert (stats['errors'], stats['dropped']) == (3, 1)
+    assert 'easyauth_session_write_dropped_total 1.0' in sink.render()
+    ## Later writes still go through
+    writer.submit(pending('abc', n=2))
+    assert writer.flush(5)
+    assert write.batches == [[('abc', {'n': 2})]]
+
+
+def test_delete_discards_queued_write(make_env):
+    """
+    A session deleted after a queued write stays deleted
+    """
+    env = make_env({'SESSION_WRITE_BEHIND': True})
+    iface = env.app.session_interface
+    sess = iface.session_class(sid='abc', new=True)
+    sess['key'] = 'val'
+    iface.save_session(env.app, sess, None)
+    assert iface.load_session('abc')['key'] == 'val'
+    loaded = iface.load_session('abc')
+    loaded.clear()
+    loaded.new = False
+    iface.save_session(env.app, loaded, None)
+    assert iface.session_writer.flush(5)
+    assert not env.redis.exists(iface.session_key('abc'))
+    assert iface.session_writer.get('abc') is None